@@ -1,31 +1,58 @@
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Body
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Body, Query
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import AsyncGenerator, Optional, Dict, Any
-from pydantic import BaseModel
+from typing import AsyncGenerator, Optional, Dict, Any, List
+from pydantic import BaseModel, Field
 import os
 import uuid
 import json
+import asyncio
 import threading
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 from utils.logger import logger_init
-from utils.pdf_to_markdown import process_pdf_in_thread
+from utils.pdf_to_markdown import PDF_VECTOR_SOURCE, process_pdf_in_thread, markdown_path_for, vector_source_path
 from utils.database_chat import get_db, save_message, get_session_history, load_session_history, update_session_title, Session, Message
 from utils.database_knowledge import (
     create_knowledge_base,
     delete_knowledge_base,
     list_knowledge_bases,
+    list_knowledge_base_ids,
     get_knowledge_base,
     add_document,
     delete_document,
     list_documents,
-    get_document
+    get_document,
+    list_document_ids,
+    find_document_by_name,
+    replace_document_file
+)
+from utils.chroma_store import (
+    load_chroma_store_retriever,
+    chroma_store_add_docs,
+    chroma_store_delete_docs,
+    chroma_store_reindex_doc,
+    chroma_store_gc,
+    delete_chroma_store,
+    build_metadata_filter,
+    build_hnsw_configuration,
+    create_chroma_store,
+    chroma_store_rebuild,
+    chroma_store_exists,
+    get_chroma_index_settings
 )
-from utils.chroma_store import load_chroma_store_retriever, chroma_store_add_docs
 from utils.rag_chat import generate_rag_response_stream_with_context
+from utils.warmup import WARMUP_ENABLED, run_warmup, warmup_state
+from utils.bulk_import import (
+    create_import_job,
+    get_import_job,
+    import_source,
+    is_archive,
+    resolve_import_directory
+)
 from utils._config import APP_VERSION, humanRole, aiRole
 
 logger = logger_init("main")
@@ -33,7 +60,19 @@ logger = logger_init("main")
 # 加载环境变量
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """服务启动时在后台执行预热，预热完成前 /api/ready 返回 503"""
+    if WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(asyncio.to_thread(run_warmup))
+    else:
+        warmup_state.ready = True
+    yield
+    if WARMUP_ENABLED and not warmup_task.done():
+        logger.info("服务关闭时预热尚未完成")
+
 app = FastAPI(
+    lifespan=lifespan,
     title="QAChatAgent API",
     description="API服务为前端提供PDF处理和知识库管理功能",
     version=APP_VERSION,
@@ -50,28 +89,82 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 就绪检查接口：启动预热完成后返回200，供负载均衡和部署探针使用
+@app.get("/api/ready")
+async def api_ready():
+    state = warmup_state.to_dict()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content={"code": 503, "message": "服务预热中", "data": state})
+    return {"code": 200, "message": "服务已就绪", "data": state}
+
 # 确保上传目录存在
 os.makedirs("./uploads", exist_ok=True)
 
 # 静态文件服务
 app.mount("/api/uploads", StaticFiles(directory="./uploads"), name="uploads")
 
+# 上传文件的存储目录
+UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "uploads"))
+
 # 处理文档向量化的后台任务函数
-def process_document_for_vector_db(file_path: str, kb_id: str):
+def process_document_for_vector_db(file_path: str, kb_id: str, doc_id: Optional[str] = None):
     """
     处理文档并将其添加到向量数据库
     
     Args:
         file_path: 文件路径
         kb_id: 知识库ID
+        doc_id: 知识库文档ID，用于记录文档对应的向量ID
     """
     try:
         logger.info(f"开始处理文档向量化 - 文件: {file_path}, 知识库ID: {kb_id}")
-        chroma_store_add_docs(kb_id, file_path)
+        chroma_store_add_docs(kb_id, file_path, doc_id=doc_id)
         logger.info(f"文档向量化处理完成 - 文件: {file_path}, 知识库ID: {kb_id}")
     except Exception as e:
         logger.error(f"文档向量化处理失败: {str(e)}", exc_info=True)
 
+# PDF转换完成后的向量化（在PDF处理线程中调用）
+def process_pdf_markdown_for_vector_db(success: bool, file_path: str, kb_id: str, doc_id: Optional[str] = None):
+    """
+    用PDF高分辨率解析生成的Markdown向量化，转换失败时回退到PyPDF快速提取PDF文本
+
+    Args:
+        success: PDF转换是否成功
+        file_path: PDF文件路径
+        kb_id: 知识库ID
+        doc_id: 知识库文档ID
+    """
+    md_path = markdown_path_for(file_path)
+    if success and os.path.exists(md_path):
+        process_document_for_vector_db(md_path, kb_id, doc_id)
+    else:
+        logger.warning(f"PDF转换Markdown失败，使用PyPDF快速提取向量化 - 文件: {file_path}")
+        process_document_for_vector_db(file_path, kb_id, doc_id)
+
+# 重建文档向量的后台任务函数
+def reindex_document_for_vector_db(file_path: str, kb_id: str, doc_id: str):
+    """删除文档原有向量并重新向量化"""
+    try:
+        logger.info(f"开始重建文档向量 - 文档ID: {doc_id}, 知识库ID: {kb_id}")
+        chroma_store_reindex_doc(kb_id, doc_id, vector_source_path(file_path))
+        logger.info(f"文档向量重建完成 - 文档ID: {doc_id}, 知识库ID: {kb_id}")
+    except Exception as e:
+        logger.error(f"文档向量重建失败: {str(e)}", exc_info=True)
+
+# 向量垃圾回收的后台任务函数
+def collect_orphan_vectors(kb_ids: List[str]):
+    """清理各知识库向量集合中的孤立向量"""
+    for kb_id in kb_ids:
+        try:
+            chroma_store_gc(kb_id)
+        except Exception as e:
+            logger.error(f"知识库 {kb_id} 向量垃圾回收失败: {str(e)}", exc_info=True)
+
+def get_document_file_path(kb_id: str, doc_id: str) -> Optional[str]:
+    """获取知识库文档在上传目录中的文件路径，文档不存在时返回None"""
+    saved_name = dict(list_document_ids(kb_id)).get(doc_id)
+    return os.path.join(UPLOAD_DIR, saved_name) if saved_name else None
+
 # 文件上传接口（支持知识库文档上传）
 @app.post("/api/upload")
 async def upload_file(
@@ -102,8 +195,10 @@ async def upload_file(
         annotated_path = ""
         md_path = ""
         thread = None
-        if file_ext.lower() in ['.pdf', '.pdfa', '.pdfx']:
-            background_tasks.add_task(process_pdf_in_thread, file_path)
+        is_pdf = file_ext.lower() in ['.pdf', '.pdfa', '.pdfx']
+        # 关联知识库的PDF默认等待转换生成的Markdown后再向量化，整个流程只做一次高分辨率解析
+        vectorize_from_markdown = is_pdf and PDF_VECTOR_SOURCE == "markdown" and bool(kb_id and kb_id.strip())
+        if is_pdf:
             annotated_path = f"/api/uploads/{os.path.splitext(unique_filename)[0]}_annotated.pdf"
             md_path = f"/api/uploads/{os.path.splitext(unique_filename)[0]}.md"
             thread = threading.current_thread()
@@ -112,19 +207,47 @@ async def upload_file(
         doc_id = str(uuid.uuid4().hex)
         if kb_id and kb_id.strip():  # 确保kb_id不是空字符串
             logger.info(f"将文件关联到知识库：{kb_id}")
-            doc = add_document(
-                doc_id=doc_id,
-                kb_id=kb_id,
-                name=original_name,
-                saved_name=unique_filename,
-                path=f"/api/uploads/{unique_filename}",
-                size=file_size,
-                annotated_path=annotated_path,
-                md_path=md_path
-            )
+            # 同一知识库中重新上传同名文件时替换原文档，沿用文档ID以增量更新向量
+            existing_doc_id = find_document_by_name(kb_id, original_name)
+            if existing_doc_id:
+                logger.info(f"知识库 {kb_id} 中已存在同名文档 {existing_doc_id}，替换文件并增量更新向量")
+                doc_id = existing_doc_id
+                doc = replace_document_file(
+                    doc_id=doc_id,
+                    saved_name=unique_filename,
+                    path=f"/api/uploads/{unique_filename}",
+                    size=file_size,
+                    annotated_path=annotated_path,
+                    md_path=md_path
+                )
+                if not doc:
+                    # 不能在没有文档ID的情况下向量化，否则会按文件路径生成另一套向量，与原文档的向量重复
+                    os.remove(file_path)
+                    raise HTTPException(status_code=500, detail=f"替换同名文档失败: {original_name}")
+            else:
+                doc = add_document(
+                    doc_id=doc_id,
+                    kb_id=kb_id,
+                    name=original_name,
+                    saved_name=unique_filename,
+                    path=f"/api/uploads/{unique_filename}",
+                    size=file_size,
+                    annotated_path=annotated_path,
+                    md_path=md_path
+                )
             
             # 添加向量化处理任务
-            background_tasks.add_task(process_document_for_vector_db, file_path, kb_id)
+            if vectorize_from_markdown:
+                background_tasks.add_task(
+                    process_pdf_in_thread, file_path,
+                    lambda success: process_pdf_markdown_for_vector_db(success, file_path, kb_id, doc_id if doc else None)
+                )
+            else:
+                background_tasks.add_task(process_document_for_vector_db, file_path, kb_id, doc_id if doc else None)
+
+        # 其他PDF只在后台生成Markdown和批注版
+        if is_pdf and not vectorize_from_markdown:
+            background_tasks.add_task(process_pdf_in_thread, file_path)
         
         if file_ext.lower() in ['.pdf', '.pdfa', '.pdfx']:
             return {
@@ -152,6 +275,8 @@ async def upload_file(
                 "docId": doc_id
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文件上传失败: {str(e)}")
 
@@ -164,6 +289,14 @@ async def api_delete_document_api(
     """删除知识库文档"""
     try:
         logger.info(f"开始删除文档 - 知识库ID: {kb_id}, 文档ID: {doc_id}")
+
+        # 先删除文档在向量库中的向量（删除文档记录后将无法再查到向量ID）
+        file_path = get_document_file_path(kb_id, doc_id)
+        if file_path:
+            try:
+                chroma_store_delete_docs(kb_id, doc_id, file_path)
+            except Exception as e:
+                logger.error(f"删除文档向量失败，将由垃圾回收清理: {str(e)}")
         
         # 调用delete_document处理所有操作（包括验证和删除）
         if not delete_document(doc_id, kb_id=kb_id):
@@ -183,6 +316,23 @@ async def api_delete_document_api(
         logger.error(f"文档删除过程中发生未捕获的异常: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"文档删除失败: {str(e)}")
 
+# 文档向量重建接口
+@app.post("/api/reindex/{kb_id}/{doc_id}")
+async def api_reindex_document(background_tasks: BackgroundTasks, kb_id: str, doc_id: str):
+    """重建知识库文档的向量"""
+    file_path = get_document_file_path(kb_id, doc_id)
+    if not file_path:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    background_tasks.add_task(reindex_document_for_vector_db, file_path, kb_id, doc_id)
+    return {
+        "code": 200,
+        "message": "文档向量重建任务已提交",
+        "data": {
+            "doc_id": doc_id,
+            "knowledge_base_id": kb_id
+        }
+    }
+
 # 任务状态查询接口
 @app.get("/api/task/status/{task_id}")
 async def api_get_task_status(task_id: int) -> Dict[str, Any]:
@@ -212,11 +362,38 @@ async def api_get_task_status(task_id: int) -> Dict[str, Any]:
 
 # 流式聊天接口，添加知识库参数
 @app.get("/api/chat/stream")
-async def api_stream_chat_response(session_id: str, message: str, kb_id : str):
-    """SSE流式响应端点，支持基于知识库的回答"""
+async def api_stream_chat_response(
+    session_id: str,
+    message: str,
+    kb_id: Optional[str] = None,
+    kb_ids: Optional[List[str]] = Query(None),
+    filters: Optional[str] = None
+):
+    """
+    SSE流式响应端点，支持基于知识库的回答
+    
+    同时检索多个知识库时可重复传入 kb_ids 参数，或在 kb_id 中以逗号分隔多个ID。
+    filters 为JSON格式的元数据过滤条件，如 {"doc_id": "..."} 只检索指定文档，
+    可用字段为 doc_id、document_type、source、file_path、page、headers、kb_id。
+    """
+    try:
+        metadata_filters = json.loads(filters) if filters else None
+        if metadata_filters is not None and not isinstance(metadata_filters, dict):
+            raise ValueError("过滤条件必须是JSON对象")
+        build_metadata_filter(metadata_filters)
+    except ValueError as e:
+        # json.JSONDecodeError 也是 ValueError
+        raise HTTPException(status_code=400, detail=f"过滤条件无效: {str(e)}")
+
     full_response = ""
     try:
-        logger.info(f"流式聊天：{session_id} - {message} - 知识库ID：{kb_id }")
+        knowledge_base_ids = [
+            item.strip()
+            for value in [*(kb_ids or []), *([kb_id] if kb_id else [])]
+            for item in value.split(",") if item.strip()
+        ]
+        knowledge_base_ids = list(dict.fromkeys(knowledge_base_ids)) or ["0"]
+        logger.info(f"流式聊天：{session_id} - {message} - 知识库ID：{knowledge_base_ids}")
         # 收集用户消息
         save_message(session_id, humanRole, message)
         
@@ -225,7 +402,7 @@ async def api_stream_chat_response(session_id: str, message: str, kb_id : str):
             nonlocal full_response
             try:
                 # 使用RAG知识库增强的流式响应
-                async for chunk in generate_rag_response_stream_with_context(message, session_id, kb_id ):
+                async for chunk in generate_rag_response_stream_with_context(message, session_id, knowledge_base_ids, metadata_filters):
                     content_json = chunk.replace("data: ", "")
                     try:
                         content_data = json.loads(content_json)
@@ -279,9 +456,17 @@ async def api_stream_chat_response(session_id: str, message: str, kb_id : str):
 class SessionUpdateModel(BaseModel):
     title: str
 
+class IndexSettingsModel(BaseModel):
+    """知识库向量集合的HNSW索引参数，未指定的参数使用Chroma默认值"""
+    space: Optional[str] = Field(None, description="距离度量: l2 / cosine / ip")
+    M: Optional[int] = Field(None, ge=2, description="每个节点的最大邻居数")
+    construction_ef: Optional[int] = Field(None, ge=2, description="建图时的候选列表大小")
+    search_ef: Optional[int] = Field(None, ge=2, description="检索时的候选列表大小")
+
 class KnowledgeBaseCreateModel(BaseModel):
     name: str
     description: str = ""
+    index_settings: Optional[IndexSettingsModel] = None
 
 # 会话标题更新接口
 @app.put("/api/session/update/{session_id}")
@@ -318,11 +503,18 @@ async def api_create_knowledge_base(kb_data: KnowledgeBaseCreateModel):
         logger.info(f"创建知识库请求 - 名称: {kb_data.name}, 描述: {kb_data.description}")
         kb_id = str(uuid.uuid4().hex)
         logger.info(f"生成知识库ID: {kb_id}")
+        index_settings = kb_data.index_settings.model_dump(exclude_none=True) if kb_data.index_settings else None
+        try:
+            build_hnsw_configuration(index_settings)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         kb = create_knowledge_base(kb_id, kb_data.name, kb_data.description)
         if not kb:
             logger.error(f"创建知识库失败 - ID: {kb_id}, 名称: {kb_data.name}")
             raise HTTPException(status_code=400, detail="创建知识库失败")
+        if index_settings:
+            create_chroma_store(kb_id, index_settings)
         
         logger.info(f"知识库创建成功 - ID: {kb_id}, 名称: {kb_data.name}")
         return {
@@ -331,9 +523,12 @@ async def api_create_knowledge_base(kb_data: KnowledgeBaseCreateModel):
             "data": {
                 "id": kb_id,
                 "name": kb_data.name,
-                "description": kb_data.description
+                "description": kb_data.description,
+                "index_settings": index_settings or {}
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"创建知识库过程中发生未捕获的异常: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"创建知识库失败: {str(e)}")
@@ -357,6 +552,9 @@ async def api_delete_knowledge_base(kb_id: str):
         success = delete_knowledge_base(kb_id)
         if not success:
             raise HTTPException(status_code=404, detail="知识库不存在")
+
+        # 删除向量集合并使缓存的集合句柄失效
+        delete_chroma_store(kb_id)
             
         return {
             "code": 200,
@@ -370,6 +568,107 @@ async def api_delete_knowledge_base(kb_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除知识库失败: {str(e)}")
 
+# 向量垃圾回收接口
+@app.post("/api/knowledge_base/gc")
+async def api_collect_orphan_vectors(background_tasks: BackgroundTasks, kb_id: Optional[str] = None):
+    """在后台清理孤立向量，不指定kb_id时清理所有知识库"""
+    kb_ids = [kb_id] if kb_id else list_knowledge_base_ids(limit=10000)
+    background_tasks.add_task(collect_orphan_vectors, kb_ids)
+    return {
+        "code": 200,
+        "message": "向量垃圾回收任务已提交",
+        "data": {
+            "knowledge_base_ids": kb_ids
+        }
+    }
+
+def rebuild_vector_store(kb_id: str, index_settings: Optional[Dict[str, Any]] = None):
+    """后台任务：用已存储的向量重建知识库集合"""
+    try:
+        chroma_store_rebuild(kb_id, index_settings)
+    except Exception as e:
+        logger.error(f"重建知识库 {kb_id} 的向量集合失败: {str(e)}")
+
+# 向量集合重建/压缩接口
+@app.post("/api/knowledge_base/rebuild/{kb_id}")
+async def api_rebuild_knowledge_base(
+    background_tasks: BackgroundTasks,
+    kb_id: str,
+    index_settings: Optional[IndexSettingsModel] = Body(None)
+):
+    """
+    在后台重建知识库向量集合，清理长期增删积累的索引碎片，可同时修改HNSW索引参数
+    
+    重建使用已存储的向量，不会重新调用嵌入接口
+    """
+    if not chroma_store_exists(kb_id):
+        raise HTTPException(status_code=404, detail="知识库不存在或尚未写入任何文档")
+    settings = index_settings.model_dump(exclude_none=True) if index_settings else None
+    try:
+        build_hnsw_configuration(settings)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    background_tasks.add_task(rebuild_vector_store, kb_id, settings)
+    return {
+        "code": 200,
+        "message": "向量集合重建任务已提交",
+        "data": {
+            "knowledge_base_id": kb_id,
+            "current_index_settings": get_chroma_index_settings(kb_id),
+            "index_settings": settings or {}
+        }
+    }
+
+# 批量导入接口：上传 zip/tar 压缩包，或指定 BULK_IMPORT_ROOT 下的服务器目录
+@app.post("/api/knowledge_base/import/{kb_id}")
+async def api_bulk_import(
+    background_tasks: BackgroundTasks,
+    kb_id: str,
+    file: Optional[UploadFile] = File(None),
+    directory: Optional[str] = Form(None)
+):
+    """批量导入文档到知识库，在后台用进程池解析并合并批次嵌入"""
+    if kb_id != "0" and not get_knowledge_base(kb_id):
+        raise HTTPException(status_code=404, detail="知识库不存在")
+    if file is not None:
+        original_name = file.filename or "archive"
+        if not is_archive(original_name):
+            raise HTTPException(status_code=400, detail="只支持 zip/tar 压缩包")
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        source = os.path.join(UPLOAD_DIR, f"import_{uuid.uuid4().hex}_{os.path.basename(original_name)}")
+        with open(source, "wb") as f:
+            while chunk := await file.read(16 * 1024 * 1024):
+                _ = f.write(chunk)
+        job = create_import_job(kb_id, original_name)
+        background_tasks.add_task(import_source, kb_id, source, job, True)
+    elif directory:
+        try:
+            source = resolve_import_directory(directory)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        job = create_import_job(kb_id, directory)
+        background_tasks.add_task(import_source, kb_id, source, job)
+    else:
+        raise HTTPException(status_code=400, detail="请上传压缩包或指定服务器目录")
+    logger.info(f"批量导入任务 {job.id} 已提交 - 知识库ID: {kb_id}, 来源: {job.source}")
+    return {
+        "code": 200,
+        "message": "批量导入任务已提交",
+        "data": job.to_dict()
+    }
+
+# 批量导入进度查询接口
+@app.get("/api/knowledge_base/import/status/{job_id}")
+async def api_bulk_import_status(job_id: str):
+    job = get_import_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="导入任务不存在")
+    return {
+        "code": 200,
+        "message": "查询成功",
+        "data": job.to_dict()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,259 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Optional, Tuple, Iterable, Callable, Set
+from .logger import logger_init
+
+logger = logger_init("bm25_index")
+
+# jieba 为可选依赖：安装后中文按词切分，否则使用字符二元组
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:
+    jieba = None
+
+# 关键词索引文件路径；查询词的文档频率超过该比例时视为常见词，不参与召回；每次查询最多使用的词数
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", "./dbs/bm25_index.db")
+BM25_COMMON_TERM_RATIO = float(os.getenv("BM25_COMMON_TERM_RATIO", 0.05))
+BM25_MAX_QUERY_TERMS = int(os.getenv("BM25_MAX_QUERY_TERMS", 8))
+
+# 英文单词、数字、标识符和错误码（如 E-1024、v2.3.1、HTTP_404）作为整体保留
+_LATIN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+_CJK_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+
+def tokenize(text: str) -> List[str]:
+    """
+    中英文混合分词
+
+    英文与标识符按整体切分并转小写；中文使用 jieba 搜索引擎模式分词，
+    未安装 jieba 时切分为字符二元组（单字片段保留单字）。
+    """
+    text = text.lower()
+    tokens = _LATIN_PATTERN.findall(text)
+    for run in _CJK_PATTERN.findall(text):
+        if jieba is not None:
+            tokens.extend(word for word in jieba.lcut_for_search(run) if word.strip())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class BM25Index:
+    """
+    基于 SQLite FTS5 的知识库 BM25 索引
+
+    文本先经 tokenize 分词，再以空格拼接写入 FTS5 表，由 FTS5 维护倒排表并计算 BM25 分数。
+    索引持久化在磁盘上、按文本块增量增删，百万级文本块也无需常驻内存。
+    查询时先通过 fts5vocab 读取各查询词的文档频率，丢弃过于常见的词并只保留最少见的
+    max_terms 个词，召回只需读取少量较短的倒排表。
+    """
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        kb_id: str,
+        common_ratio: float = BM25_COMMON_TERM_RATIO,
+        max_terms: int = BM25_MAX_QUERY_TERMS,
+    ):
+        self.kb_id = kb_id
+        self.common_ratio = common_ratio
+        self.max_terms = max_terms
+        self._conn = conn
+        # 每个知识库独立的连接和锁，不同知识库的检索和后台构建互不阻塞
+        self._lock = threading.RLock()
+        # 表名使用知识库ID的哈希，不同的ID（如 a-b 与 a_b）不会映射到同一组表，也避免注入
+        suffix = hashlib.sha256(kb_id.encode("utf-8")).hexdigest()[:32]
+        self._fts = f"bm25_fts_{suffix}"
+        self._ids = f"bm25_ids_{suffix}"
+        self._vocab = f"bm25_vocab_{suffix}"
+        with self._lock:
+            created = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self._ids,)
+            ).fetchone() is None
+            self._conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self._fts} USING fts5("
+                f"tokens, tokenize=\"unicode61 tokenchars '._-'\")"
+            )
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self._ids} (id INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE)")
+            self._conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self._vocab} USING fts5vocab({self._fts}, 'row')")
+            if created:
+                # 新建的表需要重新构建；旧版本按ID字符替换命名的表可能被多个知识库共用，直接删除
+                self._conn.execute("INSERT OR REPLACE INTO bm25_meta (kb_id, ready) VALUES (?, 0)", (kb_id,))
+                legacy_suffix = re.sub(r"[^0-9a-zA-Z]", "_", kb_id)
+                for table in (f"bm25_vocab_{legacy_suffix}", f"bm25_fts_{legacy_suffix}", f"bm25_ids_{legacy_suffix}"):
+                    self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.commit()
+            self._count = self._conn.execute(f"SELECT COUNT(*) FROM {self._ids}").fetchone()[0]
+
+    @property
+    def ready(self) -> bool:
+        """索引是否已完成初次构建"""
+        with self._lock:
+            row = self._conn.execute("SELECT ready FROM bm25_meta WHERE kb_id = ?", (self.kb_id,)).fetchone()
+        return bool(row and row[0])
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _delete(self, ids: List[str]) -> None:
+        """删除文本块（调用方需持有锁）"""
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self._conn.execute(f"SELECT id FROM {self._ids} WHERE chunk_id IN ({placeholders})", part).fetchall()
+            if rows:
+                self._conn.executemany(f"DELETE FROM {self._fts} WHERE rowid = ?", rows)
+                self._conn.executemany(f"DELETE FROM {self._ids} WHERE id = ?", rows)
+                self._count -= len(rows)
+
+    def add(self, ids: Iterable[str], texts: Iterable[str], replace: bool = True) -> None:
+        """
+        添加文本块
+
+        Args:
+            ids: 向量ID列表
+            texts: 文本内容列表
+            replace: 是否替换已存在的同ID文本块，为False时跳过已存在的文本块
+        """
+        pairs = list(zip(ids, texts))
+        if not pairs:
+            return
+        rows = [(chunk_id, " ".join(tokenize(text))) for chunk_id, text in pairs]
+        with self._lock:
+            if replace:
+                self._delete([chunk_id for chunk_id, _ in rows])
+            for chunk_id, tokens in rows:
+                cursor = self._conn.execute(f"INSERT OR IGNORE INTO {self._ids} (chunk_id) VALUES (?)", (chunk_id,))
+                if cursor.rowcount:
+                    self._conn.execute(f"INSERT INTO {self._fts} (rowid, tokens) VALUES (?, ?)", (cursor.lastrowid, tokens))
+                    self._count += 1
+            self._conn.commit()
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """删除文本块"""
+        ids = list(ids)
+        if not ids:
+            return
+        with self._lock:
+            self._delete(ids)
+            self._conn.commit()
+
+    def build(self, batches: Iterable[Tuple[List[str], List[str]]]) -> None:
+        """
+        从 (ids, texts) 批次构建索引
+
+        构建期间增量写入的文本块已在索引中，不会被覆盖。
+        """
+        for ids, texts in batches:
+            self.add(ids, texts, replace=False)
+        with self._lock:
+            self._conn.execute("UPDATE bm25_meta SET ready = 1 WHERE kb_id = ?", (self.kb_id,))
+            self._conn.commit()
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        检索与查询最相关的文本块
+
+        Returns:
+            按 BM25 分数降序排列的 (向量ID, 分数) 列表
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            placeholders = ",".join("?" * len(terms))
+            frequencies = dict(self._conn.execute(
+                f"SELECT term, doc FROM {self._vocab} WHERE term IN ({placeholders})", terms
+            ).fetchall())
+            if not frequencies:
+                return []
+            total = self._count
+            limit = max(1, int(total * self.common_ratio))
+            selected = sorted((term for term in frequencies if frequencies[term] <= limit), key=frequencies.get)
+            # 全部是常见词时只用其中最少见的词召回
+            selected = selected[:self.max_terms] or sorted(frequencies, key=frequencies.get)[:1]
+            expression = " OR ".join('"' + term.replace('"', '""') + '"' for term in selected)
+            # rank 列默认即 bm25()，ORDER BY rank LIMIT 由 FTS5 直接优化
+            ranked = self._conn.execute(
+                f"SELECT rowid, rank FROM {self._fts} WHERE {self._fts} MATCH ? ORDER BY rank LIMIT ?",
+                (expression, k)
+            ).fetchall()
+            if not ranked:
+                return []
+            placeholders = ",".join("?" * len(ranked))
+            chunk_ids = dict(self._conn.execute(
+                f"SELECT id, chunk_id FROM {self._ids} WHERE id IN ({placeholders})", [rowid for rowid, _ in ranked]
+            ).fetchall())
+        # FTS5 的 bm25() 返回负数，越小越相关
+        return [(chunk_ids[rowid], -rank) for rowid, rank in ranked if rowid in chunk_ids]
+
+    def drop(self) -> None:
+        """删除索引表"""
+        with self._lock:
+            self._conn.execute(f"DROP TABLE IF EXISTS {self._vocab}")
+            self._conn.execute(f"DROP TABLE IF EXISTS {self._fts}")
+            self._conn.execute(f"DROP TABLE IF EXISTS {self._ids}")
+            self._conn.execute("DELETE FROM bm25_meta WHERE kb_id = ?", (self.kb_id,))
+            self._conn.commit()
+
+# 所有知识库共用一个索引文件，每个知识库一组表和一个连接；WAL 模式下各连接可以并发读取
+_bm25_indexes: Dict[str, BM25Index] = {}
+_bm25_building: Set[str] = set()
+# 只保护索引注册表，不在持锁期间执行检索或写入
+_bm25_lock = threading.Lock()
+
+def _connect() -> sqlite3.Connection:
+    """为一个知识库打开索引文件的连接"""
+    os.makedirs(os.path.dirname(os.path.abspath(BM25_INDEX_PATH)), exist_ok=True)
+    # 多个连接同时写入时等待文件锁，而不是立即报错
+    conn = sqlite3.connect(BM25_INDEX_PATH, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS bm25_meta (kb_id TEXT PRIMARY KEY, ready INTEGER NOT NULL)")
+    conn.commit()
+    return conn
+
+def get_bm25_index(kb_id: str, loader: Optional[Callable[[], Iterable[Tuple[List[str], List[str]]]]] = None) -> BM25Index:
+    """
+    获取知识库的 BM25 索引
+
+    Args:
+        kb_id: 知识库ID
+        loader: 索引尚未构建时用于构建的函数，返回 (ids, texts) 批次的迭代器
+
+    Returns:
+        BM25 索引；后台构建完成前 ready 为 False
+    """
+    with _bm25_lock:
+        index = _bm25_indexes.get(kb_id)
+        if index is None:
+            index = BM25Index(_connect(), kb_id)
+            _bm25_indexes[kb_id] = index
+        if index.ready or loader is None or kb_id in _bm25_building:
+            return index
+        _bm25_building.add(kb_id)
+
+    def build():
+        try:
+            start = time.time()
+            index.build(loader())
+            logger.info(f"知识库 {kb_id} 的BM25索引构建完成，共 {len(index)} 个文本块，耗时 {time.time() - start:.2f} 秒")
+        except Exception as e:
+            logger.error(f"知识库 {kb_id} 的BM25索引构建失败: {str(e)}")
+        finally:
+            with _bm25_lock:
+                _bm25_building.discard(kb_id)
+
+    threading.Thread(target=build, daemon=True).start()
+    return index
+
+def drop_bm25_index(kb_id: str) -> None:
+    """删除知识库的索引"""
+    with _bm25_lock:
+        index = _bm25_indexes.pop(kb_id, None)
+    (index or BM25Index(_connect(), kb_id)).drop()
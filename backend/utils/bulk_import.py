@@ -0,0 +1,368 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import tarfile
+import zipfile
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import httpx
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+from .document_loader import parse_document, mark_worker_process
+from .database_knowledge import add_documents, find_document_by_name, get_knowledge_base, replace_document_file
+from .chroma_store import chroma_store_add_parsed_docs
+from .logger import logger_init
+
+logger = logger_init("bulk_import")
+
+# 批量导入配置：解析进程数（0表示CPU核数）、嵌入与写入的批大小、允许导入的服务器目录根路径
+BULK_IMPORT_WORKERS = int(os.getenv("BULK_IMPORT_WORKERS", 0)) or (os.cpu_count() or 1)
+BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", 512))
+BULK_IMPORT_ROOT = os.getenv("BULK_IMPORT_ROOT", "./imports")
+# 命令行导入时调用的服务地址
+BULK_IMPORT_SERVER = os.getenv("BULK_IMPORT_SERVER", "http://127.0.0.1:8000")
+
+# 可导入的文件类型，与 parse_document 支持的类型一致
+SUPPORTED_EXTENSIONS = {".md", ".markdown", ".txt", ".pdf", ".html", ".htm"}
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "uploads"))
+
+class ImportJob:
+    """批量导入任务的进度"""
+    def __init__(self, kb_id: str, source: str):
+        self.id = uuid.uuid4().hex
+        self.kb_id = kb_id
+        self.source = source
+        self.status = "pending"
+        self.total_files = 0
+        self.parsed_files = 0
+        self.chunks = 0
+        self.failed: Dict[str, str] = {}
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "knowledge_base_id": self.kb_id,
+            "source": self.source,
+            "status": self.status,
+            "total_files": self.total_files,
+            "parsed_files": self.parsed_files,
+            "chunks": self.chunks,
+            "failed": dict(self.failed),
+            "error": self.error,
+            "elapsed": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else 0.0,
+        }
+
+_import_jobs: Dict[str, ImportJob] = {}
+_import_jobs_lock = threading.Lock()
+
+def create_import_job(kb_id: str, source: str) -> ImportJob:
+    """登记批量导入任务"""
+    job = ImportJob(kb_id, source)
+    with _import_jobs_lock:
+        _import_jobs[job.id] = job
+    return job
+
+def get_import_job(job_id: str) -> Optional[ImportJob]:
+    """查询批量导入任务"""
+    return _import_jobs.get(job_id)
+
+def is_archive(path: str) -> bool:
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def resolve_import_directory(directory: str) -> str:
+    """
+    解析服务器目录路径，只允许 BULK_IMPORT_ROOT 下的目录
+
+    Raises:
+        ValueError: 目录不存在或不在允许的根路径下
+    """
+    root = os.path.realpath(BULK_IMPORT_ROOT)
+    path = os.path.realpath(os.path.join(root, directory))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"只能导入 {BULK_IMPORT_ROOT} 下的目录")
+    if not os.path.isdir(path):
+        raise ValueError(f"目录不存在: {directory}")
+    return path
+
+def extract_archive(archive_path: str, target_dir: str) -> None:
+    """
+    解压 zip/tar 压缩包，跳过链接、设备文件以及解压后位于目标目录之外的条目
+
+    Raises:
+        ValueError: 不支持的压缩包格式
+    """
+    root = os.path.realpath(target_dir)
+
+    def safe_target(name: str) -> Optional[str]:
+        target = os.path.realpath(os.path.join(root, name))
+        return target if os.path.commonpath([root, target]) == root and target != root else None
+
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                target = safe_target(info.filename)
+                if info.is_dir() or target is None:
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with archive.open(info) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as archive:
+            for member in archive:
+                target = safe_target(member.name)
+                if not member.isfile() or target is None:
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                src = archive.extractfile(member)
+                if src is None:
+                    continue
+                with src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+    else:
+        raise ValueError(f"不支持的压缩包格式: {os.path.basename(archive_path)}")
+
+def collect_files(directory: str) -> List[Tuple[str, str]]:
+    """
+    递归收集目录下可导入的文件，跳过隐藏文件和目录
+
+    Returns:
+        (相对路径, 绝对路径) 列表，按相对路径排序
+    """
+    files: List[Tuple[str, str]] = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames if not name.startswith((".", "__MACOSX"))]
+        for filename in filenames:
+            if filename.startswith(".") or os.path.splitext(filename)[1].lower() not in SUPPORTED_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, filename)
+            files.append((os.path.relpath(path, directory).replace(os.sep, "/"), path))
+    files.sort()
+    return files
+
+def _register_document(kb_id: str, name: str, path: str, upload_dir: str) -> Tuple[str, str]:
+    """
+    将解析成功的文件复制到上传目录并登记文档记录
+
+    同名文档沿用原文档ID替换文件（随后增量更新向量），新文档添加新的记录。
+
+    Returns:
+        (文档ID, 上传目录中的文件路径)
+
+    Raises:
+        ValueError: 知识库不存在或替换同名文档失败
+    """
+    saved_name = f"{uuid.uuid4().hex}{os.path.splitext(name)[1].lower()}"
+    saved_path = os.path.join(upload_dir, saved_name)
+    shutil.copyfile(path, saved_path)
+    size = os.path.getsize(saved_path)
+    try:
+        existing_doc_id = find_document_by_name(kb_id, name)
+        if existing_doc_id:
+            if not replace_document_file(
+                doc_id=existing_doc_id,
+                saved_name=saved_name,
+                path=f"/api/uploads/{saved_name}",
+                size=size
+            ):
+                raise ValueError(f"替换同名文档失败: {name}")
+            return existing_doc_id, saved_path
+        doc_id = uuid.uuid4().hex
+        if not add_documents(kb_id, [{
+            "id": doc_id,
+            "name": name[:255],
+            "saved_name": saved_name,
+            "path": f"/api/uploads/{saved_name}",
+            "size": size,
+        }]):
+            raise ValueError(f"知识库不存在: {kb_id}")
+        return doc_id, saved_path
+    except Exception:
+        os.remove(saved_path)
+        raise
+
+def _parse_in_pool(
+    kb_id: str, files: List[Tuple[str, str]], upload_dir: str, workers: int, job: ImportJob
+) -> Iterator[Tuple[str, str, List[str], List[Dict[str, Any]]]]:
+    """
+    在进程池中并行解析文件，按完成顺序登记文档并产出解析结果
+
+    在途任务数限制为进程数的两倍，解析快于嵌入时不会在内存中堆积全部结果。
+    使用 spawn 方式启动子进程，不继承父进程中的线程和数据库连接。
+    只有解析成功的文件才复制到上传目录并登记或替换文档记录，解析失败的文件记录到 job.failed，
+    不会留下没有文本块的文档，也不会替换掉同名文档原有的文件和向量。
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=mark_worker_process) as pool:
+        pending: Dict[Future, Tuple[str, str]] = {}
+        queue = list(reversed(files))
+        while queue or pending:
+            while queue and len(pending) < workers * 2:
+                name, path = queue.pop()
+                pending[pool.submit(parse_document, path)] = (name, path)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, path = pending.pop(future)
+                job.parsed_files += 1
+                try:
+                    texts, metadatas = future.result()
+                    doc_id, saved_path = _register_document(kb_id, name, path, upload_dir)
+                except Exception as e:
+                    job.failed[name] = str(e)
+                    logger.error(f"导入文件失败 {name} ({path}): {str(e)}")
+                    continue
+                # 文本块来源指向上传目录中的文件，与单个上传的文档一致
+                for metadata in metadatas:
+                    metadata["source"] = saved_path
+                job.chunks += len(texts)
+                yield doc_id, saved_path, texts, metadatas
+
+def import_files(
+    kb_id: str,
+    files: List[Tuple[str, str]],
+    job: Optional[ImportJob] = None,
+    workers: int = BULK_IMPORT_WORKERS,
+    batch_size: int = BULK_IMPORT_BATCH_SIZE,
+    upload_dir: str = UPLOAD_DIR,
+) -> ImportJob:
+    """
+    批量导入文件到知识库
+
+    文件复制到上传目录并批量登记文档记录后，由进程池并行解析；解析结果中的文本块
+    跨文档合并为共享批次嵌入和写入向量库，吞吐量随CPU核数增长。
+    批量导入不生成PDF的Markdown和批注文件。
+
+    Args:
+        kb_id: 知识库ID
+        files: (文档名, 文件路径) 列表，文档名通常为文件在目录或压缩包中的相对路径
+        job: 进度记录，不提供时新建
+        workers: 解析进程数
+        batch_size: 嵌入和写入的批大小
+        upload_dir: 上传目录
+
+    Returns:
+        导入任务的进度记录
+    """
+    job = job or create_import_job(kb_id, "files")
+    job.status = "running"
+    job.started_at = time.time()
+    job.total_files = len(files)
+    try:
+        if kb_id != "0" and not get_knowledge_base(kb_id):
+            raise ValueError(f"知识库不存在: {kb_id}")
+        documents = _parse_in_pool(kb_id, files, upload_dir, max(1, workers), job)
+        chroma_store_add_parsed_docs(kb_id, documents, batch_size=batch_size)
+        job.status = "completed"
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        logger.error(f"批量导入到知识库 {kb_id} 失败: {str(e)}", exc_info=True)
+    finally:
+        job.finished_at = time.time()
+    logger.info(
+        f"批量导入到知识库 {kb_id} 结束: {job.status}, 文件 {job.parsed_files}/{job.total_files}, "
+        f"文本块 {job.chunks}, 失败 {len(job.failed)}, 耗时 {job.finished_at - job.started_at:.2f} 秒"
+    )
+    return job
+
+def import_source(kb_id: str, source: str, job: Optional[ImportJob] = None, remove_source: bool = False, **kwargs) -> ImportJob:
+    """
+    从压缩包或目录批量导入
+
+    Args:
+        kb_id: 知识库ID
+        source: zip/tar 压缩包或目录路径
+        job: 进度记录，不提供时新建
+        remove_source: 导入后删除压缩包（用于上传的临时文件）
+        **kwargs: 传递给 import_files 的参数
+
+    Returns:
+        导入任务的进度记录
+    """
+    job = job or create_import_job(kb_id, os.path.basename(source))
+    temp_dir = None
+    try:
+        if os.path.isdir(source):
+            directory = source
+        else:
+            temp_dir = tempfile.mkdtemp(prefix="bulk_import_")
+            extract_archive(source, temp_dir)
+            directory = temp_dir
+        return import_files(kb_id, collect_files(directory), job=job, **kwargs)
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        logger.error(f"批量导入到知识库 {kb_id} 失败: {str(e)}")
+        return job
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if remove_source and os.path.isfile(source):
+            os.remove(source)
+
+def _pack_directory(directory: str, target_dir: str) -> str:
+    """将目录中可导入的文件打包为 tar，文件在包内的路径与目录中的相对路径一致"""
+    archive_path = os.path.join(target_dir, f"{os.path.basename(os.path.abspath(directory)) or 'import'}.tar")
+    with tarfile.open(archive_path, "w") as archive:
+        for name, path in collect_files(directory):
+            archive.add(path, arcname=name)
+    return archive_path
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    命令行入口：通过运行中服务的批量导入接口导入压缩包或目录
+
+    服务进程持有复用的Chroma客户端、关键词索引连接和检索缓存，另起进程直接写入同一个
+    持久化目录和数据库不会被服务感知，Chroma 也不支持多个进程同时打开同一个持久化目录，
+    因此命令行只负责上传和查询进度，实际导入由服务完成。目录先打包为 tar 再上传。
+    """
+    parser = argparse.ArgumentParser(description="通过服务的批量导入接口导入压缩包或目录中的文档到知识库")
+    parser.add_argument("kb_id", help="知识库ID")
+    parser.add_argument("source", help="zip/tar 压缩包或目录路径")
+    parser.add_argument("--server", default=BULK_IMPORT_SERVER, help="服务地址")
+    parser.add_argument("--interval", type=float, default=2.0, help="查询进度的间隔秒数")
+    args = parser.parse_args(argv)
+
+    server = args.server.rstrip("/")
+    temp_dir = None
+    try:
+        archive_path = args.source
+        if os.path.isdir(args.source):
+            temp_dir = tempfile.mkdtemp(prefix="bulk_import_")
+            archive_path = _pack_directory(args.source, temp_dir)
+        elif not is_archive(args.source):
+            print(f"不支持的压缩包格式: {os.path.basename(args.source)}", file=sys.stderr)
+            return 1
+        with httpx.Client(timeout=None) as client:
+            with open(archive_path, "rb") as f:
+                response = client.post(
+                    f"{server}/api/knowledge_base/import/{args.kb_id}",
+                    files={"file": (os.path.basename(archive_path), f)}
+                )
+            response.raise_for_status()
+            job = response.json()["data"]
+            while job["status"] in ("pending", "running"):
+                time.sleep(args.interval)
+                response = client.get(f"{server}/api/knowledge_base/import/status/{job['job_id']}")
+                response.raise_for_status()
+                job = response.json()["data"]
+    except httpx.HTTPError as e:
+        print(f"调用批量导入接口失败: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    print(job)
+    return 0 if job["status"] == "completed" else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
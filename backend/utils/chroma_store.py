@@ -1,10 +1,35 @@
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+import asyncio
+import chromadb
 from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
 from .embeding import EmbeddingGenerator, get_embedding_generator
+from .embedding_cache import text_hash
+from .bm25_index import BM25Index, get_bm25_index, drop_bm25_index
+from .hybrid_retriever import HybridRetriever
+from .flat_vector_store import FlatCollection, FlatVectorStore
+from .retrieval_cache import CachedRetriever, RETRIEVAL_CACHE_ENABLED
+from .database_knowledge import (
+    save_document_chunks,
+    save_documents_chunks,
+    list_document_chunk_ids,
+    list_document_ids,
+    delete_orphan_document_chunks,
+    get_kb_generation,
+    bump_kb_generation,
+)
 from .logger import logger_init
 import os
+import json
+import time
+import queue
+import shutil
+import hashlib
+import threading
 from datetime import datetime
 from typing_extensions import Protocol
 
@@ -13,6 +38,23 @@ logger = logger_init("chroma_store")
 # 从环境变量或配置文件中读取配置
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "embedding-2")
 CHROMA_STORE_PATHDIRECTORY = os.getenv("CHROMA_STORE_PATHDIRECTORY", "./chroma_langchain_db")
+# 向量存储后端：chroma 或 flat（内存映射的向量矩阵，适合中小规模知识库），以及 flat 后端的存储目录
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "chroma").lower()
+FLAT_STORE_PATHDIRECTORY = os.getenv("FLAT_STORE_PATHDIRECTORY", "./flat_vector_db")
+# 集合句柄空闲超过该时间(秒)后从注册表中移除
+CHROMA_STORE_IDLE_SECONDS = float(os.getenv("CHROMA_STORE_IDLE_SECONDS", 1800))
+# 流式入库配置：每批文本块数量、各阶段之间队列可积压的批次数
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 128))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 2))
+# 检索配置：返回数量、向量相似度阈值，以及是否启用 BM25 混合检索
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 10))
+RETRIEVAL_SCORE_THRESHOLD = float(os.getenv("RETRIEVAL_SCORE_THRESHOLD", 0.5))
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() in ("1", "true", "yes")
+# MMR 多样性筛选：候选数量、相关性权重，以及判定为重复文本块的相似度阈值
+RETRIEVAL_MMR_ENABLED = os.getenv("RETRIEVAL_MMR_ENABLED", "true").lower() in ("1", "true", "yes")
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", RETRIEVAL_TOP_K * 2))
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", 0.7))
+RETRIEVAL_DEDUP_THRESHOLD = float(os.getenv("RETRIEVAL_DEDUP_THRESHOLD", 0.9))
 
 # 创建嵌入生成器实例
 embedding_generator = get_embedding_generator(model_name=EMBEDDING_MODEL_NAME)
@@ -20,91 +62,765 @@ if not hasattr(embedding_generator, 'embed_documents') or not hasattr(embedding_
     logger.warning("Embedding generator does not implement required methods")
     embedding_generator = None
 
-def get_chroma_store(kb_id: str = "0") -> Chroma:
+# 进程级的客户端与集合句柄注册表，避免每次请求重新打开持久化客户端和集合
+_chroma_client: Optional[chromadb.ClientAPI] = None
+_chroma_stores: Dict[str, Tuple[VectorStore, float]] = {}
+_chroma_lock = threading.RLock()
+# 知识库写入锁：重建集合期间阻塞对该知识库的写入和删除，避免数据写入即将被替换的旧集合
+_kb_write_locks: Dict[str, threading.RLock] = {}
+_kb_write_locks_lock = threading.Lock()
+
+def get_chroma_client() -> chromadb.ClientAPI:
+    """获取进程内共享的Chroma持久化客户端"""
+    global _chroma_client
+    with _chroma_lock:
+        if _chroma_client is None:
+            _chroma_client = chromadb.PersistentClient(path=CHROMA_STORE_PATHDIRECTORY)
+            logger.info(f"已打开Chroma持久化客户端: {CHROMA_STORE_PATHDIRECTORY}")
+        return _chroma_client
+
+def _max_batch_size() -> int:
+    """单次写入或删除向量的最大数量"""
+    if VECTOR_STORE_BACKEND == "flat":
+        return 5000
+    return get_chroma_client().get_max_batch_size()
+
+def _flat_store_path(kb_id: str) -> str:
+    return os.path.join(FLAT_STORE_PATHDIRECTORY, f"flat_{kb_id}")
+
+def _evict_idle_chroma_stores(now: float) -> None:
+    """移除空闲超时的集合句柄（调用方需持有锁）"""
+    idle = [kb_id for kb_id, (_, last_used) in _chroma_stores.items() if now - last_used > CHROMA_STORE_IDLE_SECONDS]
+    for kb_id in idle:
+        del _chroma_stores[kb_id]
+    if idle:
+        logger.info(f"移除空闲的知识库集合句柄: {idle}")
+
+def _kb_write_lock(kb_id: str) -> threading.RLock:
+    """获取知识库的写入锁"""
+    with _kb_write_locks_lock:
+        lock = _kb_write_locks.get(kb_id)
+        if lock is None:
+            lock = _kb_write_locks[kb_id] = threading.RLock()
+        return lock
+
+# 索引参数名到Chroma集合HNSW配置项的映射
+HNSW_SETTING_KEYS = {
+    "space": "space",
+    "M": "max_neighbors",
+    "construction_ef": "ef_construction",
+    "search_ef": "ef_search",
+}
+_HNSW_SPACES = {"l2", "cosine", "ip"}
+
+def build_hnsw_configuration(index_settings: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    将知识库索引参数转换为Chroma集合的HNSW配置
+    
+    Args:
+        index_settings: 索引参数，可包含 space(l2/cosine/ip)、M、construction_ef、search_ef
+        
+    Returns:
+        Chroma集合配置，没有参数时返回 None
+        
+    Raises:
+        ValueError: 参数名或取值无效
+    """
+    if not index_settings:
+        return None
+    hnsw: Dict[str, Any] = {}
+    for name, value in index_settings.items():
+        if value is None:
+            continue
+        if name not in HNSW_SETTING_KEYS:
+            raise ValueError(f"不支持的索引参数: {name}，可用参数: {sorted(HNSW_SETTING_KEYS)}")
+        if name == "space":
+            if value not in _HNSW_SPACES:
+                raise ValueError(f"不支持的距离度量: {value}，可用度量: {sorted(_HNSW_SPACES)}")
+        elif not isinstance(value, int) or value < 2:
+            raise ValueError(f"索引参数 {name} 必须是不小于2的整数")
+        hnsw[HNSW_SETTING_KEYS[name]] = value
+    return {"hnsw": hnsw} if hnsw else None
+
+def chroma_store_exists(kb_id: str) -> bool:
+    """知识库的向量集合是否已创建"""
+    if VECTOR_STORE_BACKEND == "flat":
+        return os.path.exists(os.path.join(_flat_store_path(kb_id), "store.db"))
+    try:
+        get_chroma_client().get_collection(f"chroma_{kb_id}")
+        return True
+    except Exception:
+        return False
+
+def get_chroma_index_settings(kb_id: str) -> Dict[str, Any]:
+    """读取知识库集合当前的HNSW索引参数"""
+    hnsw = get_chroma_store(kb_id)._collection.configuration.get("hnsw") or {}
+    return {name: hnsw.get(key) for name, key in HNSW_SETTING_KEYS.items()}
+
+def create_chroma_store(kb_id: str, index_settings: Optional[Dict[str, Any]] = None) -> VectorStore:
     """
-    获取或创建Chroma向量存储
+    按指定的HNSW索引参数创建知识库的向量集合
+    
+    集合已存在时保留其原有参数。HNSW的距离度量、M和construction_ef在集合创建后无法修改，
+    需要通过 chroma_store_rebuild 重建集合。flat 后端只使用距离度量，其余参数忽略。
+    """
+    configuration = build_hnsw_configuration(index_settings)
+    with _chroma_lock:
+        if configuration and VECTOR_STORE_BACKEND == "flat":
+            space = configuration["hnsw"].get("space")
+            if space and not chroma_store_exists(kb_id):
+                FlatCollection(_flat_store_path(kb_id), space=space).close()
+                logger.info(f"已按距离度量 {space} 创建知识库 {kb_id} 的向量集合")
+        elif configuration:
+            get_chroma_client().get_or_create_collection(f"chroma_{kb_id}", configuration=configuration)
+            logger.info(f"已按索引参数 {index_settings} 创建知识库 {kb_id} 的向量集合")
+        return get_chroma_store(kb_id)
+
+def get_chroma_store(kb_id: str = "0") -> VectorStore:
+    """
+    获取或创建知识库的向量存储，同一知识库在进程内复用同一个句柄
+    
+    VECTOR_STORE_BACKEND 为 flat 时返回 FlatVectorStore，其接口与 Chroma 一致。
     
     Args:
         kb_id: 知识库ID，默认为"0"(系统知识库)
         
     Returns:
-        Chroma向量存储实例
+        向量存储实例
+    """
+    now = time.monotonic()
+    with _chroma_lock:
+        entry = _chroma_stores.get(kb_id)
+        if entry is not None:
+            _chroma_stores[kb_id] = (entry[0], now)
+            return entry[0]
+
+        _evict_idle_chroma_stores(now)
+        # 确保嵌入生成器实现了Embeddings接口
+        embedding_func = embedding_generator if isinstance(embedding_generator, Embeddings) else None
+        if VECTOR_STORE_BACKEND == "flat":
+            store = FlatVectorStore(FlatCollection(_flat_store_path(kb_id)), embedding_func)
+            _chroma_stores[kb_id] = (store, now)
+            return store
+        store = Chroma(
+            client=get_chroma_client(),
+            collection_name=f"chroma_{kb_id}",
+            embedding_function=embedding_func,
+            create_collection_if_not_exists=True,
+        )
+        _chroma_stores[kb_id] = (store, now)
+        return store
+
+def invalidate_chroma_store(kb_id: str) -> None:
+    """从注册表中移除知识库的集合句柄，下次访问时重新打开"""
+    with _chroma_lock:
+        _chroma_stores.pop(kb_id, None)
+
+def delete_chroma_store(kb_id: str) -> None:
+    """删除知识库对应的向量集合并使句柄失效"""
+    with _chroma_lock:
+        invalidate_chroma_store(kb_id)
+        drop_bm25_index(kb_id)
+        bump_kb_generation(kb_id)
+        if VECTOR_STORE_BACKEND == "flat":
+            shutil.rmtree(_flat_store_path(kb_id), ignore_errors=True)
+            logger.info(f"已删除知识库 {kb_id} 的向量集合")
+            return
+        try:
+            get_chroma_client().delete_collection(f"chroma_{kb_id}")
+            logger.info(f"已删除知识库 {kb_id} 的向量集合")
+        except Exception as e:
+            # 集合可能从未创建过
+            logger.warning(f"删除知识库 {kb_id} 的向量集合失败: {str(e)}")
+
+def make_chunk_ids(kb_id: str, doc_key: str, texts: List[str], occurrences: Optional[Dict[str, int]] = None) -> List[str]:
     """
-    # 确保嵌入生成器实现了Embeddings接口
-    embedding_func = embedding_generator if isinstance(embedding_generator, Embeddings) else None
+    生成确定性的向量ID：由 (知识库ID, 文档标识, 文本块内容哈希) 计算
     
-    return Chroma(
-        collection_name=f"chroma_{kb_id}",
-        embedding_function=embedding_func,
-        create_collection_if_not_exists=True,
-        persist_directory=CHROMA_STORE_PATHDIRECTORY,
-    )
+    同一文档内内容相同的文本块按出现次序区分，保证ID唯一。分批调用时传入同一个
+    occurrences 字典，以便跨批次累计出现次数。
+    """
+    if occurrences is None:
+        occurrences = {}
+    ids: List[str] = []
+    for text in texts:
+        content_hash = text_hash(text)
+        occurrence = occurrences.get(content_hash, 0)
+        occurrences[content_hash] = occurrence + 1
+        ids.append(hashlib.sha256(f"{kb_id}\x00{doc_key}\x00{content_hash}\x00{occurrence}".encode("utf-8")).hexdigest())
+    return ids
+
+# 流水线结束标记
+_PIPELINE_DONE = object()
+
+def _pipeline_put(q: "queue.Queue", item: Any, stop: threading.Event) -> bool:
+    """向有界队列放入数据，下游已停止时放弃并返回False"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _pipeline_stage(target, stop: threading.Event, errors: List[BaseException], output: "queue.Queue") -> threading.Thread:
+    """启动流水线阶段线程：出错时记录异常、通知其他阶段停止，并总是向下游发送结束标记"""
+    def run():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            while True:
+                try:
+                    output.put(_PIPELINE_DONE, timeout=0.5)
+                    break
+                except queue.Full:
+                    # 下游已停止消费时丢弃积压数据，保证结束标记能送达
+                    if stop.is_set():
+                        try:
+                            output.get_nowait()
+                        except queue.Empty:
+                            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def _base_metadata(kb_id: str, path: str, doc_id: Optional[str]) -> Dict[str, Any]:
+    """文档所有文本块共有的元数据"""
+    metadata = {
+        'source': os.path.basename(path),
+        'kb_id': kb_id,
+        'timestamp': datetime.now().isoformat(),
+        'file_path': path
+    }
+    if doc_id:
+        metadata['doc_id'] = doc_id
+    return metadata
+
+def _run_ingest_pipeline(kb_id: str, produce_batches, existing_ids: set) -> Tuple[List[str], int]:
+    """
+    执行 解析/分割 -> 嵌入 -> 写入 流水线
+
+    三个阶段通过有界队列连接，每批文本块在后续内容仍在解析时即完成嵌入和写入。
+    已存在的向量ID只刷新元数据、不重新嵌入。
+
+    Args:
+        kb_id: 知识库ID
+        produce_batches: 生成器函数，接收停止事件，产出 (ids, texts, metadatas) 批次
+        existing_ids: 已写入向量库的向量ID
+
+    Returns:
+        (全部向量ID, 新增或修改的数量)
+
+    Raises:
+        RuntimeError: 嵌入生成器未能初始化
+    """
+    if embedding_generator is None:
+        # 在启动阶段线程前检查，避免嵌入阶段线程中才因属性错误失败
+        raise RuntimeError(f"嵌入生成器未初始化，请检查嵌入模型配置 (EMBEDDING_MODEL_NAME={EMBEDDING_MODEL_NAME})")
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    parsed: "queue.Queue" = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+    embedded: "queue.Queue" = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+
+    def parse_stage():
+        for batch in produce_batches(stop):
+            if not _pipeline_put(parsed, batch, stop):
+                return
+
+    def embed_stage():
+        while True:
+            item = parsed.get()
+            if item is _PIPELINE_DONE or stop.is_set():
+                return
+            ids, texts, metadatas = item
+            new_positions = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing_ids]
+            embeddings = embedding_generator.embed_documents([texts[i] for i in new_positions]) if new_positions else []
+            if not _pipeline_put(embedded, (ids, texts, metadatas, new_positions, embeddings), stop):
+                return
+
+    stages = [
+        _pipeline_stage(parse_stage, stop, errors, parsed),
+        _pipeline_stage(embed_stage, stop, errors, embedded),
+    ]
+
+    # 写入阶段在当前线程执行
+    all_ids: List[str] = []
+    new_count = 0
+    try:
+        while True:
+            item = embedded.get()
+            if item is _PIPELINE_DONE:
+                break
+            ids, texts, metadatas, new_positions, embeddings = item
+            unchanged_positions = [i for i in range(len(ids)) if ids[i] in existing_ids]
+            with _kb_write_lock(kb_id):
+                # 重建集合后句柄会变化，每批写入时重新获取
+                chroma_store = get_chroma_store(kb_id)
+                # 未变化的文本块只刷新元数据（块序号、页码等可能变化），不调用嵌入接口
+                if unchanged_positions:
+                    chroma_store._collection.update(
+                        ids=[ids[i] for i in unchanged_positions],
+                        metadatas=[metadatas[i] for i in unchanged_positions]
+                    )
+                if new_positions:
+                    chroma_store._collection.upsert(
+                        ids=[ids[i] for i in new_positions],
+                        embeddings=embeddings,
+                        metadatas=[metadatas[i] for i in new_positions],
+                        documents=[texts[i] for i in new_positions]
+                    )
+                    get_bm25_index(kb_id).add([ids[i] for i in new_positions], [texts[i] for i in new_positions])
+                # 每批写入后即可被检索到，随之使缓存的检索结果失效
+                bump_kb_generation(kb_id)
+            all_ids.extend(ids)
+            new_count += len(new_positions)
+    except Exception as e:
+        stop.set()
+        errors.append(e)
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+
+    if errors:
+        logger.error(f"存储文档到ChromaDB失败: {str(errors[0])}")
+        raise errors[0]
+    if embedding_generator.cache is not None:
+        logger.info(f"嵌入缓存统计: {embedding_generator.cache.stats()}")
+    return all_ids, new_count
 
-def chroma_store_add_docs(kb_id: str, path: str) -> List[str]:
+def chroma_store_add_docs(kb_id: str, path: str, doc_id: Optional[str] = None, incremental: bool = True) -> List[str]:
     """
     添加文档到ChromaDB向量存储，保留完整元数据
     
+    以流水线方式处理：解析/分割 -> 嵌入 -> 写入 三个阶段通过有界队列连接，
+    每批文本块在后续页面仍在解析时即完成嵌入和写入，内存占用与批大小相关，
+    大文档的前几批文本块可以尽早被检索到。
+    
+    向量ID由文本块内容确定，重复添加同一文档不会产生重复向量。
+    增量模式下与文档已记录的向量ID比对：未变化的文本块只更新元数据、不重新嵌入，
+    新增或修改的文本块嵌入后写入，已不存在的文本块对应的向量被删除。
+    只有文档完整解析后才删除旧向量并替换向量ID记录，解析失败时异常抛给调用方，原有向量保持不变。
+    
     Args:
         kb_id: 知识库ID
         path: 文件路径
+        doc_id: 知识库文档ID，提供时记录该文档的向量ID，用于删除和重建
+        incremental: 是否按已记录的向量ID增量更新
         
     Returns:
         存储的文档ID列表
+
+    Raises:
+        Exception: 文档解析、嵌入或写入失败
+    """
+    from .document_loader import iter_document
+
+    base_metadata = _base_metadata(kb_id, path, doc_id)
+    # 文档标识：知识库文档ID，未提供时使用文件路径的哈希
+    doc_key = doc_id or text_hash(os.path.abspath(path))
+    existing_ids = set(list_document_chunk_ids(doc_id)) if doc_id and incremental else set()
+    batch_size = min(INGEST_BATCH_SIZE, _max_batch_size())
+    # 解析阶段读完整个文档后置位，未置位时不能据此删除旧向量
+    parse_completed = threading.Event()
+
+    def produce_batches(stop: threading.Event):
+        occurrences: Dict[str, int] = {}
+        texts: List[str] = []
+        metadatas: List[Dict[str, Any]] = []
+        for text, md in iter_document(path):
+            if stop.is_set():
+                return
+            # 合并元数据 (确保类型安全)
+            if not isinstance(md, dict):
+                md = {}
+            texts.append(text)
+            metadatas.append({**base_metadata, **md})
+            if len(texts) >= batch_size:
+                yield make_chunk_ids(kb_id, doc_key, texts, occurrences), texts, metadatas
+                texts, metadatas = [], []
+        if texts:
+            yield make_chunk_ids(kb_id, doc_key, texts, occurrences), texts, metadatas
+        parse_completed.set()
+
+    all_ids, new_count = _run_ingest_pipeline(kb_id, produce_batches, existing_ids)
+    if not parse_completed.is_set():
+        raise RuntimeError(f"文档未完整解析，保留原有向量: {path}")
+
+    removed_ids = list(existing_ids - set(all_ids))
+    if removed_ids:
+        _delete_vectors(get_chroma_store(kb_id), removed_ids, kb_id)
+    logger.info(
+        f"成功存储 {len(all_ids)} 个文档到知识库 {kb_id}: 新增/修改 {new_count}, "
+        f"未变化 {len(all_ids) - new_count}, 删除 {len(removed_ids)}"
+    )
+    if doc_id:
+        save_document_chunks(doc_id, kb_id, all_ids, replace=True)
+    return all_ids
+
+def chroma_store_add_parsed_docs(
+    kb_id: str,
+    documents: Iterable[Tuple[str, str, List[str], List[Dict[str, Any]]]],
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> Dict[str, List[str]]:
+    """
+    批量写入已解析的多个文档
+
+    不同文档的文本块合并为共享的大批次嵌入和写入，避免每个小文件单独调用一次嵌入接口和写入；
+    文档可以由进程池并行解析，边解析边嵌入。写入完成后在一个事务中记录所有文档的向量ID。
+    已记录向量ID的文档（重新导入的同名文档）按增量方式更新。
+
+    Args:
+        kb_id: 知识库ID
+        documents: (文档ID, 文件路径, 文本列表, 元数据列表) 的迭代器
+        batch_size: 嵌入和写入的批大小
+
+    Returns:
+        文档ID -> 向量ID列表
+    """
+    batch_size = min(batch_size, _max_batch_size())
+    doc_chunk_ids: Dict[str, List[str]] = {}
+    existing_ids: set = set()
+
+    def produce_batches(stop: threading.Event):
+        ids: List[str] = []
+        texts: List[str] = []
+        metadatas: List[Dict[str, Any]] = []
+        for doc_id, path, doc_texts, doc_metadatas in documents:
+            if stop.is_set():
+                return
+            existing_ids.update(list_document_chunk_ids(doc_id))
+            base_metadata = _base_metadata(kb_id, path, doc_id)
+            chunk_ids = make_chunk_ids(kb_id, doc_id, doc_texts)
+            doc_chunk_ids[doc_id] = chunk_ids
+            for chunk_id, text, md in zip(chunk_ids, doc_texts, doc_metadatas):
+                ids.append(chunk_id)
+                texts.append(text)
+                metadatas.append({**base_metadata, **(md if isinstance(md, dict) else {})})
+                if len(ids) >= batch_size:
+                    yield ids, texts, metadatas
+                    ids, texts, metadatas = [], [], []
+        if ids:
+            yield ids, texts, metadatas
+
+    all_ids, new_count = _run_ingest_pipeline(kb_id, produce_batches, existing_ids)
+
+    removed_ids = list(existing_ids - set(all_ids))
+    if removed_ids:
+        _delete_vectors(get_chroma_store(kb_id), removed_ids, kb_id)
+    save_documents_chunks(kb_id, doc_chunk_ids)
+    logger.info(
+        f"批量存储 {len(doc_chunk_ids)} 个文档共 {len(all_ids)} 个文本块到知识库 {kb_id}: "
+        f"新增/修改 {new_count}, 删除 {len(removed_ids)}"
+    )
+    return doc_chunk_ids
+
+def _delete_vectors(chroma_store: VectorStore, ids: List[str], kb_id: Optional[str] = None) -> None:
+    """按客户端允许的最大批量删除向量，通常一次调用即可完成，并同步删除关键词索引中的条目"""
+    batch_size = _max_batch_size()
+    if kb_id is None:
+        for i in range(0, len(ids), batch_size):
+            chroma_store.delete(ids=ids[i:i + batch_size])
+        return
+    with _kb_write_lock(kb_id):
+        # 等待集合重建完成后在新集合上删除
+        chroma_store = get_chroma_store(kb_id)
+        for i in range(0, len(ids), batch_size):
+            chroma_store.delete(ids=ids[i:i + batch_size])
+        get_bm25_index(kb_id).remove(ids)
+        bump_kb_generation(kb_id)
+
+def chroma_store_delete_docs(kb_id: str, doc_id: str, file_path: Optional[str] = None) -> int:
+    """
+    删除文档在向量库中的全部向量
+    
+    Args:
+        kb_id: 知识库ID
+        doc_id: 知识库文档ID
+        file_path: 文档文件路径，用于删除未记录向量ID的旧数据
+        
+    Returns:
+        删除的向量数量
     """
     chroma_store = get_chroma_store(kb_id)
-    from .document_loader import load_document
-    from datetime import datetime
-    import os
+    chunk_ids = list_document_chunk_ids(doc_id)
+    if chunk_ids:
+        _delete_vectors(chroma_store, chunk_ids, kb_id)
+        # 同时清除向量ID记录，之后重新添加该文档时不会被误判为未变化
+        save_document_chunks(doc_id, kb_id, [], replace=True)
+        logger.info(f"从知识库 {kb_id} 删除文档 {doc_id} 的 {len(chunk_ids)} 个向量")
+        return len(chunk_ids)
+
+    # 旧版本写入的向量没有记录ID，按元数据匹配删除
+    if file_path:
+        legacy_ids = chroma_store.get(where={"file_path": file_path}, include=[]).get("ids") or []
+        if legacy_ids:
+            _delete_vectors(chroma_store, legacy_ids, kb_id)
+        logger.info(f"按文件路径从知识库 {kb_id} 删除文档 {doc_id} 的 {len(legacy_ids)} 个向量: {file_path}")
+        return len(legacy_ids)
+    return 0
+
+def chroma_store_reindex_doc(kb_id: str, doc_id: str, path: str) -> List[str]:
+    """重建文档向量：只重新嵌入发生变化的文本块"""
+    if not list_document_chunk_ids(doc_id):
+        # 旧版本写入的向量没有记录ID，先按文件路径整体删除
+        chroma_store_delete_docs(kb_id, doc_id, path)
+    return chroma_store_add_docs(kb_id, path, doc_id=doc_id)
+
+def chroma_store_gc(kb_id: str, page_size: int = 5000) -> int:
+    """
+    清理知识库向量集合中所属文档已被删除的孤立向量
     
-    # 获取文本和元数据
-    texts, metadatas = load_document(path)
+    向量的 doc_id 元数据不属于现存文档时视为孤立；没有 doc_id 的旧数据按文件名判断。
     
-    # 添加基础元数据
-    base_metadata = {
-        'source': os.path.basename(path),
-        'kb_id': kb_id,
-        'timestamp': datetime.now().isoformat(),
-        'file_path': path
-    }
+    Args:
+        kb_id: 知识库ID
+        page_size: 分页扫描集合时每页的数量
+        
+    Returns:
+        删除的孤立向量数量
+    """
+    live_docs = list_document_ids(kb_id)
+    live_doc_ids = {doc_id for doc_id, _ in live_docs}
+    live_saved_names = {saved_name for _, saved_name in live_docs}
+
+    chroma_store = get_chroma_store(kb_id)
+    orphan_ids: List[str] = []
+    offset = 0
+    while True:
+        page = chroma_store.get(include=["metadatas"], limit=page_size, offset=offset)
+        ids = page.get("ids") or []
+        for vector_id, metadata in zip(ids, page.get("metadatas") or []):
+            metadata = metadata or {}
+            if "doc_id" in metadata:
+                if metadata["doc_id"] not in live_doc_ids:
+                    orphan_ids.append(vector_id)
+            elif os.path.basename(str(metadata.get("file_path", ""))) not in live_saved_names:
+                orphan_ids.append(vector_id)
+        if len(ids) < page_size:
+            break
+        offset += page_size
+
+    if orphan_ids:
+        _delete_vectors(chroma_store, orphan_ids, kb_id)
+    delete_orphan_document_chunks(kb_id)
+    logger.info(f"知识库 {kb_id} 垃圾回收完成，删除 {len(orphan_ids)} 个孤立向量")
+    return len(orphan_ids)
+
+def chroma_store_rebuild(kb_id: str, index_settings: Optional[Dict[str, Any]] = None, page_size: int = 5000) -> int:
+    """
+    用已存储的向量重建知识库集合，可同时修改HNSW索引参数
     
-    # 合并元数据 (确保类型安全)
-    full_metadatas: List[Dict[str, Any]] = []
-    for md in metadatas:
-        if not isinstance(md, dict):
-            md = {}
-        full_metadata = {**base_metadata, **md}
-        full_metadatas.append(full_metadata)
+    长期增删后HNSW图中积累的删除标记会降低召回率和检索速度。重建时分页读取旧集合的
+    向量、文本和元数据写入临时集合，不调用嵌入接口；完成后删除旧集合并将临时集合改名替换。
+    重建期间该知识库的写入和删除会等待，检索仍使用旧集合。
     
-    # 存储文档和元数据
-    try:
-        doc_ids = chroma_store.add_texts(
-            texts=texts,
-            metadatas=full_metadatas,
-            embedding_function=embedding_generator if isinstance(embedding_generator, Embeddings) else None
-        )
-        logger.info(f"成功存储 {len(doc_ids)} 个文档到知识库 {kb_id}")
-        return doc_ids
-    except Exception as e:
-        logger.error(f"存储文档到ChromaDB失败: {str(e)}")
-        logger.error(f"元数据内容: {full_metadatas}")
-        raise
+    Args:
+        kb_id: 知识库ID
+        index_settings: 新的索引参数，未指定的参数沿用旧集合的设置
+        page_size: 每页读取的向量数量
+        
+    Returns:
+        重建后集合中的向量数量
+    """
+    if VECTOR_STORE_BACKEND == "flat":
+        return _flat_store_rebuild(kb_id, index_settings)
+    client = get_chroma_client()
+    name = f"chroma_{kb_id}"
+    temp_name = f"{name}_rebuild"
+    batch_size = min(page_size, client.get_max_batch_size())
+    start = time.time()
+    with _kb_write_lock(kb_id):
+        old = client.get_collection(name)
+        hnsw = dict(old.configuration.get("hnsw") or {})
+        hnsw.update((build_hnsw_configuration(index_settings) or {}).get("hnsw", {}))
+        configuration = {"hnsw": {key: hnsw[key] for key in HNSW_SETTING_KEYS.values() if hnsw.get(key) is not None}}
+
+        # 清理上次失败遗留的临时集合
+        try:
+            client.delete_collection(temp_name)
+        except Exception:
+            pass
+        # 旧版本以 hnsw: 前缀元数据保存的索引参数已合并进配置，不再保留
+        metadata = {key: value for key, value in (old.metadata or {}).items() if not key.startswith("hnsw:")} or None
+        temp = client.create_collection(temp_name, configuration=configuration, metadata=metadata)
+        try:
+            offset = 0
+            while True:
+                page = old.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+                ids = page.get("ids") or []
+                if ids:
+                    temp.add(ids=ids, embeddings=page["embeddings"], documents=page["documents"], metadatas=page["metadatas"])
+                if len(ids) < batch_size:
+                    break
+                offset += batch_size
+            if temp.count() != old.count():
+                raise RuntimeError(f"重建后向量数量不一致: {temp.count()} != {old.count()}")
+        except Exception:
+            client.delete_collection(temp_name)
+            raise
+
+        with _chroma_lock:
+            invalidate_chroma_store(kb_id)
+            client.delete_collection(name)
+            temp.modify(name=name)
+        bump_kb_generation(kb_id)
+        count = temp.count()
+    logger.info(f"知识库 {kb_id} 的向量集合重建完成，共 {count} 个向量，索引参数 {configuration['hnsw']}，耗时 {time.time() - start:.2f} 秒")
+    return count
+
+def _flat_store_rebuild(kb_id: str, index_settings: Optional[Dict[str, Any]] = None) -> int:
+    """flat 后端的重建：压缩掉已删除的行并重新训练IVF索引，可修改距离度量"""
+    space = ((build_hnsw_configuration(index_settings) or {}).get("hnsw") or {}).get("space")
+    start = time.time()
+    with _kb_write_lock(kb_id):
+        count = get_chroma_store(kb_id)._collection.compact(space=space)
+        bump_kb_generation(kb_id)
+    logger.info(f"知识库 {kb_id} 的向量集合压缩完成，共 {count} 个向量，耗时 {time.time() - start:.2f} 秒")
+    return count
+
+def _iter_chroma_texts(kb_id: str, page_size: int = 5000):
+    """分页读取知识库集合中的全部文本块，用于构建关键词索引"""
+    chroma_store = get_chroma_store(kb_id)
+    offset = 0
+    while True:
+        page = chroma_store.get(include=["documents"], limit=page_size, offset=offset)
+        ids = page.get("ids") or []
+        documents = page.get("documents") or []
+        yield ids, [document or "" for document in documents]
+        if len(ids) < page_size:
+            break
+        offset += page_size
+
+def get_kb_bm25_index(kb_id: str) -> BM25Index:
+    """获取知识库的BM25索引，首次访问时在后台从向量集合构建"""
+    return get_bm25_index(kb_id, loader=lambda: _iter_chroma_texts(kb_id))
+
+# 检索时允许过滤的元数据字段与比较运算符
+FILTERABLE_METADATA_FIELDS = {"doc_id", "document_type", "source", "file_path", "page", "headers", "kb_id"}
+_FILTER_OPERATORS = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin"}
+
+def build_metadata_filter(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    将检索过滤条件转换为Chroma的where子句
+    
+    标量值按相等匹配，列表按 $in 匹配，也可以直接给出 {"$gte": 3} 这样的运算符字典；
+    多个字段之间为"且"的关系。
+    
+    Args:
+        filters: 字段到过滤值的映射，例如 {"doc_id": "...", "page": {"$lte": 10}}
+        
+    Returns:
+        Chroma where 子句，没有过滤条件时返回 None
+        
+    Raises:
+        ValueError: 字段或运算符不受支持
+    """
+    if not filters:
+        return None
+    clauses: List[Dict[str, Any]] = []
+    for field, value in filters.items():
+        if field not in FILTERABLE_METADATA_FIELDS:
+            raise ValueError(f"不支持按字段 {field} 过滤，可用字段: {sorted(FILTERABLE_METADATA_FIELDS)}")
+        if isinstance(value, dict):
+            unknown = set(value) - _FILTER_OPERATORS
+            if unknown:
+                raise ValueError(f"不支持的过滤运算符: {sorted(unknown)}")
+            condition = value
+        elif isinstance(value, (list, tuple)):
+            if not value:
+                raise ValueError(f"字段 {field} 的过滤值列表为空")
+            condition = {"$in": list(value)}
+        else:
+            condition = {"$eq": value}
+        clauses.append({field: condition})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
 
-def load_chroma_store_retriever(kb_id: str):
+def load_chroma_store_retriever(kb_id: str, filters: Optional[Dict[str, Any]] = None):
     """
-    创建带元数据的ChromaDB检索器
+    创建带元数据的混合检索器
+    
+    向量检索与BM25关键词检索并行执行，结果以倒数排名融合合并，
+    精确标识符、错误码、产品名等向量检索容易漏掉的查询也能命中。
+    融合后的候选经 MMR 筛选，剔除相互重叠的近似重复文本块，减少上下文 token。
+    检索结果按知识库版本号缓存，重复的问题无需再次嵌入和检索。
+    
+    提供过滤条件时以 where 子句下推到Chroma，向量检索只在符合条件的文本块中进行，
+    例如按 doc_id 过滤即只检索该文档的向量；关键词检索的命中在读取文档时按同一条件过滤。
     
     Args:
         kb_id: 知识库ID
+        filters: 元数据过滤条件，格式见 build_metadata_filter
         
     Returns:
         配置好的检索器实例
     """
     chroma_store = get_chroma_store(kb_id)
-    return chroma_store.as_retriever(
-        search_type="similarity_score_threshold",
-        search_kwargs={
-            "k": 10,
-            "score_threshold": 0.5,
-            "include": ["metadatas", "documents", "distances"]
-        }
-    )
\ No newline at end of file
+    # 关闭混合检索时不提供关键词索引，只做向量检索与 MMR 筛选
+    bm25_index = get_kb_bm25_index(kb_id) if HYBRID_SEARCH_ENABLED else None
+    where = build_metadata_filter(filters)
+    retriever = HybridRetriever(
+        vectorstore=chroma_store,
+        bm25_index=bm25_index,
+        filter=where,
+        k=RETRIEVAL_TOP_K,
+        fetch_k=max(RETRIEVAL_FETCH_K, RETRIEVAL_TOP_K),
+        score_threshold=RETRIEVAL_SCORE_THRESHOLD,
+        mmr_enabled=RETRIEVAL_MMR_ENABLED,
+        mmr_lambda=RETRIEVAL_MMR_LAMBDA,
+        dedup_threshold=RETRIEVAL_DEDUP_THRESHOLD,
+    )
+    # 关键词索引构建完成前后的检索结果不同，一并作为版本标识
+    generation = lambda: (get_kb_generation(kb_id), bm25_index is not None and bm25_index.ready)
+    if not RETRIEVAL_CACHE_ENABLED:
+        return retriever
+    scope = json.dumps(where, sort_keys=True, ensure_ascii=False) if where else None
+    return CachedRetriever(retriever=retriever, kb_id=kb_id, scope=scope, generation=generation)
+
+async def aretrieve_knowledge_bases(retrievers: Dict[str, BaseRetriever], query: str, k: int = RETRIEVAL_TOP_K) -> List[Document]:
+    """
+    并发检索多个知识库，按归一化分数合并为全局 top-k
+    
+    各知识库的检索同时进行，总耗时取决于最慢的一个知识库而不是之和。
+    多个知识库共用同一个查询向量，先计算一次写入查询向量缓存，避免每个知识库各自请求嵌入接口。
+    单个知识库检索失败时记录警告并跳过，不影响其他知识库的结果。
+    
+    Args:
+        retrievers: 知识库ID到检索器的映射
+        query: 查询文本
+        k: 合并后返回的文档数量
+        
+    Returns:
+        按分数降序排列的文档列表，元数据中包含 kb_id 与 score
+    """
+    if len(retrievers) > 1 and embedding_generator is not None:
+        try:
+            await embedding_generator.aembed_query(query)
+        except Exception as e:
+            logger.warning(f"预先计算查询向量失败: {str(e)}")
+
+    kb_ids = list(retrievers)
+    results = await asyncio.gather(
+        *(retrievers[kb_id].ainvoke(query) for kb_id in kb_ids),
+        return_exceptions=True
+    )
+
+    ranked: List[Tuple[float, int, Document]] = []
+    for kb_id, result in zip(kb_ids, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"知识库 {kb_id} 检索失败: {str(result)}")
+            continue
+        for rank, doc in enumerate(result):
+            score = doc.metadata.get("score")
+            if score is None:
+                # 检索器未给出分数时按名次折算，与融合分数的归一化方式一致
+                score = 61.0 / (60 + rank + 1)
+                doc.metadata["score"] = score
+            doc.metadata.setdefault("kb_id", kb_id)
+            ranked.append((float(score), rank, doc))
+    # 分数相同时名次靠前的优先
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+    return [doc for _, _, doc in ranked[:k]]
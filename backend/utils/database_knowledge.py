@@ -1,7 +1,7 @@
 """
 存储知识库：knowledge.db, "sqlite:///./dbs/chat.db"
 
-有两张表：
+有四张表：
 - knowledgeBases 知识库表，存储知识库信息，包括：
 {
   "createdAt": "2025-09-19T16:21:17.824Z",
@@ -44,6 +44,12 @@
   }
 ]
 
+- documentChunks 文档向量块表，记录每个文档写入向量库 chroma_{kb_id} 集合的向量ID，
+  删除或重建文档时据此精确删除对应向量
+
+- knowledgeBaseGenerations 知识库版本号表，知识库的向量每次写入或删除时递增，
+  作为检索结果缓存键的一部分，多个服务进程据此同步失效各自缓存的检索结果
+
 其中： annotatedPath 和 mdPath 目前只有pdf格式文件才有，其他格式文件字段留空。
 - annotatedPath 是pdf 文件经过 backend/utils/pdf_to_markdown.py 处理后的带批注的pdf文件，文件命名是原文件名后加`_annotated`的pdf文件
 - mdPath 也是pdf 文件经过 backend/utils/pdf_to_markdown.py 处理后的markdown文件，包含pdf中的文本图像信息，文件命名与原pdf同名
@@ -52,9 +58,10 @@
 import os
 import functools
 from contextlib import contextmanager
-from typing import List, Dict, Optional, Generator, Any, Callable, TypeVar
+from typing import List, Dict, Optional, Generator, Any, Callable, TypeVar, Tuple
 from datetime import datetime, timezone
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Integer, ForeignKey, Index
+from sqlalchemy import create_engine, select, Column, String, Text, DateTime, Integer, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base, Session as SQLAlchemySession
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError, OperationalError
 from .logger import logger_init
@@ -143,6 +150,28 @@ class Document(Base):
         Index('idx_documents_uploaded_at', uploaded_at),
     )
 
+# 文档向量块表模型
+class DocumentChunk(Base):
+    """文档向量块表，记录文档在向量库中的向量ID"""
+    __tablename__ = "documentChunks"
+
+    id: Column[str] = Column(String(64), primary_key=True)  # 向量ID
+    document_id: Column[str] = Column(String(64), ForeignKey("documents.id"), nullable=False)
+    knowledge_base_id: Column[str] = Column(String(64), nullable=False)
+
+    __table_args__ = (
+        Index('idx_document_chunks_document', document_id),
+        Index('idx_document_chunks_knowledge_base', knowledge_base_id),
+    )
+
+# 知识库版本号表模型
+class KnowledgeBaseGeneration(Base):
+    """知识库版本号表，不随知识库删除，避免重建同ID知识库后命中旧版本的缓存"""
+    __tablename__ = "knowledgeBaseGenerations"
+
+    knowledge_base_id: Column[str] = Column(String(64), primary_key=True)
+    generation: Column[int] = Column(Integer, nullable=False, default=0)
+
 # 创建表
 try:
     Base.metadata.create_all(bind=engine)
@@ -214,10 +243,12 @@ def create_knowledge_base(kb_id: str, name: str, description: str = "") -> Optio
 
 @db_operation
 def delete_knowledge_base(db: SQLAlchemySession, kb_id: str) -> bool:
-    """删除知识库及其所有文档"""
+    """删除知识库及其所有文档和向量块记录"""
     try:
         kb = db.query(KnowledgeBase).filter(KnowledgeBase.id == kb_id).first()
         if kb:
+            # 向量块记录与文档之间没有级联关系，需单独删除
+            db.query(DocumentChunk).filter(DocumentChunk.knowledge_base_id == kb_id).delete(synchronize_session=False)
             db.delete(kb)
             knowledge_cache.invalidate(kb_id)
             logger.info(f"删除知识库: {kb_id}")
@@ -237,6 +268,16 @@ def list_knowledge_bases(db: SQLAlchemySession, limit: int = 100, offset: int =
         logger.error(f"列出知识库失败: {str(e)}")
         return []
 
+@db_operation
+def list_knowledge_base_ids(db: SQLAlchemySession, limit: int = 100) -> List[str]:
+    """列出知识库ID，按最近更新时间倒序"""
+    try:
+        return [row.id for row in
+                db.query(KnowledgeBase.id).order_by(KnowledgeBase.updated_at.desc()).limit(limit).all()]
+    except Exception as e:
+        logger.error(f"列出知识库ID失败: {str(e)}")
+        return []
+
 @db_operation
 def get_knowledge_base(db: SQLAlchemySession, kb_id: str) -> Optional[KnowledgeBase]:
     """获取单个知识库"""
@@ -297,6 +338,76 @@ def add_document(
         logger.error(f"添加文档失败: {str(e)}")
         return None
 
+@db_operation
+def add_documents(db: SQLAlchemySession, kb_id: str, documents: List[Dict[str, Any]]) -> int:
+    """
+    在一个事务中批量添加文档到知识库
+
+    Args:
+        kb_id: 知识库ID
+        documents: 文档字段字典列表，包含 id、name、saved_name、path、size，可选 annotated_path、md_path
+
+    Returns:
+        添加的文档数量，知识库不存在时返回0
+    """
+    try:
+        kb = db.query(KnowledgeBase).filter(KnowledgeBase.id == kb_id).first()
+        if not kb and kb_id == "0":
+            kb = KnowledgeBase(id="0", name="默认知识库", description="系统默认知识库")
+            db.add(kb)
+            db.flush()
+            logger.info(f"自动创建默认知识库: {kb_id}")
+        elif not kb:
+            logger.error(f"知识库不存在: {kb_id}")
+            return 0
+        if documents:
+            db.bulk_insert_mappings(Document, [
+                {"annotated_path": "", "md_path": "", **document, "knowledge_base_id": kb_id}
+                for document in documents
+            ])
+            db.flush()
+        knowledge_cache.invalidate(kb_id)
+        logger.info(f"批量添加 {len(documents)} 个文档到知识库 {kb_id}")
+        return len(documents)
+    except Exception as e:
+        logger.error(f"批量添加文档失败: {str(e)}")
+        raise
+
+def _remove_document_files(doc: Document) -> None:
+    """删除文档在上传目录中的主文件、PDF批注文件、Markdown文件及同名文件夹"""
+    upload_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "uploads"))
+    # 删除主文件
+    saved_name = str(doc.saved_name) if doc.saved_name else None
+    if saved_name:
+        file_path = os.path.join(upload_dir, saved_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    
+    # 删除PDF批注文件
+    annotated_path = str(doc.annotated_path) if doc.annotated_path else None
+    if annotated_path:
+        annotated_file = os.path.join(upload_dir, os.path.basename(annotated_path))
+        if os.path.exists(annotated_file):
+            os.remove(annotated_file)
+            
+    # 删除pdf解析Markdown文件
+    md_path = str(doc.md_path) if doc.md_path else None
+    if md_path:
+        md_file = os.path.join(upload_dir, os.path.basename(md_path))
+        if os.path.exists(md_file):
+            os.remove(md_file)
+    
+    # 删除同名文件夹及其内容
+    if saved_name:
+        try:
+            file_base = os.path.splitext(saved_name)[0]
+            dir_path = os.path.join(upload_dir, file_base)
+            if os.path.exists(dir_path) and os.path.isdir(dir_path):
+                import shutil
+                shutil.rmtree(dir_path)
+        except Exception as e:
+            logger.warning(f"删除同名文件夹失败: {str(e)}")
+
 @db_operation
 def delete_document(db: SQLAlchemySession, doc_id: str, kb_id: Optional[str] = None) -> bool:
     """删除文档及其相关文件，可选验证知识库ID"""
@@ -311,40 +422,9 @@ def delete_document(db: SQLAlchemySession, doc_id: str, kb_id: Optional[str] = N
             logger.error(f"文档不属于指定知识库 - 文档ID: {doc_id}, 请求知识库ID: {kb_id}, 实际知识库ID: {doc.knowledge_base_id}")
             return False
             
-        upload_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "uploads"))
-        
-        # 删除主文件
-        saved_name = str(doc.saved_name) if doc.saved_name else None
-        if saved_name:
-            file_path = os.path.join(upload_dir, saved_name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        
-        # 删除PDF批注文件
-        annotated_path = str(doc.annotated_path) if doc.annotated_path else None
-        if annotated_path:
-            annotated_file = os.path.join(upload_dir, os.path.basename(annotated_path))
-            if os.path.exists(annotated_file):
-                os.remove(annotated_file)
-                
-        # 删除pdf解析Markdown文件
-        md_path = str(doc.md_path) if doc.md_path else None
-        if md_path:
-            md_file = os.path.join(upload_dir, os.path.basename(md_path))
-            if os.path.exists(md_file):
-                os.remove(md_file)
-        
-        # 删除同名文件夹及其内容
-        if saved_name:
-            try:
-                file_base = os.path.splitext(saved_name)[0]
-                dir_path = os.path.join(upload_dir, file_base)
-                if os.path.exists(dir_path) and os.path.isdir(dir_path):
-                    import shutil
-                    shutil.rmtree(dir_path)
-            except Exception as e:
-                logger.warning(f"删除同名文件夹失败: {str(e)}")
+        _remove_document_files(doc)
         
+        db.query(DocumentChunk).filter(DocumentChunk.document_id == doc_id).delete(synchronize_session=False)
         db.delete(doc)
         knowledge_cache.invalidate(str(doc.knowledge_base_id))
         logger.info(f"删除文档及相关文件: {doc_id}")
@@ -400,4 +480,151 @@ def update_document_paths(
         return True
     except Exception as e:
         logger.error(f"更新文档路径失败: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+# 知识库版本号操作
+def _bump_kb_generation(db: SQLAlchemySession, kb_id: str) -> None:
+    """在当前事务中递增知识库版本号，不存在时从1开始"""
+    statement = sqlite_insert(KnowledgeBaseGeneration).values(knowledge_base_id=kb_id, generation=1)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[KnowledgeBaseGeneration.knowledge_base_id],
+        set_={"generation": KnowledgeBaseGeneration.generation + 1}
+    ))
+
+@db_operation
+def bump_kb_generation(db: SQLAlchemySession, kb_id: str) -> None:
+    """递增知识库版本号，使所有服务进程中该知识库已缓存的检索结果失效"""
+    try:
+        _bump_kb_generation(db, kb_id)
+    except Exception as e:
+        logger.error(f"递增知识库版本号失败: {str(e)}")
+        raise
+
+@db_operation
+def get_kb_generation(db: SQLAlchemySession, kb_id: str) -> int:
+    """获取知识库当前的版本号，从未写入过向量的知识库为0"""
+    try:
+        row = db.query(KnowledgeBaseGeneration.generation)\
+            .filter(KnowledgeBaseGeneration.knowledge_base_id == kb_id).first()
+        return row.generation if row else 0
+    except Exception as e:
+        logger.error(f"获取知识库版本号失败: {str(e)}")
+        raise
+
+# 文档向量块操作
+@db_operation
+def save_document_chunks(db: SQLAlchemySession, doc_id: str, kb_id: str, chunk_ids: List[str], replace: bool = False) -> bool:
+    """记录文档写入向量库的向量ID，replace为True时先清除该文档原有记录"""
+    try:
+        if replace:
+            db.query(DocumentChunk).filter(DocumentChunk.document_id == doc_id).delete(synchronize_session=False)
+        if chunk_ids:
+            db.bulk_insert_mappings(DocumentChunk, [
+                {"id": chunk_id, "document_id": doc_id, "knowledge_base_id": kb_id}
+                for chunk_id in dict.fromkeys(chunk_ids)
+            ])
+        _bump_kb_generation(db, kb_id)
+        db.flush()
+        logger.info(f"记录文档 {doc_id} 的 {len(chunk_ids)} 个向量ID")
+        return True
+    except Exception as e:
+        logger.error(f"记录文档向量ID失败: {str(e)}")
+        raise
+
+@db_operation
+def save_documents_chunks(db: SQLAlchemySession, kb_id: str, doc_chunk_ids: Dict[str, List[str]]) -> bool:
+    """在一个事务中替换多个文档的向量ID记录"""
+    try:
+        doc_ids = list(doc_chunk_ids)
+        for i in range(0, len(doc_ids), 500):
+            db.query(DocumentChunk).filter(DocumentChunk.document_id.in_(doc_ids[i:i + 500])).delete(synchronize_session=False)
+        db.bulk_insert_mappings(DocumentChunk, [
+            {"id": chunk_id, "document_id": doc_id, "knowledge_base_id": kb_id}
+            for doc_id, chunk_ids in doc_chunk_ids.items()
+            for chunk_id in dict.fromkeys(chunk_ids)
+        ])
+        _bump_kb_generation(db, kb_id)
+        db.flush()
+        logger.info(f"记录 {len(doc_ids)} 个文档的 {sum(len(ids) for ids in doc_chunk_ids.values())} 个向量ID")
+        return True
+    except Exception as e:
+        logger.error(f"记录文档向量ID失败: {str(e)}")
+        raise
+
+@db_operation
+def list_document_chunk_ids(db: SQLAlchemySession, doc_id: str) -> List[str]:
+    """获取文档在向量库中的所有向量ID"""
+    try:
+        return [row.id for row in db.query(DocumentChunk.id).filter(DocumentChunk.document_id == doc_id).all()]
+    except Exception as e:
+        logger.error(f"获取文档向量ID失败: {str(e)}")
+        return []
+
+@db_operation
+def list_document_ids(db: SQLAlchemySession, kb_id: str) -> List[Tuple[str, str]]:
+    """列出知识库中所有文档的 (文档ID, 存储文件名)，不分页"""
+    try:
+        return [(row.id, row.saved_name) for row in
+                db.query(Document.id, Document.saved_name).filter(Document.knowledge_base_id == kb_id).all()]
+    except Exception as e:
+        logger.error(f"列出文档ID失败: {str(e)}")
+        return []
+
+@db_operation
+def delete_orphan_document_chunks(db: SQLAlchemySession, kb_id: str) -> int:
+    """删除所属文档已不存在的向量块记录"""
+    try:
+        live_ids = select(Document.id).where(Document.knowledge_base_id == kb_id)
+        deleted = db.query(DocumentChunk).filter(
+            DocumentChunk.knowledge_base_id == kb_id,
+            ~DocumentChunk.document_id.in_(live_ids)
+        ).delete(synchronize_session=False)
+        if deleted:
+            logger.info(f"清理知识库 {kb_id} 中 {deleted} 条孤立的向量块记录")
+        return deleted
+    except Exception as e:
+        logger.error(f"清理孤立向量块记录失败: {str(e)}")
+        return 0
+
+@db_operation
+def find_document_by_name(db: SQLAlchemySession, kb_id: str, name: str) -> Optional[str]:
+    """按原始文件名查找知识库中的文档，返回文档ID"""
+    try:
+        row = db.query(Document.id).filter(Document.knowledge_base_id == kb_id, Document.name == name)\
+            .order_by(Document.uploaded_at.desc()).first()
+        return row.id if row else None
+    except Exception as e:
+        logger.error(f"查找文档失败: {str(e)}")
+        return None
+
+@db_operation
+def replace_document_file(
+    db: SQLAlchemySession,
+    doc_id: str,
+    saved_name: str,
+    path: str,
+    size: int,
+    annotated_path: str = "",
+    md_path: str = ""
+) -> bool:
+    """重新上传文档时替换其文件，删除旧文件，保留文档ID以便增量更新向量"""
+    try:
+        doc = db.query(Document).filter(Document.id == doc_id).first()
+        if not doc:
+            logger.warning(f"尝试替换不存在的文档: {doc_id}")
+            return False
+
+        _remove_document_files(doc)
+        setattr(doc, "saved_name", saved_name)
+        setattr(doc, "path", path)
+        setattr(doc, "size", size)
+        setattr(doc, "annotated_path", annotated_path)
+        setattr(doc, "md_path", md_path)
+        setattr(doc, "uploaded_at", datetime.now(timezone.utc))
+        db.flush()
+        knowledge_cache.invalidate(str(doc.knowledge_base_id))
+        logger.info(f"替换文档文件: {doc_id} -> {saved_name}")
+        return True
+    except Exception as e:
+        logger.error(f"替换文档文件失败: {str(e)}")
+        return False
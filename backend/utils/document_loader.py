@@ -1,79 +1,111 @@
 import os
 import logging
-from typing import List, Optional, Union, Tuple, Dict, Any
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Union, Tuple, Dict, Any, Iterator
+from pypdf import PdfReader
+from .markdown_chunker import iter_markdown_sections
+from .tokenizer import count_tokens
 from .logger import logger_init
 
-from langchain_community.document_loaders import WebBaseLoader,UnstructuredMarkdownLoader,TextLoader,PyPDFLoader,UnstructuredHTMLLoader
+from langchain_community.document_loaders import WebBaseLoader,TextLoader,UnstructuredHTMLLoader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import bs4
 
 logger = logger_init("document_loader")
 
-def document_loader_markdown(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> Tuple[List[str], List[Dict[str, Any]]]:
+# 按 token 分块：每块的目标 token 数（0 表示按字符数分块）和块之间重叠的 token 数，可被 load_document 的参数覆盖
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 0))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 64))
+
+def _length_function(by_tokens: bool):
+    """分割器的长度函数：按 token 数或字符数"""
+    return count_tokens if by_tokens else len
+
+def _iter_splits(docs: Iterator[Document], chunk_size: int, chunk_overlap: int, by_tokens: bool = False) -> Iterator[Document]:
     """
-    加载并分割Markdown文档，按标题结构进行分割
-    
+    逐个文档分割 lazy_load 产出的文档，读到一个文档即产出它的文本块
+
+    逐文档分割与对整个文档列表调用 split_documents 的结果相同。
+    by_tokens 为 True 时 chunk_size 和 chunk_overlap 按 token 数计算。
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=_length_function(by_tokens)
+    )
+    for doc in docs:
+        yield from text_splitter.split_documents([doc])
+
+def _collect_chunks(chunks: Iterator[Tuple[str, Dict[str, Any]]]) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """将逐块产出的 (text, metadata) 收集为文本列表和元数据列表"""
+    texts = []
+    metadatas = []
+    for text, metadata in chunks:
+        texts.append(text)
+        metadatas.append(metadata)
+    return texts, metadatas
+
+def iter_markdown_chunks(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200,
+                         encoding: str = "utf-8", by_tokens: bool = False) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    按标题结构逐块产出Markdown文档的文本块
+
+    逐行读取文件并单遍分割（见 markdown_chunker.iter_markdown_sections），
+    保留表格和代码块的原始格式，内存占用与文件大小无关。PDF转换的Markdown中的页码标记写入 page 元数据。
+
     参数:
         file_path: Markdown文件路径
         chunk_size: 文本块大小，默认1000字符
         chunk_overlap: 块之间的重叠字符数，默认200
-        
+        encoding: 文件编码，默认为'utf-8'
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
+
     返回:
-        (texts, metadatas): 分割后的文本列表和对应的元数据列表
+        (text, metadata) 的迭代器
     """
-    try:
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"Markdown文件不存在: {file_path}")
+    # 检查文件是否存在
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Markdown文件不存在: {file_path}")
 
-        # 加载Markdown文档
-        loader = UnstructuredMarkdownLoader(file_path)
-        data = loader.load()
-        
-        if len(data) == 0:
-            logger.warning("Markdown文档为空")
-            return []
-        
-        # 获取Markdown内容
-        markdown_content = data[0].page_content
-        
-        # 定义要分割的标题层级
-        headers_to_split_on = [
-            ("#", "Header 1"),
-            ("##", "Header 2"),
-            ("###", "Header 3"),
-            ("####", "Header 4"),
-            ("#####", "Header 5"),
-            ("######", "Header 6")
-        ]
-        
-        # 使用MarkdownHeaderTextSplitter按标题分割
-        markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on)
-        md_header_splits = markdown_splitter.split_text(markdown_content)
-        
-        # 进一步使用RecursiveCharacterTextSplitter进行细粒度分割
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
-        
-        # 分割文档并添加元数据(保留headers)
-        final_splits = text_splitter.split_documents(md_header_splits)
-        texts = []
-        metadatas = []
-        
-        for doc in final_splits:
-            headers = {k: v for k, v in doc.metadata.items() if k.startswith("Header")}
+    chunk_index = 0
+    with open(file_path, encoding=encoding) as f:
+        for text, headers, page in iter_markdown_sections(f, chunk_size, chunk_overlap, _length_function(by_tokens)):
             metadata = {
                 "source": file_path,
                 "document_type": "markdown",
                 "headers": " | ".join(headers.values()) if headers else "",  # 添加标题信息
-                "chunk_index": len(texts),  # 添加块索引
+                "chunk_index": chunk_index,  # 添加块索引
                 **headers  # 保留标题层级信息
             }
-            texts.append(doc.page_content)
-            metadatas.append(metadata)
+            if page is not None:
+                # PDF转换的Markdown带页码标记，与PyPDF提取的文本块一样记录从0开始的页码
+                metadata["page"] = page - 1
+            yield text, metadata
+            chunk_index += 1
+    if chunk_index == 0:
+        logger.warning("Markdown文档为空")
+
+def document_loader_markdown(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200,
+                             encoding: str = "utf-8", by_tokens: bool = False) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    加载并分割Markdown文档，按标题结构进行分割
+    
+    参数:
+        file_path: Markdown文件路径
+        chunk_size: 文本块大小，默认1000字符
+        chunk_overlap: 块之间的重叠字符数，默认200
+        encoding: 文件编码，默认为'utf-8'
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
         
+    返回:
+        (texts, metadatas): 分割后的文本列表和对应的元数据列表
+    """
+    try:
+        texts, metadatas = _collect_chunks(iter_markdown_chunks(file_path, chunk_size, chunk_overlap, encoding, by_tokens))
         logger.info(f"Markdown文档已分割为 {len(texts)} 个文本块")
         return texts, metadatas
         
@@ -81,8 +113,42 @@ def document_loader_markdown(file_path: str, chunk_size: int = 1000, chunk_overl
         logger.error(f"处理Markdown文档时出错: {str(e)}")
         return [], []
 
+def iter_txt_chunks(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200,
+                    encoding: str = "utf-8", autodetect_encoding: bool = False, by_tokens: bool = False) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    逐块产出文本文件的文本块
+
+    参数:
+        file_path: 文本文件路径
+        chunk_size: 文本块大小，默认1000字符
+        chunk_overlap: 块之间的重叠字符数，默认200
+        encoding: 文件编码，默认为'utf-8'
+        autodetect_encoding: 是否自动检测编码，默认为False
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
+
+    返回:
+        (text, metadata) 的迭代器
+    """
+    # 检查文件是否存在
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"文本文件不存在: {file_path}")
+
+    # 初始化TextLoader
+    loader = TextLoader(
+        file_path=file_path,
+        encoding=encoding,
+        autodetect_encoding=autodetect_encoding
+    )
+    for chunk_index, doc in enumerate(_iter_splits(loader.lazy_load(), chunk_size, chunk_overlap, by_tokens)):
+        yield doc.page_content, {
+            "source": file_path,
+            "document_type": "text",
+            "chunk_index": chunk_index,
+            "line_numbers": doc.metadata.get("line_numbers", "")
+        }
+
 def document_loader_txt(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200, 
-                       encoding: str = "utf-8", autodetect_encoding: bool = False) -> Tuple[List[str], List[Dict[str, Any]]]:
+                       encoding: str = "utf-8", autodetect_encoding: bool = False, by_tokens: bool = False) -> Tuple[List[str], List[Dict[str, Any]]]:
     """
     加载并分割文本文件
     
@@ -92,47 +158,13 @@ def document_loader_txt(file_path: str, chunk_size: int = 1000, chunk_overlap: i
         chunk_overlap: 块之间的重叠字符数，默认200
         encoding: 文件编码，默认为'utf-8'
         autodetect_encoding: 是否自动检测编码，默认为False
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
         
     返回:
         (texts, metadatas): 分割后的文本列表和对应的元数据列表
     """
     try:
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"文本文件不存在: {file_path}")
-
-        # 初始化TextLoader
-        loader = TextLoader(
-            file_path=file_path,
-            encoding=encoding,
-            autodetect_encoding=autodetect_encoding
-        )
-        
-        # 加载文档
-        data = loader.load()
-        
-        # 初始化文本分割器
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
-        
-        # 分割文档
-        splits = text_splitter.split_documents(data)
-        
-        # 提取文本内容和元数据
-        texts = []
-        metadatas = []
-        
-        for doc in splits:
-            texts.append(doc.page_content)
-            metadatas.append({
-                "source": file_path,
-                "document_type": "text",
-                "chunk_index": len(texts) - 1,
-                "line_numbers": doc.metadata.get("line_numbers", "")
-            })
-        
+        texts, metadatas = _collect_chunks(iter_txt_chunks(file_path, chunk_size, chunk_overlap, encoding, autodetect_encoding, by_tokens))
         logger.info(f"文本文件已分割为 {len(texts)} 个文本块")
         return texts, metadatas
         
@@ -146,7 +178,121 @@ def document_loader_txt(file_path: str, chunk_size: int = 1000, chunk_overlap: i
         logger.error(f"处理文本文件时出错: {str(e)}")
         return [], []
 
-def document_loader_pdf(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200, password: Optional[str] = None, pages: Optional[List[int]] = None) -> Tuple[List[str], List[Dict[str, Any]]]:
+# PDF并行提取配置：页数达到阈值时按页段分片到进程池并行提取和分割；进程数（0表示CPU核数）；每个分片的页数
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 64))
+PDF_PARALLEL_WORKERS = int(os.getenv("PDF_PARALLEL_WORKERS", 0)) or (os.cpu_count() or 1)
+PDF_SHARD_PAGES = int(os.getenv("PDF_SHARD_PAGES", 32))
+
+_PDF_SEPARATORS = ["\n\n", "\n", "。", "？", "！", ".", "?", "!"]
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+# 每个线程（子进程中即每个进程）缓存最近打开的PDF，同一文档的各分片复用已解析的交叉引用表和字体
+_pdf_readers = threading.local()
+# 在解析进程池（批量导入、PDF分片）的工作进程中置位，此时PDF总是串行处理，避免进程嵌套
+_in_worker_process = False
+
+def mark_worker_process() -> None:
+    """进程池的 initializer：标记当前进程为解析工作进程"""
+    global _in_worker_process
+    _in_worker_process = True
+
+def _open_pdf(file_path: str, password: Optional[str] = None) -> PdfReader:
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, password)
+    if getattr(_pdf_readers, "key", None) != key:
+        _pdf_readers.reader = PdfReader(file_path, password=password) if password else PdfReader(file_path)
+        _pdf_readers.key = key
+    return _pdf_readers.reader
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """进程内共享的PDF提取进程池，首次使用时以 spawn 方式创建"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_PARALLEL_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=mark_worker_process)
+        return _pdf_pool
+
+def _extract_pdf_shard(file_path: str, page_numbers: List[int], chunk_size: int, chunk_overlap: int,
+                       password: Optional[str] = None, by_tokens: bool = False) -> List[Tuple[int, List[str]]]:
+    """
+    提取并分割一组PDF页面，可在子进程中执行
+
+    每页单独分割，与 PyPDFLoader 按页加载后 split_documents 的结果一致。
+
+    返回:
+        [(页码, 该页的文本块列表)]，按页码顺序
+    """
+    reader = _open_pdf(file_path, password)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=_PDF_SEPARATORS,
+                                                   length_function=_length_function(by_tokens))
+    return [(page_number, text_splitter.split_text(reader.pages[page_number].extract_text().strip()))
+            for page_number in page_numbers]
+
+def iter_pdf_chunks(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200, password: Optional[str] = None,
+                    pages: Optional[List[int]] = None, parallel: Optional[bool] = None, by_tokens: bool = False) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    按页序逐块产出PDF的文本块
+
+    页数达到 PDF_PARALLEL_MIN_PAGES 时，页面按 PDF_SHARD_PAGES 分片提交到进程池并行提取和分割，
+    结果按页序合并，chunk_index 在合并时连续编号，与串行处理的结果完全一致。
+    提交的分片数限制为进程数的两倍，前面的分片完成即可产出，不必等待整本文档。
+    在解析进程池的工作进程中（如批量导入的解析进程，见 mark_worker_process）总是串行处理，避免进程嵌套；
+    uvicorn --reload/--workers 启动的服务进程本身是子进程，不受影响。
+
+    参数:
+        file_path: PDF文件路径
+        chunk_size: 文本块大小
+        chunk_overlap: 块之间的重叠字符数
+        password: PDF密码
+        pages: 要处理的页码（从0开始），默认处理所有页面
+        parallel: 是否并行，默认按页数自动选择
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
+
+    返回:
+        (text, metadata) 的迭代器
+    """
+    total_pages = len(_open_pdf(file_path, password).pages)
+    page_numbers = sorted({page for page in pages if 0 <= page < total_pages}) if pages is not None else list(range(total_pages))
+    if parallel is None:
+        parallel = len(page_numbers) >= PDF_PARALLEL_MIN_PAGES and PDF_PARALLEL_WORKERS > 1 \
+            and not _in_worker_process
+    shards = [page_numbers[i:i + PDF_SHARD_PAGES] for i in range(0, len(page_numbers), PDF_SHARD_PAGES)]
+
+    if parallel and len(shards) > 1:
+        pool = _get_pdf_pool()
+        pending = deque()
+        next_shard = 0
+
+        def results() -> Iterator[List[Tuple[int, List[str]]]]:
+            nonlocal next_shard
+            while next_shard < len(shards) or pending:
+                while next_shard < len(shards) and len(pending) < PDF_PARALLEL_WORKERS * 2:
+                    pending.append(pool.submit(_extract_pdf_shard, file_path, shards[next_shard], chunk_size, chunk_overlap, password, by_tokens))
+                    next_shard += 1
+                yield pending.popleft().result()
+    else:
+        def results() -> Iterator[List[Tuple[int, List[str]]]]:
+            for shard in shards:
+                yield _extract_pdf_shard(file_path, shard, chunk_size, chunk_overlap, password, by_tokens)
+
+    chunk_index = 0
+    for shard_result in results():
+        for page_number, chunks in shard_result:
+            for text in chunks:
+                yield text, {
+                    "source": file_path,
+                    "document_type": "pdf",
+                    "page": page_number,
+                    "chunk_index": chunk_index
+                }
+                chunk_index += 1
+    logger.info(f"PDF文档共 {len(page_numbers)} 页，{'并行' if parallel and len(shards) > 1 else '串行'}分割为 {chunk_index} 个文本块")
+    # 释放缓存的文档，避免长期占用内存
+    _pdf_readers.key = _pdf_readers.reader = None
+
+def document_loader_pdf(file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200, password: Optional[str] = None,
+                        pages: Optional[List[int]] = None, parallel: Optional[bool] = None, by_tokens: bool = False) -> Tuple[List[str], List[Dict[str, Any]]]:
     """
     加载并分割PDF文档
     
@@ -154,8 +300,10 @@ def document_loader_pdf(file_path: str, chunk_size: int = 1000, chunk_overlap: i
         file_path: PDF文件路径
         chunk_size: 文本块大小，默认1000字符
         chunk_overlap: 块之间的重叠字符数，默认200
-        pages: 指定要加载的页面范围，默认None(加载所有页面)
+        pages: 指定要加载的页码列表（从0开始），默认None(加载所有页面)
         password: PDF密码，默认None
+        parallel: 是否按页段分片并行提取，默认None(页数达到 PDF_PARALLEL_MIN_PAGES 时并行)
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
         
     返回:
         (texts, metadatas): 分割后的文本列表和对应的元数据列表
@@ -165,39 +313,11 @@ def document_loader_pdf(file_path: str, chunk_size: int = 1000, chunk_overlap: i
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"PDF文件不存在: {file_path}")
 
-        # 初始化PDF加载器
-        if password:
-            loader = PyPDFLoader(file_path, password=password)
-        else:
-            loader = PyPDFLoader(file_path)
-        
-        # 加载文档 
-        docs = loader.load()
-        
-        logger.info(f"成功加载 {len(docs)} 页PDF文档")
-        
-        # 初始化文本分割器
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            separators=["\n\n", "\n", "。", "？", "！", ".", "?", "!"]
-        )
-        
-        # 分割文档
-        splits = text_splitter.split_documents(docs)
-        
-        # 提取文本内容和元数据
         texts = []
         metadatas = []
-        
-        for doc in splits:
-            texts.append(doc.page_content)
-            metadatas.append({
-                "source": file_path,
-                "document_type": "pdf",
-                "page": doc.metadata.get("page", 0),
-                "chunk_index": len(texts) - 1
-            })
+        for text, metadata in iter_pdf_chunks(file_path, chunk_size, chunk_overlap, password, pages, parallel, by_tokens):
+            texts.append(text)
+            metadatas.append(metadata)
         
         logger.info(f"PDF文档已分割为 {len(texts)} 个文本块")
         return texts, metadatas
@@ -209,8 +329,46 @@ def document_loader_pdf(file_path: str, chunk_size: int = 1000, chunk_overlap: i
         logger.error(f"处理PDF文档时出错: {str(e)}")
         return [], []
 
+def iter_web_chunks(url: Union[str, List[str]], chunk_size: int = 1000,
+                    chunk_overlap: int = 200, verify_ssl: bool = True, by_tokens: bool = False) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    逐个网页抓取并逐块产出文本块，抓取完一个URL即产出它的文本块
+
+    参数:
+        url: 网页URL地址或URL列表
+        chunk_size: 文本块大小，默认1000字符
+        chunk_overlap: 块之间的重叠字符数，默认200
+        verify_ssl: SSL验证，默认True
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
+
+    返回:
+        (text, metadata) 的迭代器
+    """
+    # 初始化WebBaseLoader
+    loader = WebBaseLoader(
+        web_paths=url if isinstance(url, list) else [url],
+        bs_kwargs=dict(
+            parse_only=bs4.SoupStrainer(
+                class_=("post-content", "post-title", "post-header", "content", "article", "main")
+            )
+        ),
+    )
+
+    # 配置SSL验证
+    if not verify_ssl:
+        loader.requests_kwargs = {'verify': False}
+
+    for chunk_index, doc in enumerate(_iter_splits(loader.lazy_load(), chunk_size, chunk_overlap, by_tokens)):
+        source_url = url if isinstance(url, str) else doc.metadata.get("source", "unknown")
+        yield doc.page_content, {
+            "source": source_url,
+            "document_type": "web",
+            "title": doc.metadata.get("title", ""),
+            "chunk_index": chunk_index
+        }
+
 def document_loader_web(url: Union[str, List[str]], chunk_size: int = 1000, 
-                        chunk_overlap: int = 200, verify_ssl: bool = True) -> Tuple[List[str], List[Dict[str, Any]]]:
+                        chunk_overlap: int = 200, verify_ssl: bool = True, by_tokens: bool = False) -> Tuple[List[str], List[Dict[str, Any]]]:
     """
     从网页URL加载并分割内容
     
@@ -220,51 +378,13 @@ def document_loader_web(url: Union[str, List[str]], chunk_size: int = 1000,
         chunk_overlap: 块之间的重叠字符数，默认200
         proxies: 代理设置，默认None
         verify_ssl: SSL验证，默认True
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
         
     返回:
         (texts, metadatas): 分割后的文本列表和对应的元数据列表
     """
     try:
-        # 初始化WebBaseLoader
-        loader = WebBaseLoader(
-            web_paths=url if isinstance(url, list) else [url],
-            bs_kwargs=dict(
-                parse_only=bs4.SoupStrainer(
-                    class_=("post-content", "post-title", "post-header", "content", "article", "main")
-                )
-            ),
-        )
-        
-        # 配置SSL验证
-        if not verify_ssl:
-            loader.requests_kwargs = {'verify': False}
-        
-        # 加载文档
-        docs = loader.load()
-        
-        # 初始化文本分割器
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
-        
-        # 分割文档
-        splits = text_splitter.split_documents(docs)
-        
-        # 提取文本内容和元数据
-        texts = []
-        metadatas = []
-        
-        for doc in splits:
-            texts.append(doc.page_content)
-            source_url = url if isinstance(url, str) else doc.metadata.get("source", "unknown")
-            metadatas.append({
-                "source": source_url,
-                "document_type": "web",
-                "title": doc.metadata.get("title", ""),
-                "chunk_index": len(texts) - 1
-            })
-        
+        texts, metadatas = _collect_chunks(iter_web_chunks(url, chunk_size, chunk_overlap, verify_ssl, by_tokens))
         logger.info(f"网页内容已分割为 {len(texts)} 个文本块")
         return texts, metadatas
         
@@ -272,8 +392,44 @@ def document_loader_web(url: Union[str, List[str]], chunk_size: int = 1000,
         logger.error(f"加载网页内容时出错: {str(e)}")
         return [], []
 
+def iter_html_chunks(html_file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200,
+                     chunking_strategy: str = "by_title", max_characters: int = 1000, by_tokens: bool = False) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    逐块产出本地HTML文件的文本块
+
+    参数:
+        html_file_path: HTML文件路径
+        chunk_size: 文本块大小，默认1000字符
+        chunk_overlap: 块之间的重叠字符数，默认200
+        chunking_strategy: 分块策略，默认"by_title"
+        max_characters: 最大分块字符数，默认1000
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
+
+    返回:
+        (text, metadata) 的迭代器
+    """
+    # 检查文件是否存在
+    if not os.path.exists(html_file_path):
+        raise FileNotFoundError(f"HTML文件不存在: {html_file_path}")
+
+    # 初始化UnstructuredHTMLLoader
+    loader = UnstructuredHTMLLoader(
+        html_file_path,
+        unstructured_kwargs={
+            "chunking_strategy": chunking_strategy,
+            "max_characters": max_characters
+        }
+    )
+    for chunk_index, doc in enumerate(_iter_splits(loader.lazy_load(), chunk_size, chunk_overlap, by_tokens)):
+        yield doc.page_content, {
+            "source": html_file_path,
+            "document_type": "html",
+            "title": doc.metadata.get("title", ""),
+            "chunk_index": chunk_index
+        }
+
 def document_loader_html(html_file_path: str, chunk_size: int = 1000, chunk_overlap: int = 200,
-                         chunking_strategy: str = "by_title", max_characters: int = 1000) -> Tuple[List[str], List[Dict[str, Any]]]:
+                         chunking_strategy: str = "by_title", max_characters: int = 1000, by_tokens: bool = False) -> Tuple[List[str], List[Dict[str, Any]]]:
     """
     加载并分割本地HTML文件
     
@@ -283,49 +439,13 @@ def document_loader_html(html_file_path: str, chunk_size: int = 1000, chunk_over
         chunk_overlap: 块之间的重叠字符数，默认200
         chunking_strategy: 分块策略，默认"by_title"
         max_characters: 最大分块字符数，默认1000
+        by_tokens: chunk_size 和 chunk_overlap 是否按 token 数计算，默认False(按字符数)
         
     返回:
         (texts, metadatas): 分割后的文本列表和对应的元数据列表
     """
     try:
-        # 检查文件是否存在
-        if not os.path.exists(html_file_path):
-            raise FileNotFoundError(f"HTML文件不存在: {html_file_path}")
-
-        # 初始化UnstructuredHTMLLoader
-        loader = UnstructuredHTMLLoader(
-            html_file_path,
-            unstructured_kwargs={
-                "chunking_strategy": chunking_strategy,
-                "max_characters": max_characters
-            }
-        )
-        
-        # 加载文档
-        data = loader.load()
-        
-        # 初始化文本分割器
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
-        
-        # 分割文档
-        splits = text_splitter.split_documents(data)
-        
-        # 提取文本内容和元数据
-        texts = []
-        metadatas = []
-        
-        for doc in splits:
-            texts.append(doc.page_content)
-            metadatas.append({
-                "source": html_file_path,
-                "document_type": "html",
-                "title": doc.metadata.get("title", ""),
-                "chunk_index": len(texts) - 1
-            })
-        
+        texts, metadatas = _collect_chunks(iter_html_chunks(html_file_path, chunk_size, chunk_overlap, chunking_strategy, max_characters, by_tokens))
         logger.info(f"HTML文件已分割为 {len(texts)} 个文本块")
         return texts, metadatas
         
@@ -336,50 +456,162 @@ def document_loader_html(html_file_path: str, chunk_size: int = 1000, chunk_over
         logger.error(f"处理HTML文件时出错: {str(e)}")
         return [], []
 
-def load_document(file_path: str, file_type: str = "auto", **kwargs) -> Tuple[List[str], List[Dict[str, Any]]]:
+def detect_file_type(file_path: str, file_type: str = "auto") -> str:
+    """
+    检测文档类型
+
+    参数:
+        file_path: 文件路径或URL
+        file_type: 指定的文件类型，为"auto"时按URL和扩展名检测
+
+    返回:
+        文件类型: "md"、"txt"、"pdf"、"web" 或 "html"
+
+    异常:
+        ValueError: 不支持的文件类型
+    """
+    if file_type != "auto":
+        return file_type
+    if file_path.startswith(('http://', 'https://')) and file_path.endswith(('.html', '.htm')):
+        return "web"
+    _, ext = os.path.splitext(file_path)
+    if ext.lower() in ['.md', '.markdown']:
+        return "md"
+    elif ext.lower() == '.txt':
+        return "txt"
+    elif ext.lower() == '.pdf':
+        return "pdf"
+    elif ext.lower() in ['.html', '.htm']:
+        return "html"
+    raise ValueError(f"不支持的文件类型: {ext}")
+
+def _token_chunking(kwargs: Dict[str, Any], chunk_tokens: Optional[int], chunk_overlap_tokens: Optional[int]) -> Dict[str, Any]:
+    """
+    按 token 分块时将 chunk_size 和 chunk_overlap 换成 token 数并打开加载器的 by_tokens
+
+    chunk_tokens 为 None 时使用 CHUNK_TOKENS 配置，为 0 时保持按字符数分块。
+    """
+    chunk_tokens = CHUNK_TOKENS if chunk_tokens is None else chunk_tokens
+    if not chunk_tokens:
+        return kwargs
+    chunk_overlap_tokens = CHUNK_OVERLAP_TOKENS if chunk_overlap_tokens is None else chunk_overlap_tokens
+    return {
+        **kwargs,
+        "chunk_size": chunk_tokens,
+        "chunk_overlap": min(chunk_overlap_tokens, chunk_tokens // 2),
+        "by_tokens": True
+    }
+
+def load_document(file_path: str, file_type: str = "auto", chunk_tokens: Optional[int] = None,
+                  chunk_overlap_tokens: Optional[int] = None, **kwargs) -> Tuple[List[str], List[Dict[str, Any]]]:
     """
     统一文档加载接口，根据文件类型自动选择加载器
+
+    每个文本块的元数据都带有 token_count，检索后可按 token 预算组装上下文。
     
     参数:
         file_path: 文件路径或URL
         file_type: 文件类型，可选值: "auto", "md", "txt", "pdf", "web", "html"
+        chunk_tokens: 按 token 分块时每块的目标 token 数，默认None(使用 CHUNK_TOKENS 配置)，0 表示按字符数分块
+        chunk_overlap_tokens: 按 token 分块时块之间重叠的 token 数，默认None(使用 CHUNK_OVERLAP_TOKENS 配置)
         **kwargs: 传递给具体加载器的参数
         
     返回:
         (texts, metadatas): 分割后的文本列表和对应的元数据列表
     """
     # 自动检测文件类型
-    if file_type == "auto":
-        if file_path.startswith(('http://', 'https://')) and file_path.endswith(('.html', '.htm')):
-            file_type = "web"
-        else:
-            _, ext = os.path.splitext(file_path)
-            if ext.lower() in ['.md', '.markdown']:
-                file_type = "md"
-            elif ext.lower() == '.txt':
-                file_type = "txt"
-            elif ext.lower() == '.pdf':
-                file_type = "pdf"
-            elif ext.lower() in ['.html', '.htm']:
-                file_type = "html"
-            else:
-                raise ValueError(f"不支持的文件类型: {ext}")
+    file_type = detect_file_type(file_path, file_type)
+    kwargs = _token_chunking(kwargs, chunk_tokens, chunk_overlap_tokens)
     
     # 根据文件类型调用相应的加载器
     if file_type == "md":
-        return document_loader_markdown(file_path, **kwargs)
+        texts, metadatas = document_loader_markdown(file_path, **kwargs)
     elif file_type == "txt":
-        return document_loader_txt(file_path, **kwargs)
+        texts, metadatas = document_loader_txt(file_path, **kwargs)
     elif file_type == "pdf":
-        return document_loader_pdf(file_path, **kwargs)
+        texts, metadatas = document_loader_pdf(file_path, **kwargs)
     elif file_type == "web":
-        return document_loader_web(file_path, **kwargs)
+        texts, metadatas = document_loader_web(file_path, **kwargs)
     elif file_type == "html":
-        return document_loader_html(file_path, **kwargs)
+        texts, metadatas = document_loader_html(file_path, **kwargs)
     else:
         print(f"不支持的文件类型: {file_type}")
         return [], []
 
+    for text, metadata in zip(texts, metadatas):
+        metadata["token_count"] = count_tokens(text)
+    return texts, metadatas
+
+def parse_document(file_path: str, file_type: str = "auto", **kwargs) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    加载并分割文档，结果与 load_document 相同，但加载失败时抛出异常而不是返回空结果
+
+    用于需要区分"解析失败"和"没有内容"的场景，如批量导入的解析进程。
+
+    参数:
+        file_path: 文件路径或URL
+        file_type: 文件类型，同 load_document
+        **kwargs: 同 iter_document
+
+    返回:
+        (texts, metadatas): 分割后的文本列表和对应的元数据列表
+    """
+    return _collect_chunks(iter_document(file_path, file_type, **kwargs))
+
+# 各文件类型的逐块加载器
+_CHUNK_ITERATORS = {
+    "md": iter_markdown_chunks,
+    "txt": iter_txt_chunks,
+    "pdf": iter_pdf_chunks,
+    "web": iter_web_chunks,
+    "html": iter_html_chunks,
+}
+
+def iter_document(file_path: str, file_type: str = "auto", chunk_size: int = 1000, chunk_overlap: int = 200,
+                  chunk_tokens: Optional[int] = None, chunk_overlap_tokens: Optional[int] = None,
+                  **kwargs) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    逐块产出文档内容的生成器版本统一加载接口
+
+    各类型均基于加载器的 lazy_load 逐个文档（网页为逐个URL）读取并分割，读到即产出，
+    下游嵌入不必等待整个文件处理完；PDF 按页段读取，页数较多时由进程池并行处理并按页序产出。
+    产出的文本块和元数据（包括连续的 chunk_index）与 load_document 的结果一致。
+    加载失败时记录日志并抛出异常（不同于 load_document 返回空结果），中途失败不会被当作完整的文档。
+
+    参数:
+        file_path: 文件路径或URL
+        file_type: 文件类型，同 load_document
+        chunk_size: 文本块大小，默认1000字符
+        chunk_overlap: 块之间的重叠字符数，默认200
+        chunk_tokens: 按 token 分块时每块的目标 token 数，同 load_document
+        chunk_overlap_tokens: 按 token 分块时块之间重叠的 token 数，同 load_document
+        **kwargs: 传递给具体加载器的参数
+
+    返回:
+        (text, metadata) 的迭代器
+
+    异常:
+        FileNotFoundError: 文件不存在
+        ValueError: 不支持的文件类型
+        Exception: 加载或分割过程中的其他错误
+    """
+    kwargs = _token_chunking({**kwargs, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}, chunk_tokens, chunk_overlap_tokens)
+    try:
+        file_type = detect_file_type(file_path, file_type)
+        if file_type not in _CHUNK_ITERATORS:
+            raise ValueError(f"不支持的文件类型: {file_type}")
+        if file_type != "web" and not os.path.exists(file_path):
+            raise FileNotFoundError(f"文件不存在: {file_path}")
+        for text, metadata in _CHUNK_ITERATORS[file_type](file_path, **kwargs):
+            metadata["token_count"] = count_tokens(text)
+            yield text, metadata
+    except FileNotFoundError:
+        logger.error(f"文件未找到: {file_path}")
+        raise
+    except Exception as e:
+        logger.error(f"逐块加载文档 {file_path} 时出错: {str(e)}")
+        raise
+
 # 使用示例
 if __name__ == "__main__":
     # 示例1: 加载Markdown文档
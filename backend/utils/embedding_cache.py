@@ -0,0 +1,217 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Sequence
+import numpy as np
+from .logger import logger_init
+
+logger = logger_init("embedding_cache")
+
+# SQLite 单条语句的参数数量有上限，批量查询/写入时按此大小分段
+_SQL_CHUNK = 500
+
+def text_hash(text: str) -> str:
+    """计算文本内容的哈希值，作为缓存键的一部分"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本：全半角统一、去除首尾空白、合并连续空白并转小写"""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).lower()
+
+class QueryEmbeddingCache:
+    """
+    查询向量的内存 LRU 缓存，带过期时间
+
+    以 (模型名, 规范化查询文本) 为键，读写均为 O(1)。
+    条目数上限为 capacity，向量以 float32 数组保存以节省内存。
+    """
+    def __init__(self, capacity: int = 1024, ttl: float = 3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        """获取缓存的查询向量，过期或不存在时返回 None"""
+        key = (model, normalize_query(text))
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                expires_at, vector = entry
+                if expires_at > time.monotonic():
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._cache[key]
+            self.misses += 1
+            return None
+
+    def put(self, model: str, text: str, vector: Sequence[float]) -> None:
+        """写入查询向量，超出容量时淘汰最久未使用的条目"""
+        array = np.array(vector, dtype=np.float32)
+        if not array.any():
+            return
+        # 缓存中的向量会被多个请求共享，设为只读防止被意外修改
+        array.setflags(write=False)
+        key = (model, normalize_query(text))
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, array)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._cache),
+            "capacity": self.capacity,
+        }
+
+class EmbeddingCache:
+    """
+    持久化的内容寻址嵌入缓存
+
+    以 (模型名, 文本哈希) 为键，向量以 float32 二进制存储在 SQLite 中。
+    总大小超过 max_bytes 时按最近访问时间淘汰最旧的条目。
+    """
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        批量查询缓存
+
+        Args:
+            model: 嵌入模型名称
+            texts: 文本列表
+
+        Returns:
+            与输入顺序一致的 float32 向量列表，未命中的位置为 None
+        """
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            unique_hashes = list(dict.fromkeys(hashes))
+            for i in range(0, len(unique_hashes), _SQL_CHUNK):
+                part = unique_hashes[i:i + _SQL_CHUNK]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *part]
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, h) for h in found]
+                )
+                self._conn.commit()
+
+            results: List[Optional[np.ndarray]] = []
+            for h in hashes:
+                blob = found.get(h)
+                if blob is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(np.frombuffer(blob, dtype=np.float32))
+        return results
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """批量写入缓存，写入后超出容量则淘汰最久未访问的条目"""
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            array = np.asarray(vector, dtype=np.float32)
+            if not array.any():
+                # 零向量没有检索意义，不写入缓存
+                continue
+            blob = array.tobytes()
+            rows.append((model, text_hash(text), blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            if self._conn.total_changes - before == len(rows):
+                self._total_bytes += sum(row[3] for row in rows)
+            else:
+                self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+            self._conn.commit()
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """按最近访问时间淘汰，直到总大小降到容量的 90%"""
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT model, text_hash, size FROM embeddings ORDER BY last_access LIMIT ?", (_SQL_CHUNK,)
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            batch = []
+            for model, h, size in rows:
+                batch.append((model, h))
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", batch)
+            evicted += len(batch)
+        self._conn.commit()
+        logger.info(f"嵌入缓存超出容量，已淘汰 {evicted} 条记录，当前大小 {self._total_bytes} 字节")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,70 @@
+from typing import List
+import numpy as np
+
+# 64 位混合常数（splitmix64 / murmur3 finalizer），numpy 的 uint64 乘法按 2^64 自然回绕
+_MIX_1 = np.uint64(0xFF51AFD7ED558CCD)
+_MIX_2 = np.uint64(0xC4CEB9FE1A85EC53)
+_PRIME_1 = np.uint64(0x9E3779B97F4A7C15)
+_PRIME_2 = np.uint64(0xBF58476D1CE4E5B9)
+_SALT_BIGRAM = np.uint64(0x94D049BB133111EB)
+_SALT_TRIGRAM = np.uint64(0x2545F4914F6CDD1D)
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    """对 uint64 数组做雪崩混合，使哈希值均匀分布"""
+    h = h ^ (h >> np.uint64(33))
+    h = h * _MIX_1
+    h = h ^ (h >> np.uint64(33))
+    h = h * _MIX_2
+    return h ^ (h >> np.uint64(33))
+
+def hashing_embed(texts: List[str], dim: int = 512) -> np.ndarray:
+    """
+    字符 n-gram 特征哈希嵌入，整批文本一次完成向量化计算
+
+    以字符的一元、二元、三元组为特征（对中文无需分词），经哈希映射到 dim 维，
+    并用哈希的最高位决定符号以抵消冲突；词频取对数压缩后做 L2 归一化，
+    因此余弦相似度可以直接反映文本的字面重合程度。
+
+    Args:
+        texts: 文本列表
+        dim: 向量维度
+
+    Returns:
+        形状为 (len(texts), dim) 的 float32 矩阵
+    """
+    count = len(texts)
+    if count == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+
+    lowered = [text.lower() for text in texts]
+    lengths = np.fromiter((len(text) for text in lowered), dtype=np.int64, count=count)
+    # 用 \x00 拼接所有文本，一次编码成码点数组；分隔符不参与任何 n-gram
+    codes = np.frombuffer("\x00".join(lowered).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    rows = np.repeat(np.arange(count, dtype=np.int64), lengths + 1)[:codes.size]
+    valid = codes != 0
+
+    feature_hashes = [_mix(codes[valid] * _PRIME_1)]
+    feature_rows = [rows[valid]]
+    if codes.size > 1:
+        first, second = codes[:-1], codes[1:]
+        mask = valid[:-1] & valid[1:]
+        feature_hashes.append(_mix((first[mask] * _PRIME_1) ^ (second[mask] * _PRIME_2) ^ _SALT_BIGRAM))
+        feature_rows.append(rows[:-1][mask])
+    if codes.size > 2:
+        first, second, third = codes[:-2], codes[1:-1], codes[2:]
+        mask = valid[:-2] & valid[1:-1] & valid[2:]
+        feature_hashes.append(_mix(
+            (first[mask] * _PRIME_1) ^ (second[mask] * _PRIME_2) ^ (third[mask] * _MIX_1) ^ _SALT_TRIGRAM
+        ))
+        feature_rows.append(rows[:-2][mask])
+
+    hashes = np.concatenate(feature_hashes)
+    feature_row = np.concatenate(feature_rows)
+    buckets = (hashes % np.uint64(dim)).astype(np.int64)
+    signs = np.where((hashes >> np.uint64(63)) == 1, -1.0, 1.0)
+
+    matrix = np.bincount(feature_row * dim + buckets, weights=signs, minlength=count * dim).reshape(count, dim)
+    matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
@@ -0,0 +1,140 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+from .logger import logger_init
+
+logger = logger_init("embedding_scheduler")
+
+# 优先级：数值越小越先执行，聊天查询优先于后台文档入库
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# 限流配置：每秒请求数、每分钟 token 数（0 表示不限制），以及触发限流后的退避上限
+EMBEDDING_REQUESTS_PER_SECOND: float = float(os.getenv("EMBEDDING_REQUESTS_PER_SECOND", 10))
+EMBEDDING_TOKENS_PER_MINUTE: float = float(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 1000000))
+EMBEDDING_MAX_BACKOFF: float = float(os.getenv("EMBEDDING_MAX_BACKOFF", 60))
+
+def estimate_tokens(texts: List[str]) -> int:
+    """粗略估算文本的 token 数（中文约一字一 token，按字符数估算偏保守）"""
+    return sum(len(text) for text in texts)
+
+class EmbeddingScheduler:
+    """
+    进程级嵌入请求调度器
+
+    - 请求数与 token 数两个令牌桶共同限流
+    - 等待者按 (优先级, 到达顺序) 排队，只有队首可以取令牌，交互式查询不会排在入库批次之后
+    - 收到 429 时暂停发放令牌并将请求速率减半，之后每次成功逐步恢复
+    """
+    def __init__(
+        self,
+        requests_per_second: float = EMBEDDING_REQUESTS_PER_SECOND,
+        tokens_per_minute: float = EMBEDDING_TOKENS_PER_MINUTE,
+        max_backoff: float = EMBEDDING_MAX_BACKOFF,
+    ):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.max_backoff = max_backoff
+        self._rate = requests_per_second
+        self._request_tokens = max(requests_per_second, 1.0)
+        self._token_tokens = tokens_per_minute
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoff = 0.0
+        self._waiters: List[Tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.rate_limited_count = 0
+        self.granted = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_second > 0:
+            self._request_tokens = min(max(self.requests_per_second, 1.0), self._request_tokens + elapsed * self._rate)
+        if self.tokens_per_minute > 0:
+            self._token_tokens = min(self.tokens_per_minute, self._token_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, now: float, cost: float) -> float:
+        """计算队首请求还需等待的时间"""
+        wait = max(0.0, self._blocked_until - now)
+        if self.requests_per_second > 0 and self._request_tokens < 1:
+            wait = max(wait, (1 - self._request_tokens) / self._rate)
+        if self.tokens_per_minute > 0 and self._token_tokens < cost:
+            wait = max(wait, (cost - self._token_tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_BACKGROUND) -> None:
+        """
+        阻塞直到可以发起一次嵌入请求
+
+        Args:
+            tokens: 本次请求估算的 token 数
+            priority: 请求优先级
+        """
+        # 单次请求的消耗不超过桶容量，否则永远无法满足
+        cost = min(float(tokens), self.tokens_per_minute) if self.tokens_per_minute > 0 else 0.0
+        ticket = (priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] == ticket:
+                        wait = self._wait_time(now, cost)
+                        if wait <= 0:
+                            if self.requests_per_second > 0:
+                                self._request_tokens -= 1
+                            self._token_tokens -= cost
+                            heapq.heappop(self._waiters)
+                            self.granted[priority] = self.granted.get(priority, 0) + 1
+                            self._cond.notify_all()
+                            return
+                        self._cond.wait(timeout=wait)
+                    else:
+                        self._cond.wait()
+            except BaseException:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+    def report_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """收到 429 时调用：指数退避并降低请求速率"""
+        with self._cond:
+            self.rate_limited_count += 1
+            self._backoff = min(self.max_backoff, self._backoff * 2 if self._backoff else 1.0)
+            delay = max(self._backoff, retry_after or 0.0)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            if self.requests_per_second > 0:
+                self._rate = max(self.requests_per_second / 16, self._rate / 2)
+            logger.warning(f"嵌入接口触发限流，暂停 {delay:.1f} 秒，当前速率 {self._rate:.2f} 请求/秒")
+            self._cond.notify_all()
+
+    def report_success(self) -> None:
+        """请求成功时调用：逐步恢复速率并衰减退避时间"""
+        with self._cond:
+            if self._backoff:
+                self._backoff = self._backoff / 2 if self._backoff > 1.0 else 0.0
+            if self._rate < self.requests_per_second:
+                self._rate = min(self.requests_per_second, self._rate * 1.1)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回调度器状态"""
+        with self._cond:
+            return {
+                "rate": self._rate,
+                "backoff": self._backoff,
+                "waiting": len(self._waiters),
+                "rate_limited": self.rate_limited_count,
+                "granted_interactive": self.granted.get(PRIORITY_INTERACTIVE, 0),
+                "granted_background": self.granted.get(PRIORITY_BACKGROUND, 0),
+            }
+
+# 进程内共享的调度器实例，所有远程嵌入调用都经过它
+embedding_scheduler = EmbeddingScheduler()
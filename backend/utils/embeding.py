@@ -1,44 +1,311 @@
-from typing import List
-from zhipuai import ZhipuAI
+import os
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Callable, Dict
+from zhipuai import ZhipuAI, APIReachLimitError
 from dotenv import load_dotenv
+import numpy as np
 from langchain_core.embeddings import Embeddings
+from tenacity import Retrying, stop_after_attempt, wait_exponential
+from .embedding_cache import EmbeddingCache, QueryEmbeddingCache
+from .embedding_local import hashing_embed
+from .embedding_scheduler import (
+    EmbeddingScheduler,
+    embedding_scheduler,
+    estimate_tokens,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_BACKGROUND,
+)
 
 # 加载环境变量
 load_dotenv()
 
+# 批量嵌入配置：每个请求携带的文本数、同时在途的批次数、每批失败重试次数
+EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+EMBEDDING_MAX_CONCURRENCY: int = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_MAX_RETRIES: int = int(os.getenv("EMBEDDING_MAX_RETRIES", 3))
+# 异步嵌入的并发上限（聊天检索走异步路径，与文档入库的同步线程池相互隔离）
+EMBEDDING_ASYNC_CONCURRENCY: int = int(os.getenv("EMBEDDING_ASYNC_CONCURRENCY", 8))
+# 持久化嵌入缓存配置：相同模型下相同文本只调用一次嵌入接口
+EMBEDDING_CACHE_ENABLED: bool = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH: str = os.getenv("EMBEDDING_CACHE_PATH", "./dbs/embedding_cache.db")
+EMBEDDING_CACHE_MAX_MB: int = int(os.getenv("EMBEDDING_CACHE_MAX_MB", 512))
+# 查询向量内存缓存配置：重复的问题直接命中，不再发起网络请求
+QUERY_EMBEDDING_CACHE_SIZE: int = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 2048))
+QUERY_EMBEDDING_CACHE_TTL: float = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 3600))
+# 本地嵌入后端配置
+LOCAL_EMBEDDING_DIM: int = int(os.getenv("LOCAL_EMBEDDING_DIM", 512))
+LOCAL_EMBEDDING_BATCH_SIZE: int = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 256))
+
 class EmbeddingGenerator(Embeddings):
-    def __init__(self, model_name):
+    # 是否使用持久化嵌入缓存，不使用的后端不会打开缓存数据库
+    uses_cache = True
+
+    def __init__(
+        self,
+        model_name: str,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        async_concurrency: int = EMBEDDING_ASYNC_CONCURRENCY,
+        client: Optional[ZhipuAI] = None,
+        cache: Optional[EmbeddingCache] = None,
+        scheduler: Optional[EmbeddingScheduler] = embedding_scheduler,
+    ):
         self.model_name = model_name
-        self.client = ZhipuAI()
-
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        embeddings: List[List[float]] = []
-        for text in texts:
-            response = self.client.embeddings.create(model=self.model_name, input=text)
-            if hasattr(response, 'data') and response.data:
-                embeddings.append([float(x) for x in response.data[0].embedding])
-            else:
-                # 如果获取嵌入失败，返回一个零向量
-                embeddings.append([0.0] * 1024)  # 假设嵌入向量维度为 1024
+        self.scheduler = scheduler
+        self.cache = cache
+        self.query_cache = QueryEmbeddingCache(QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL) \
+            if QUERY_EMBEDDING_CACHE_SIZE > 0 else None
+        self.batch_size = max(1, batch_size)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max(1, max_retries)
+        self.client = client if client is not None else self._create_client()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency,
+            thread_name_prefix="embedding"
+        )
+        # 异步路径：阻塞的 HTTP 调用放到独立线程池，信号量限制在途请求数，事件循环不被阻塞
+        self.async_concurrency = max(1, async_concurrency)
+        self._async_executor = ThreadPoolExecutor(
+            max_workers=self.async_concurrency,
+            thread_name_prefix="embedding-async"
+        )
+        self._async_semaphore = asyncio.Semaphore(self.async_concurrency)
+
+    def _create_client(self):
+        """创建嵌入接口客户端，重试由批次级别统一处理，关闭客户端内部重试"""
+        return ZhipuAI(max_retries=0)
+
+    def _request_batch(self, texts: List[str], priority: int) -> list:
+        """经调度器限流后发起一次嵌入请求，429 时通知调度器退避"""
+        if self.scheduler is not None:
+            self.scheduler.acquire(estimate_tokens(texts), priority)
+        try:
+            response = self.client.embeddings.create(model=self.model_name, input=texts)
+        except APIReachLimitError as e:
+            if self.scheduler is not None:
+                retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+                self.scheduler.report_rate_limited(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            raise
+        if self.scheduler is not None:
+            self.scheduler.report_success()
+
+        data = response.data if hasattr(response, 'data') else None
+        # 不再用零向量占位：零向量写入索引后会污染检索结果，失败时整批重试或抛出异常
+        if not data:
+            raise RuntimeError("嵌入接口未返回数据")
+        if len(data) != len(texts):
+            raise ValueError(f"嵌入结果数量不匹配: 期望 {len(texts)}, 实际 {len(data)}")
+        return data
+
+    def _embed_batch(self, texts: List[str], priority: int = PRIORITY_BACKGROUND) -> np.ndarray:
+        """
+        一次请求嵌入一批文本，失败时整批重试
+
+        Args:
+            texts: 待嵌入的文本列表
+            priority: 调度优先级，聊天查询使用 PRIORITY_INTERACTIVE
+
+        Returns:
+            与输入顺序一致的 float32 向量矩阵，形状为 (len(texts), dim)
+        """
+        for attempt in Retrying(
+            stop=stop_after_attempt(self.max_retries),
+            wait=wait_exponential(multiplier=0.5, max=8),
+            reraise=True,
+        ):
+            with attempt:
+                data = self._request_batch(texts, priority)
+
+        # 接口按 index 标识输入位置，排序后保证与输入顺序一致
+        data = sorted(data, key=lambda item: item.index if item.index is not None else 0)
+        return np.array([item.embedding for item in data], dtype=np.float32)
+
+    def _embed_uncached(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        按批次并发嵌入文档，结果保持输入顺序
+
+        返回的各向量是同一块连续 float32 内存的行视图，Chroma 写入时直接使用，无需逐元素转换。
+        """
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return list(self._embed_batch(batches[0]))
+
+        # 线程池大小即在途批次上限，map 按提交顺序返回结果
+        return list(np.concatenate(list(self._executor.map(self._embed_batch, batches))))
+
+    def embed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        """嵌入文档，已缓存的文本直接返回，只有未见过的文本才调用接口"""
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._embed_uncached(texts)
+
+        embeddings = self.cache.get_many(self.model_name, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            # 同一批中重复的文本只嵌入一次
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            new_embeddings = self._embed_uncached(unique_texts)
+            self.cache.put_many(self.model_name, unique_texts, new_embeddings)
+            lookup = dict(zip(unique_texts, new_embeddings))
+            for i in missing:
+                embeddings[i] = lookup[texts[i]]
         return embeddings
 
-    def embed_query(self, text: str) -> List[float]:
-        """嵌入单个查询文本"""
-        response = self.client.embeddings.create(model=self.model_name, input=text)
-        if hasattr(response, 'data') and response.data:
-            return [float(x) for x in response.data[0].embedding]
-        return [0.0] * 1024  # 如果获取嵌入失败，返回零向量
+    def embed_query(self, text: str) -> np.ndarray:
+        """嵌入单个查询文本，优先使用内存缓存"""
+        if self.query_cache is not None:
+            cached = self.query_cache.get(self.model_name, text)
+            if cached is not None:
+                return cached
+        embedding = self._embed_batch([text], PRIORITY_INTERACTIVE)[0]
+        if self.query_cache is not None:
+            self.query_cache.put(self.model_name, text, embedding)
+        return embedding
 
-    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
-        """异步嵌入文档"""
-        return self.embed_documents(texts)
+    async def _aembed_batch(self, texts: List[str], priority: int = PRIORITY_BACKGROUND) -> np.ndarray:
+        """在线程池中嵌入一批文本，不阻塞事件循环"""
+        async with self._async_semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._async_executor, partial(self._embed_batch, texts, priority))
 
-    async def aembed_query(self, text: str) -> List[float]:
-        """异步嵌入查询"""
-        return self.embed_query(text)
+    async def _aembed_uncached(self, texts: List[str]) -> List[np.ndarray]:
+        """异步嵌入文档，各批次并发执行，结果保持输入顺序"""
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results = await asyncio.gather(*(self._aembed_batch(batch) for batch in batches))
+        return list(np.concatenate(results))
 
+    async def aembed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        """异步嵌入文档，缓存读写在线程中执行"""
+        if not texts:
+            return []
+        if self.cache is None:
+            return await self._aembed_uncached(texts)
+
+        embeddings = await asyncio.to_thread(self.cache.get_many, self.model_name, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            new_embeddings = await self._aembed_uncached(unique_texts)
+            await asyncio.to_thread(self.cache.put_many, self.model_name, unique_texts, new_embeddings)
+            lookup = dict(zip(unique_texts, new_embeddings))
+            for i in missing:
+                embeddings[i] = lookup[texts[i]]
+        return embeddings
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        """异步嵌入查询，优先使用内存缓存"""
+        if self.query_cache is not None:
+            cached = self.query_cache.get(self.model_name, text)
+            if cached is not None:
+                return cached
+        embeddings = await self._aembed_batch([text], PRIORITY_INTERACTIVE)
+        if self.query_cache is not None:
+            self.query_cache.put(self.model_name, text, embeddings[0])
+        return embeddings[0]
+
+
+class HashingEmbeddingGenerator(EmbeddingGenerator):
+    """
+    进程内 CPU 嵌入后端，不依赖网络
+
+    模型名形如 "local-hash" 或 "local-hash-768"，后缀为向量维度（默认 512）。
+    """
+    uses_cache = False
+
+    def __init__(self, model_name: str, **kwargs):
+        suffix = model_name.rsplit("-", 1)[-1]
+        self.dim = int(suffix) if suffix.isdigit() else LOCAL_EMBEDDING_DIM
+        kwargs.setdefault("batch_size", LOCAL_EMBEDDING_BATCH_SIZE)
+        # 本地计算比读取磁盘缓存更快，不使用持久化缓存；也不受远程接口限流约束
+        kwargs["cache"] = None
+        kwargs["scheduler"] = None
+        super().__init__(model_name, **kwargs)
+
+    def _create_client(self):
+        return None
+
+    def _embed_batch(self, texts: List[str], priority: int = PRIORITY_BACKGROUND) -> np.ndarray:
+        return hashing_embed(texts, self.dim)
+
+
+# 嵌入后端注册表：模型名前缀 -> 生成器类，未匹配的模型名默认使用智谱AI接口
+EmbeddingFactory = Callable[..., EmbeddingGenerator]
+_EMBEDDING_PROVIDERS: Dict[str, EmbeddingFactory] = {
+    "local-hash": HashingEmbeddingGenerator,
+}
+
+def register_embedding_provider(prefix: str, factory: EmbeddingFactory) -> None:
+    """注册嵌入后端，EMBEDDING_MODEL_NAME 以 prefix 开头时使用该后端"""
+    _EMBEDDING_PROVIDERS[prefix] = factory
 
 def get_embedding_generator(model_name: str) -> EmbeddingGenerator:
-    return EmbeddingGenerator(model_name)
+    factory: EmbeddingFactory = EmbeddingGenerator
+    # 最长前缀优先匹配
+    for prefix in sorted(_EMBEDDING_PROVIDERS, key=len, reverse=True):
+        if model_name.startswith(prefix):
+            factory = _EMBEDDING_PROVIDERS[prefix]
+            break
+    # 只为使用持久化缓存的后端打开缓存数据库
+    use_cache = EMBEDDING_CACHE_ENABLED and getattr(factory, "uses_cache", True)
+    cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 1024 * 1024) if use_cache else None
+    return factory(model_name, cache=cache)
+
+
+# 基准测试：用本地模拟嵌入服务对比逐条请求与批量并发请求
+if __name__ == "__main__":
+    import json
+    import random
+    import sys
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05  # 模拟单次请求往返耗时(秒)
+    chunk_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    class StandInEmbeddingHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            time.sleep(latency)
+            payload = json.dumps({
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [random.random() for _ in range(1024)]}
+                    for i in range(len(inputs))
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
 
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInEmbeddingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+    texts = [f"测试文本块 {i} " * 20 for i in range(chunk_count)]
 
+    for label, batch_size, concurrency in [("逐条顺序", 1, 1), ("批量并发", EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_CONCURRENCY)]:
+        generator = EmbeddingGenerator(
+            "embedding-2",
+            batch_size=batch_size,
+            max_concurrency=concurrency,
+            client=ZhipuAI(api_key="bench.standin", base_url=base_url, max_retries=0),
+            # 不经过全局限流调度器，只比较批量与并发本身的效果
+            scheduler=None,
+        )
+        start = time.time()
+        vectors = generator.embed_documents(texts)
+        elapsed = time.time() - start
+        print(f"{label}: {len(vectors)} 个文本块, 耗时 {elapsed:.2f}秒, {len(vectors) / elapsed:.0f} 块/秒")
+    server.shutdown()
@@ -0,0 +1,707 @@
+import os
+import json
+import uuid
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Callable
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from .logger import logger_init
+
+logger = logger_init("flat_vector_store")
+
+# 存活向量数超过该阈值时训练IVF分区索引；查询时探测的分区数；暴力检索时每块的行数
+FLAT_IVF_THRESHOLD = int(os.getenv("FLAT_IVF_THRESHOLD", 50000))
+FLAT_IVF_NPROBE = int(os.getenv("FLAT_IVF_NPROBE", 16))
+FLAT_SEARCH_BLOCK_ROWS = int(os.getenv("FLAT_SEARCH_BLOCK_ROWS", 65536))
+
+_SPACES = {"l2", "cosine", "ip"}
+
+def _where_to_sql(where: Dict[str, Any], params: List[Any]) -> str:
+    """将Chroma风格的where子句转换为对元数据JSON的SQL条件"""
+    if len(where) != 1:
+        return "(" + " AND ".join(_where_to_sql({key: value}, params) for key, value in where.items()) + ")"
+    key, value = next(iter(where.items()))
+    if key in ("$and", "$or"):
+        joiner = " AND " if key == "$and" else " OR "
+        return "(" + joiner.join(_where_to_sql(clause, params) for clause in value) + ")"
+    path = '$."' + key.replace('"', '') + '"'
+    if not isinstance(value, dict):
+        value = {"$eq": value}
+    conditions = []
+    for op, operand in value.items():
+        params.append(path)
+        if op in ("$in", "$nin"):
+            operand = list(operand)
+            placeholders = ",".join("?" * len(operand)) or "NULL"
+            conditions.append(f"json_extract(metadata, ?) {'IN' if op == '$in' else 'NOT IN'} ({placeholders})")
+            params.extend(operand)
+        else:
+            sql_op = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}.get(op)
+            if sql_op is None:
+                raise ValueError(f"不支持的过滤运算符: {op}")
+            conditions.append(f"json_extract(metadata, ?) {sql_op} ?")
+            params.append(operand)
+    return "(" + " AND ".join(conditions) + ")"
+
+class FlatCollection:
+    """
+    内存映射的单知识库向量集合
+
+    目录中的文件：
+    - vectors.f32：float32 向量矩阵，按行追加
+    - live.u8：每行一个字节，1 表示存活，删除只清零对应字节
+    - store.db：SQLite 附属表，保存 行号 -> (ID, 文本, 元数据) 与集合设置
+    - ivf_*.{f32,i32,i64}：IVF 聚类中心、每行所属分区，以及按分区排序的行号与分区偏移
+
+    矩阵与存活标记以只读内存映射方式打开，打开集合几乎不耗时，多个工作进程通过操作系统
+    页缓存共享同一份数据。写入通过 SQLite 事务分配行号，再按偏移写入文件，各进程的写入互不覆盖。
+    读取方每次检索前检查文件大小与版本，其他进程追加的数据随即可见。
+
+    存活向量较少时整批暴力计算内积；超过 ivf_threshold 后训练 IVF 分区索引，
+    检索只计算距离最近的 nprobe 个分区，训练后新增的行单独暴力检索，积累较多时重新排序。
+    接口与 chromadb.Collection 中本项目用到的部分一致（upsert、update、get、query、delete、count）。
+    """
+    def __init__(self, path: str, space: str = "l2", ivf_threshold: int = FLAT_IVF_THRESHOLD, nprobe: int = FLAT_IVF_NPROBE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, "store.db"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                row INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                document TEXT,
+                metadata TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('space', ?)", (space,))
+        self._settings: Dict[str, str] = {}
+        self._mapped_rows = -1
+        self._mapped_version = None
+        self._vectors: Optional[np.ndarray] = None
+        self._live: Optional[np.ndarray] = None
+        self._norms: Optional[np.ndarray] = None
+        self._centroids: Optional[np.ndarray] = None
+        self._centroid_norms: Optional[np.ndarray] = None
+        self._assign: Optional[np.ndarray] = None
+        self._order: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+        self._refresh()
+
+    # ---- 文件与设置 ----
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return self._settings.get(key, default)
+
+    def _write_setting(self, key: str, value: Any) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def space(self) -> str:
+        return self._setting("space", "l2")
+
+    @property
+    def dim(self) -> Optional[int]:
+        value = self._setting("dim")
+        return int(value) if value else None
+
+    @property
+    def configuration(self) -> Dict[str, Any]:
+        """与Chroma集合配置格式一致，只包含距离度量"""
+        return {"hnsw": {"space": self.space}}
+
+    @property
+    def metadata(self) -> Optional[Dict[str, Any]]:
+        return None
+
+    def _map(self, name: str, dtype, shape: Tuple[int, ...]) -> Optional[np.ndarray]:
+        """只读映射文件的前 shape 部分，文件不足时返回 None"""
+        filename = self._file(name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if size == 0 or not os.path.exists(filename) or os.path.getsize(filename) < size:
+            return None
+        # 以普通 ndarray 视图访问映射内存，避免 np.memmap 子类在每次索引时的额外开销
+        return np.memmap(filename, dtype=dtype, mode="r", shape=shape).view(np.ndarray)
+
+    def _refresh(self) -> None:
+        """文件增长或索引版本变化时重新映射"""
+        self._settings = dict(self._conn.execute("SELECT key, value FROM settings").fetchall())
+        dim = self.dim
+        rows = int(self._setting("rows", "0"))
+        version = (self._setting("version"), self._setting("ivf_version"))
+        if rows == self._mapped_rows and version == self._mapped_version:
+            return
+        with self._lock:
+            if dim is None or rows == 0:
+                self._vectors, self._live, self._norms = None, None, None
+            else:
+                self._vectors = self._map("vectors.f32", np.float32, (rows, dim))
+                self._live = self._map("live.u8", np.uint8, (rows,))
+                if version != self._mapped_version or self._norms is None:
+                    self._norms = None
+                elif self._norms is not None and len(self._norms) < rows:
+                    self._norms = np.concatenate([self._norms, self._row_norms(len(self._norms), rows)])
+            nlist = int(self._setting("ivf_nlist", "0"))
+            indexed = int(self._setting("ivf_indexed_rows", "0"))
+            if nlist and dim:
+                self._centroids = self._map("ivf_centroids.f32", np.float32, (nlist, dim))
+                self._centroid_norms = np.linalg.norm(self._centroids, axis=1) if self._centroids is not None else None
+                self._assign = self._map("ivf_assign.i32", np.int32, (rows,))
+                self._order = self._map("ivf_order.i32", np.int32, (indexed,))
+                self._offsets = self._map("ivf_offsets.i64", np.int64, (nlist + 1,))
+            else:
+                self._centroids = self._assign = self._order = self._offsets = None
+            self._mapped_rows = rows
+            self._mapped_version = version
+
+    def _row_norms(self, start: int, end: int) -> np.ndarray:
+        norms = np.empty(end - start, dtype=np.float32)
+        for i in range(start, end, FLAT_SEARCH_BLOCK_ROWS):
+            block = np.asarray(self._vectors[i:min(end, i + FLAT_SEARCH_BLOCK_ROWS)])
+            norms[i - start:i - start + len(block)] = np.linalg.norm(block, axis=1)
+        return norms
+
+    def _pwrite(self, name: str, data: np.ndarray, offset: int) -> None:
+        fd = os.open(self._file(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, np.ascontiguousarray(data).tobytes(), offset)
+        finally:
+            os.close(fd)
+
+    def _set_live(self, rows: Iterable[int], value: int) -> None:
+        fd = os.open(self._file("live.u8"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            byte = bytes([value])
+            for row in rows:
+                os.pwrite(fd, byte, row)
+        finally:
+            os.close(fd)
+
+    # ---- 写入 ----
+
+    def _rows_for_ids(self, ids: List[str]) -> Dict[str, int]:
+        found: Dict[str, int] = {}
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            found.update(self._conn.execute(f"SELECT id, row FROM chunks WHERE id IN ({placeholders})", part).fetchall())
+        return found
+
+    def upsert(
+        self,
+        ids: List[str],
+        embeddings: Any,
+        metadatas: Optional[List[Dict[str, Any]]] = None,
+        documents: Optional[List[Optional[str]]] = None,
+    ) -> None:
+        """写入或替换向量：已存在的ID先标记删除，再在文件末尾追加新行"""
+        if not ids:
+            return
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[0] != len(ids):
+            raise ValueError(f"向量数量 {matrix.shape[0] if matrix.ndim else 0} 与ID数量 {len(ids)} 不一致")
+        metadatas = metadatas or [{} for _ in ids]
+        documents = documents or [None for _ in ids]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._settings = dict(self._conn.execute("SELECT key, value FROM settings").fetchall())
+                if self.dim is None:
+                    self._write_setting("dim", matrix.shape[1])
+                    self._settings["dim"] = str(matrix.shape[1])
+                elif matrix.shape[1] != self.dim:
+                    raise ValueError(f"向量维度 {matrix.shape[1]} 与集合维度 {self.dim} 不一致")
+                replaced = self._rows_for_ids(list(ids))
+                if replaced:
+                    self._conn.executemany("DELETE FROM chunks WHERE row = ?", [(row,) for row in replaced.values()])
+                rows = []
+                for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                    cursor = self._conn.execute(
+                        "INSERT INTO chunks (id, document, metadata) VALUES (?, ?, ?)",
+                        (chunk_id, document, json.dumps(metadata or {}, ensure_ascii=False))
+                    )
+                    rows.append(cursor.lastrowid - 1)
+                start = rows[0]
+                # 同一事务内分配的行号连续，向量一次写入
+                self._pwrite("vectors.f32", matrix, start * matrix.shape[1] * 4)
+                if self._centroids is not None:
+                    self._pwrite("ivf_assign.i32", self._nearest_centroids(matrix), start * 4)
+                self._pwrite("live.u8", np.ones(len(rows), dtype=np.uint8), start)
+                self._set_live([row - 1 for row in replaced.values()], 0)
+                self._write_setting("rows", max(int(self._setting("rows", "0")), rows[-1] + 1))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._refresh()
+            self._maybe_train()
+
+    add = upsert
+
+    def update(
+        self,
+        ids: List[str],
+        metadatas: Optional[List[Dict[str, Any]]] = None,
+        documents: Optional[List[Optional[str]]] = None,
+        embeddings: Any = None,
+    ) -> None:
+        """更新已存在的向量的元数据或文本，提供向量时按 upsert 处理"""
+        if embeddings is not None:
+            stored = self.get(ids=ids, include=["documents", "metadatas"])
+            current = {i: (d, m) for i, d, m in zip(stored["ids"], stored["documents"], stored["metadatas"])}
+            keep = [i for i, chunk_id in enumerate(ids) if chunk_id in current]
+            self.upsert(
+                [ids[i] for i in keep],
+                np.asarray(embeddings, dtype=np.float32)[keep],
+                [metadatas[i] if metadatas else current[ids[i]][1] for i in keep],
+                [documents[i] if documents else current[ids[i]][0] for i in keep],
+            )
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for i, chunk_id in enumerate(ids):
+                    if metadatas is not None:
+                        self._conn.execute(
+                            "UPDATE chunks SET metadata = ? WHERE id = ?",
+                            (json.dumps(metadatas[i] or {}, ensure_ascii=False), chunk_id)
+                        )
+                    if documents is not None:
+                        self._conn.execute("UPDATE chunks SET document = ? WHERE id = ?", (documents[i], chunk_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None) -> None:
+        """删除向量：清除附属表记录并将存活标记置零"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = [row for row, _ in self._select_rows(ids, where)]
+                for i in range(0, len(rows), 500):
+                    part = rows[i:i + 500]
+                    self._conn.execute(f"DELETE FROM chunks WHERE row IN ({','.join('?' * len(part))})", part)
+                self._set_live([row - 1 for row in rows], 0)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # ---- 读取 ----
+
+    def _select_rows(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        columns: str = "row, id",
+    ) -> List[tuple]:
+        params: List[Any] = []
+        conditions = []
+        if ids is not None:
+            if not ids:
+                return []
+            conditions.append(f"id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        if where:
+            conditions.append(_where_to_sql(where, params))
+        sql = f"SELECT {columns} FROM chunks"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY row"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([limit, offset or 0])
+        return self._conn.execute(sql, params).fetchall()
+
+    def _read_vectors(self, rows: List[int]) -> np.ndarray:
+        self._refresh()
+        if not rows or self._vectors is None:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(self._vectors[np.asarray(rows, dtype=np.int64)])
+
+    def get(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        include: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """按ID或元数据条件读取，返回格式与 chromadb.Collection.get 一致"""
+        include = ["metadatas", "documents"] if include is None else include
+        records = self._select_rows(ids, where, limit, offset, columns="row, id, document, metadata")
+        result: Dict[str, Any] = {"ids": [record[1] for record in records], "include": include}
+        result["documents"] = [record[2] for record in records] if "documents" in include else None
+        result["metadatas"] = [json.loads(record[3]) for record in records] if "metadatas" in include else None
+        result["embeddings"] = self._read_vectors([record[0] - 1 for record in records]) if "embeddings" in include else None
+        return result
+
+    def count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _similarity(self, matrix: np.ndarray, query: np.ndarray, norms: Optional[np.ndarray]) -> np.ndarray:
+        """计算相似度（越大越相似）"""
+        dots = matrix @ query
+        if self.space == "ip":
+            return dots
+        if self.space == "cosine":
+            return dots / np.maximum(norms * np.linalg.norm(query), 1e-12)
+        return 2 * dots - norms * norms - float(query @ query)
+
+    def _to_distance(self, similarity: np.ndarray) -> np.ndarray:
+        """转换为与Chroma一致的距离：l2 为平方距离，cosine / ip 为 1 - 相似度"""
+        return -similarity if self.space == "l2" else 1 - similarity
+
+    def _norms_for(self, rows: np.ndarray) -> Optional[np.ndarray]:
+        if self.space == "ip":
+            return None
+        if self._norms is None:
+            self._norms = self._row_norms(0, self._mapped_rows)
+        return self._norms[rows]
+
+    def _search_rows(self, query: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """在给定行中分块计算相似度，返回 top-k 的行号与相似度"""
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for i in range(0, len(rows), FLAT_SEARCH_BLOCK_ROWS):
+            block_rows = rows[i:i + FLAT_SEARCH_BLOCK_ROWS]
+            block_rows = block_rows[self._live[block_rows] == 1]
+            if len(block_rows) == 0:
+                continue
+            contiguous = block_rows[-1] - block_rows[0] + 1 == len(block_rows)
+            matrix = self._vectors[block_rows[0]:block_rows[-1] + 1] if contiguous else self._vectors[block_rows]
+            scores = self._similarity(np.asarray(matrix), query, self._norms_for(block_rows))
+            best_rows = np.concatenate([best_rows, block_rows])
+            best_scores = np.concatenate([best_scores, scores.astype(np.float32)])
+            if len(best_rows) > k:
+                top = np.argpartition(-best_scores, k - 1)[:k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        order = np.argsort(-best_scores)
+        return best_rows[order], best_scores[order]
+
+    def _ivf_rows(self, query: np.ndarray) -> np.ndarray:
+        """选择与查询最接近的 nprobe 个分区中的行，加上训练后新增、尚未排序的行"""
+        centroid_scores = self._similarity(self._centroids, query, self._centroid_norms)
+        nprobe = min(self.nprobe, len(centroid_scores))
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        parts = [np.asarray(self._order[self._offsets[p]:self._offsets[p + 1]], dtype=np.int64) for p in probes]
+        indexed = len(self._order)
+        if self._mapped_rows > indexed:
+            tail = np.arange(indexed, self._mapped_rows, dtype=np.int64)
+            if self._assign is None:
+                parts.append(tail)
+            else:
+                parts.append(tail[np.isin(np.asarray(self._assign[indexed:self._mapped_rows]), probes)])
+        rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        rows.sort()
+        return rows
+
+    def query(
+        self,
+        query_embeddings: Any,
+        n_results: int = 10,
+        where: Optional[Dict[str, Any]] = None,
+        include: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """向量检索，返回格式与 chromadb.Collection.query 一致"""
+        include = ["metadatas", "documents", "distances"] if include is None else include
+        self._refresh()
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        result: Dict[str, Any] = {key: [] for key in ("ids", "documents", "metadatas", "distances", "embeddings")}
+        for query in queries:
+            if self._vectors is None or self._live is None:
+                found_rows, scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            elif where:
+                # 有过滤条件时先在附属表中筛选出候选行，只对这些行计算距离
+                rows = np.array([row - 1 for row, _ in self._select_rows(where=where)], dtype=np.int64)
+                rows = rows[rows < self._mapped_rows]
+                found_rows, scores = self._search_rows(query, rows, n_results)
+            elif self._order is not None and self._centroids is not None:
+                found_rows, scores = self._search_rows(query, self._ivf_rows(query), n_results)
+            else:
+                found_rows, scores = self._search_rows(query, np.arange(self._mapped_rows, dtype=np.int64), n_results)
+
+            records = {}
+            row_list = [int(row) + 1 for row in found_rows]
+            for i in range(0, len(row_list), 500):
+                part = row_list[i:i + 500]
+                records.update((record[0], record) for record in self._conn.execute(
+                    f"SELECT row, id, document, metadata FROM chunks WHERE row IN ({','.join('?' * len(part))})", part
+                ).fetchall())
+            kept = [(row, score) for row, score in zip(row_list, scores) if row in records]
+            result["ids"].append([records[row][1] for row, _ in kept])
+            result["documents"].append([records[row][2] for row, _ in kept] if "documents" in include else None)
+            result["metadatas"].append([json.loads(records[row][3]) for row, _ in kept] if "metadatas" in include else None)
+            result["distances"].append(
+                self._to_distance(np.array([score for _, score in kept], dtype=np.float32)).tolist() if "distances" in include else None
+            )
+            result["embeddings"].append(self._read_vectors([row - 1 for row, _ in kept]) if "embeddings" in include else None)
+        return result
+
+    # ---- IVF 索引 ----
+
+    def _nearest_centroids(self, matrix: np.ndarray) -> np.ndarray:
+        centroids = np.asarray(self._centroids)
+        assign = np.empty(len(matrix), dtype=np.int32)
+        centroid_norms = np.linalg.norm(centroids, axis=1)
+        for i in range(0, len(matrix), FLAT_SEARCH_BLOCK_ROWS):
+            block = np.asarray(matrix[i:i + FLAT_SEARCH_BLOCK_ROWS], dtype=np.float32)
+            dots = block @ centroids.T
+            if self.space == "l2":
+                scores = 2 * dots - centroid_norms ** 2
+            elif self.space == "cosine":
+                scores = dots / np.maximum(centroid_norms, 1e-12)
+            else:
+                scores = dots
+            assign[i:i + len(block)] = np.argmax(scores, axis=1)
+        return assign
+
+    def _maybe_train(self) -> None:
+        """存活向量达到阈值、数据量较上次训练翻两番，或未排序的新增行过多时更新IVF索引"""
+        live = self.count()
+        trained_rows = int(self._setting("ivf_trained_rows", "0"))
+        indexed = int(self._setting("ivf_indexed_rows", "0"))
+        if live >= self.ivf_threshold and (trained_rows == 0 or live >= trained_rows * 4):
+            self.train_ivf()
+        elif self._centroids is not None and self._mapped_rows - indexed > max(indexed // 5, 1):
+            self._write_ivf_order()
+
+    def train_ivf(self, iterations: int = 10, seed: int = 0) -> None:
+        """在存活向量的样本上训练 k-means 聚类中心，并为所有行分配分区"""
+        with self._lock:
+            self._refresh()
+            rows = np.flatnonzero(np.asarray(self._live) == 1)
+            if len(rows) == 0:
+                return
+            nlist = max(1, min(4096, int(np.sqrt(len(rows)))))
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(rows, size=min(len(rows), nlist * 64), replace=False))
+            sample = np.asarray(self._vectors[sample_rows], dtype=np.float32)
+            if self.space == "cosine":
+                sample = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(iterations):
+                dots = sample @ centroids.T
+                if self.space == "l2":
+                    dots = 2 * dots - (centroids ** 2).sum(axis=1)
+                labels = np.argmax(dots, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, sample)
+                counts = np.bincount(labels, minlength=nlist)[:, None]
+                # 空分区保留原中心
+                centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+                if self.space == "cosine":
+                    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+            self._centroids = centroids.astype(np.float32)
+            assign = self._nearest_centroids(self._vectors)
+            self._write_file("ivf_centroids.f32", self._centroids)
+            self._write_file("ivf_assign.i32", assign)
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._write_setting("ivf_nlist", nlist)
+            self._write_setting("ivf_trained_rows", len(rows))
+            self._conn.execute("COMMIT")
+            self._write_ivf_order(assign)
+            logger.info(f"向量集合 {self.path} 已训练IVF索引: {nlist} 个分区，{len(rows)} 个向量")
+
+    def _write_file(self, name: str, data: np.ndarray) -> None:
+        """先写临时文件再原子替换，读取方不会映射到写了一半的文件"""
+        temp = self._file(name + ".tmp")
+        np.ascontiguousarray(data).tofile(temp)
+        os.replace(temp, self._file(name))
+
+    def _write_ivf_order(self, assign: Optional[np.ndarray] = None) -> None:
+        """按分区对全部行排序并写出分区偏移，新增行并入索引"""
+        with self._lock:
+            self._refresh()
+            if assign is None:
+                assign = np.asarray(self._assign)
+            nlist = int(self._setting("ivf_nlist", "0"))
+            order = np.argsort(assign, kind="stable").astype(np.int32)
+            offsets = np.searchsorted(assign[order], np.arange(nlist + 1)).astype(np.int64)
+            self._write_file("ivf_order.i32", order)
+            self._write_file("ivf_offsets.i64", offsets)
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._write_setting("ivf_indexed_rows", len(order))
+            self._write_setting("ivf_version", uuid.uuid4().hex)
+            self._conn.execute("COMMIT")
+            self._refresh()
+
+    # ---- 维护 ----
+
+    def compact(self, space: Optional[str] = None) -> int:
+        """
+        压缩集合：只保留存活的行并重新编号，达到阈值时重新训练IVF索引
+
+        Args:
+            space: 新的距离度量，不指定时保持不变
+
+        Returns:
+            压缩后的向量数量
+        """
+        if space is not None and space not in _SPACES:
+            raise ValueError(f"不支持的距离度量: {space}")
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                live_rows = [row - 1 for (row,) in self._conn.execute("SELECT row FROM chunks ORDER BY row").fetchall()]
+                if self._vectors is not None and live_rows:
+                    temp = self._file("vectors.f32.tmp")
+                    with open(temp, "wb") as f:
+                        for i in range(0, len(live_rows), FLAT_SEARCH_BLOCK_ROWS):
+                            f.write(np.ascontiguousarray(self._vectors[live_rows[i:i + FLAT_SEARCH_BLOCK_ROWS]]).tobytes())
+                    os.replace(temp, self._file("vectors.f32"))
+                self._write_file("live.u8", np.ones(len(live_rows), dtype=np.uint8))
+                # 按原顺序重新编号
+                self._conn.execute("CREATE TEMP TABLE renumber AS SELECT row AS old_row, ROW_NUMBER() OVER (ORDER BY row) AS new_row FROM chunks")
+                self._conn.execute("UPDATE chunks SET row = -(SELECT new_row FROM renumber WHERE old_row = chunks.row)")
+                self._conn.execute("UPDATE chunks SET row = -row")
+                self._conn.execute("DROP TABLE renumber")
+                self._conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'chunks'", (len(live_rows),))
+                self._write_setting("rows", len(live_rows))
+                self._write_setting("version", uuid.uuid4().hex)
+                for key in ("ivf_nlist", "ivf_trained_rows", "ivf_indexed_rows", "ivf_version"):
+                    self._conn.execute("DELETE FROM settings WHERE key = ?", (key,))
+                if space is not None:
+                    self._write_setting("space", space)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            for name in ("ivf_centroids.f32", "ivf_assign.i32", "ivf_order.i32", "ivf_offsets.i64"):
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            self._mapped_rows = -1
+            self._norms = None
+            self._refresh()
+            if len(live_rows) >= self.ivf_threshold:
+                self.train_ivf()
+            return len(live_rows)
+
+    def close(self) -> None:
+        self._vectors = self._live = self._norms = None
+        self._centroids = self._assign = self._order = self._offsets = None
+        self._conn.close()
+
+class FlatVectorStore(VectorStore):
+    """
+    基于 FlatCollection 的 LangChain 向量存储
+
+    与 langchain_chroma.Chroma 提供相同的常用接口（get、delete、get_by_ids、相似度检索），
+    并通过 _collection 暴露底层集合，供入库流水线直接写入向量。
+    """
+    def __init__(self, collection: FlatCollection, embedding_function: Optional[Embeddings] = None):
+        self._collection = collection
+        self._embedding_function = embedding_function
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding_function
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        space = self._collection.space
+        if space == "cosine":
+            return self._cosine_relevance_score_fn
+        if space == "ip":
+            return self._max_inner_product_relevance_score_fn
+        return self._euclidean_relevance_score_fn
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        embeddings = self._embedding_function.embed_documents(texts)
+        self._collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+        return ids
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        path: str = "./flat_vector_db",
+        **kwargs: Any,
+    ) -> "FlatVectorStore":
+        store = cls(FlatCollection(path, **kwargs), embedding)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[Document, float]]:
+        result = self._collection.query(query_embeddings=[embedding], n_results=k, where=filter)
+        return [
+            (Document(id=chunk_id, page_content=document or "", metadata=metadata or {}), distance)
+            for chunk_id, document, metadata, distance in zip(
+                result["ids"][0], result["documents"][0], result["metadatas"][0], result["distances"][0]
+            )
+        ]
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """与 Chroma 的同名方法一致，返回的是距离而不是相关性分数"""
+        return self.similarity_search_by_vector_with_score(embedding, k, filter)
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k, filter)
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        relevance_score_fn = self._select_relevance_score_fn()
+        return [(doc, relevance_score_fn(score)) for doc, score in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def get(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        include: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        return self._collection.get(ids=ids, where=where, limit=limit, offset=offset, include=include)
+
+    def get_by_ids(self, ids: List[str], /) -> List[Document]:
+        result = self._collection.get(ids=list(ids), include=["documents", "metadatas"])
+        return [
+            Document(id=chunk_id, page_content=document, metadata=metadata or {})
+            for chunk_id, document, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+            if document is not None
+        ]
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        self._collection.delete(ids=ids, where=kwargs.get("where"))
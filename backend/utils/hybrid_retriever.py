@@ -0,0 +1,263 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+from pydantic import ConfigDict
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from .bm25_index import BM25Index
+from .logger import logger_init
+
+logger = logger_init("hybrid_retriever")
+
+# 同步检索时用于并行执行关键词检索的线程池
+_lexical_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bm25")
+# 有元数据过滤条件时关键词检索多取的倍数，弥补事后过滤掉的命中
+_FILTER_OVERFETCH = 5
+# 融合分数归一化使用的检索路数（向量 + 关键词），与实际参与融合的路数无关
+_FUSION_PATHS = 2
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60, paths: int = _FUSION_PATHS) -> List[Tuple[str, float]]:
+    """
+    倒数排名融合（RRF）
+
+    每个结果在各路排名中得分 1 / (k + 名次)，累加后排序。
+    分数总是除以 paths 路检索都位列第一时的理论最大值 paths / (k + 1)，只被一路检索命中的结果
+    分数不超过 1 / paths。关键词索引尚未就绪、只有向量检索一路的知识库也按同一标准归一化，
+    多个知识库的结果合并排序时分数可以直接比较。
+
+    Args:
+        rankings: 各路检索按相关性排序的ID列表，没有命中的检索传入空列表
+        k: 平滑常数，越大则排名靠后的结果权重越接近靠前的结果
+        paths: 归一化使用的检索路数，默认为混合检索的两路
+
+    Returns:
+        按融合分数降序排列的 (ID, 分数) 列表
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    max_score = max(paths, len(rankings)) / (k + 1)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [(item_id, score / max_score) for item_id, score in fused]
+
+def mmr_select(
+    relevance: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.7,
+    dedup_threshold: float = 0.9,
+) -> List[int]:
+    """
+    最大边际相关性（MMR）选择
+
+    每一步选择 lambda * 相关性 - (1 - lambda) * 与已选结果的最大相似度 最高的候选。
+    相似度矩阵用一次矩阵乘法算出，每选一个结果只需一次向量化的 maximum 更新冗余度。
+    与已选结果的余弦相似度不低于 dedup_threshold 的候选视为重复内容，直接丢弃，
+    因此返回的数量可能少于 k。
+
+    Args:
+        relevance: 候选的相关性分数，形状为 (n,)
+        embeddings: 候选的向量，形状为 (n, dim)
+        k: 最多选择的数量
+        lambda_mult: 相关性与多样性的权衡，1 表示只看相关性
+        dedup_threshold: 判定为重复内容的相似度阈值
+
+    Returns:
+        选中候选的下标列表，按选择顺序排列
+    """
+    count = len(relevance)
+    if count == 0 or k <= 0:
+        return []
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors = vectors / norms
+    similarity = vectors @ vectors.T
+
+    relevance = np.asarray(relevance, dtype=np.float32)
+    redundancy = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    selected: List[int] = []
+    while len(selected) < k and available.any():
+        if selected:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+        available &= redundancy < dedup_threshold
+    return selected
+
+class HybridRetriever(BaseRetriever):
+    """
+    向量检索与 BM25 关键词检索的混合检索器
+
+    两路检索并行执行，结果用倒数排名融合合并。融合分数写入文档元数据的 score 字段，
+    向量相似度与 BM25 分数分别写入 vector_score、bm25_score。
+    BM25 索引未提供或尚未构建完成时只使用向量检索结果。
+
+    启用 MMR 时先取 fetch_k 个融合候选，从向量库读取它们已存储的向量做多样性筛选，
+    相邻文本块重叠造成的近似重复内容被剔除，返回更少、更不重复的文本块。
+
+    filter 为 Chroma 的 where 子句：向量检索直接在符合条件的向量中进行；
+    关键词索引不保存元数据，其命中多取若干倍，融合后先从向量库按同一条件过滤，再截取候选。
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: VectorStore
+    bm25_index: Optional[BM25Index] = None
+    filter: Optional[Dict[str, Any]] = None
+    k: int = 10
+    score_threshold: float = 0.5
+    fetch_k: int = 20
+    rrf_k: int = 60
+    mmr_enabled: bool = True
+    mmr_lambda: float = 0.7
+    dedup_threshold: float = 0.9
+
+    def _vector_search(self, query: str) -> List[Tuple[Document, float]]:
+        return self.vectorstore.similarity_search_with_relevance_scores(
+            query, k=self.fetch_k, score_threshold=self.score_threshold, filter=self.filter
+        )
+
+    def _vector_search_by_vector(self, embedding: List[float]) -> List[Tuple[Document, float]]:
+        """按查询向量检索，距离换算为相关性分数后按阈值过滤"""
+        relevance_score_fn = self.vectorstore._select_relevance_score_fn()
+        hits = self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=self.fetch_k, filter=self.filter
+        )
+        scored = [(doc, relevance_score_fn(distance)) for doc, distance in hits]
+        return [(doc, score) for doc, score in scored if score >= self.score_threshold]
+
+    async def _avector_search(self, query: str) -> List[Tuple[Document, float]]:
+        """
+        异步向量检索
+
+        查询向量由嵌入生成器的 aembed_query 计算，受其异步并发上限约束；
+        向量库的异步检索接口会在默认线程池中调用同步的 embed_query，绕过该限制。
+        """
+        embeddings = self.vectorstore.embeddings
+        if embeddings is None:
+            return await self.vectorstore.asimilarity_search_with_relevance_scores(
+                query, k=self.fetch_k, score_threshold=self.score_threshold, filter=self.filter
+            )
+        embedding = await embeddings.aembed_query(query)
+        return await asyncio.to_thread(self._vector_search_by_vector, embedding)
+
+    def _lexical_search(self, query: str) -> Optional[List[Tuple[str, float]]]:
+        """关键词检索，索引不可用时返回 None"""
+        if self.bm25_index is None or not self.bm25_index.ready:
+            return None
+        k = self.fetch_k * _FILTER_OVERFETCH if self.filter else self.fetch_k
+        return self.bm25_index.search(query, k=k)
+
+    def _fuse(
+        self, vector_hits: List[Tuple[Document, float]], lexical_hits: Optional[List[Tuple[str, float]]]
+    ) -> List[Document]:
+        """融合两路结果，只对关键词检索独有的命中从向量库补取文档内容"""
+        documents: Dict[str, Document] = {}
+        vector_scores: Dict[str, float] = {}
+        vector_ranking: List[str] = []
+        for doc, score in vector_hits:
+            if doc.id is None:
+                continue
+            documents[doc.id] = doc
+            vector_scores[doc.id] = score
+            vector_ranking.append(doc.id)
+        rankings = [vector_ranking]
+        lexical_scores: Dict[str, float] = {}
+        if lexical_hits is not None:
+            lexical_scores = dict(lexical_hits)
+            rankings.append([chunk_id for chunk_id, _ in lexical_hits])
+        fused = reciprocal_rank_fusion(rankings, k=self.rrf_k)
+        if self.filter:
+            # 关键词检索的命中没有元数据，先按过滤条件剔除，再截取 fetch_k 个候选，多取的命中才有意义
+            fused = self._filter_candidates(fused, documents)
+        if not fused:
+            return []
+
+        if self.mmr_enabled and len(fused) > 1:
+            fused = self._diversify(fused[:self.fetch_k], documents)
+        else:
+            fused = fused[:self.fetch_k]
+            missing = [chunk_id for chunk_id, _ in fused if chunk_id not in documents]
+            if missing:
+                stored = self._get_stored(missing, ["documents", "metadatas"])
+                for chunk_id, content, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+                    if content is not None:
+                        documents[chunk_id] = Document(id=chunk_id, page_content=content, metadata=metadata or {})
+            fused = [item for item in fused if item[0] in documents][:self.k]
+
+        results: List[Document] = []
+        for chunk_id, score in fused:
+            doc = documents.get(chunk_id)
+            if doc is None:
+                # 关键词索引中存在但向量已被删除
+                continue
+            metadata = dict(doc.metadata or {})
+            metadata["score"] = score
+            if chunk_id in vector_scores:
+                metadata["vector_score"] = vector_scores[chunk_id]
+            if chunk_id in lexical_scores:
+                metadata["bm25_score"] = lexical_scores[chunk_id]
+            results.append(Document(id=chunk_id, page_content=doc.page_content, metadata=metadata))
+        return results
+
+    def _filter_candidates(self, fused: List[Tuple[str, float]], documents: Dict[str, Document]) -> List[Tuple[str, float]]:
+        """读取关键词检索独有命中的文档内容，只保留符合过滤条件的候选；向量检索的命中已满足过滤条件"""
+        missing = [chunk_id for chunk_id, _ in fused if chunk_id not in documents]
+        if missing:
+            stored = self._get_stored(missing, ["documents", "metadatas"])
+            for chunk_id, content, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+                if content is not None:
+                    documents[chunk_id] = Document(id=chunk_id, page_content=content, metadata=metadata or {})
+        return [item for item in fused if item[0] in documents]
+
+    def _get_stored(self, ids: List[str], include: List[str]) -> Dict[str, Any]:
+        """按ID从向量库读取文本块，有过滤条件时只返回符合条件的"""
+        return self.vectorstore._collection.get(ids=ids, where=self.filter, include=include)
+
+    def _diversify(self, fused: List[Tuple[str, float]], documents: Dict[str, Document]) -> List[Tuple[str, float]]:
+        """读取候选的存储向量做 MMR 筛选，顺带补取关键词检索独有命中的文档内容"""
+        candidate_ids = [chunk_id for chunk_id, _ in fused]
+        stored = self._get_stored(candidate_ids, ["embeddings", "documents", "metadatas"])
+        vectors: Dict[str, np.ndarray] = {}
+        for chunk_id, embedding, content, metadata in zip(
+            stored["ids"], stored["embeddings"], stored["documents"], stored["metadatas"]
+        ):
+            vectors[chunk_id] = embedding
+            if chunk_id not in documents and content is not None:
+                documents[chunk_id] = Document(id=chunk_id, page_content=content, metadata=metadata or {})
+        # 向量已被删除或不符合过滤条件的候选不参与筛选
+        fused = [(chunk_id, score) for chunk_id, score in fused if chunk_id in vectors]
+        if not fused:
+            return []
+        selected = mmr_select(
+            np.array([score for _, score in fused], dtype=np.float32),
+            np.stack([vectors[chunk_id] for chunk_id, _ in fused]),
+            k=self.k,
+            lambda_mult=self.mmr_lambda,
+            dedup_threshold=self.dedup_threshold,
+        )
+        return [fused[i] for i in selected]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        lexical_future = _lexical_executor.submit(self._lexical_search, query)
+        vector_hits = self._vector_search(query)
+        return self._fuse(vector_hits, lexical_future.result())
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector_hits, lexical_hits = await asyncio.gather(
+            self._avector_search(query),
+            asyncio.to_thread(self._lexical_search, query),
+        )
+        return await asyncio.to_thread(self._fuse, vector_hits, lexical_hits)
@@ -0,0 +1,234 @@
+import re
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional, Callable
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# ATX 标题（最多3个空格缩进，可带结尾的#）、代码围栏、Setext 标题下划线、分隔线、列表项和引用、表格分隔行
+_ATX_HEADING = re.compile(r"^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$")
+_FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_SETEXT_UNDERLINE = re.compile(r"^ {0,3}(=+|-+)[ \t]*$")
+_THEMATIC_BREAK = re.compile(r"^ {0,3}(?:(?:-[ \t]*){3,}|(?:\*[ \t]*){3,}|(?:_[ \t]*){3,})$")
+_LIST_OR_QUOTE = re.compile(r"^ {0,3}(?:[-+*]|\d{1,9}[.)]|>)(?:[ \t]|$)")
+_TABLE_DELIMITER = re.compile(r"^ {0,3}\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+# PDF转换的Markdown中标记页码的注释行，页码从1开始
+PAGE_MARKER = "<!-- page: {} -->"
+_PAGE_MARKER = re.compile(r"^<!-- page: (\d+) -->$")
+
+# 段落过长时的分割符，优先在换行和句末处分割
+_TEXT_SEPARATORS = ["\n", "。", "？", "！", ". ", "? ", "! ", "；", "; ", "，", ", ", " ", ""]
+
+def _iter_blocks(lines: Iterable[str]) -> Iterator[Tuple[str, object]]:
+    """
+    单遍扫描Markdown行，产出标题和内容块
+
+    产出 ("heading", (级别, 标题))、("page", 页码) 或 ("block", (类型, 行列表))，类型为 "text"、"code" 或 "table"。
+    代码围栏内的行原样保留，不识别其中的标题；表格从表头行和分隔行开始，到空行或分隔线结束。
+    只有普通段落下方的 === 或 --- 构成 Setext 标题，列表、引用、代码块和表格之后的 --- 是分隔线，
+    分隔线只结束当前内容块，本身不计入文本。页码标记行（见 PAGE_MARKER）同样结束当前内容块。
+    """
+    block: List[str] = []
+    kind = "text"
+    fence: Optional[Tuple[str, int]] = None
+
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+        if fence is not None:
+            block.append(line)
+            stripped = line.strip()
+            if stripped.startswith(fence[0] * fence[1]) and not stripped.strip(fence[0]):
+                yield "block", ("code", block)
+                block, kind, fence = [], "text", None
+            continue
+
+        if not line.strip():
+            if block:
+                yield "block", (kind, block)
+                block, kind = [], "text"
+            continue
+
+        match = _FENCE.match(line)
+        if match and not (match.group(1)[0] == "`" and "`" in line[match.end():]):
+            if block:
+                yield "block", (kind, block)
+            marker = match.group(1)
+            block, kind, fence = [line], "code", (marker[0], len(marker))
+            continue
+
+        match = _PAGE_MARKER.match(line.strip())
+        if match:
+            if block:
+                yield "block", (kind, block)
+                block, kind = [], "text"
+            yield "page", int(match.group(1))
+            continue
+
+        if kind == "table":
+            if _THEMATIC_BREAK.match(line):
+                yield "block", (kind, block)
+                block, kind = [], "text"
+            else:
+                block.append(line)
+            continue
+
+        match = _ATX_HEADING.match(line)
+        if match:
+            if block:
+                yield "block", (kind, block)
+                block, kind = [], "text"
+            yield "heading", (len(match.group(1)), (match.group(2) or "").strip())
+            continue
+
+        if block and _SETEXT_UNDERLINE.match(line) and not any(_LIST_OR_QUOTE.match(item) for item in block):
+            # 普通段落下方的 === 或 --- 表示一级或二级标题
+            yield "heading", (1 if line.strip()[0] == "=" else 2, " ".join(item.strip() for item in block))
+            block = []
+            continue
+
+        if _THEMATIC_BREAK.match(line):
+            if block:
+                yield "block", (kind, block)
+                block, kind = [], "text"
+            continue
+
+        if block and "|" in block[-1] and _TABLE_DELIMITER.match(line):
+            # 表头行之前的段落行单独作为文本块
+            if len(block) > 1:
+                yield "block", ("text", block[:-1])
+            block, kind = [block[-1], line], "table"
+            continue
+
+        block.append(line)
+
+    if block:
+        yield "block", (kind, block)
+
+def _split_long_line(line: str, limit: int) -> List[str]:
+    return [line[i:i + limit] for i in range(0, len(line), limit)] or [line]
+
+def _group_lines(lines: List[str], limit: int, length_function: Callable[[str], int]) -> Iterator[List[str]]:
+    """将行按总长度不超过 limit 分组，超长的单行按字符截断"""
+    group: List[str] = []
+    size = 0
+    for line in lines:
+        length = length_function(line)
+        for part in _split_long_line(line, limit) if length > limit else [line]:
+            part_length = length if part is line else length_function(part)
+            if group and size + part_length + 1 > limit:
+                yield group
+                group, size = [], 0
+            group.append(part)
+            size += part_length + 1
+    if group:
+        yield group
+
+def _split_block(kind: str, lines: List[str], chunk_size: int, text_splitter: RecursiveCharacterTextSplitter,
+                 length_function: Callable[[str], int]) -> List[str]:
+    """
+    将超过 chunk_size 的内容块分割为多段
+
+    代码块的每一段都带上开闭围栏，表格的每一段都带上表头行和分隔行，分割后仍是合法的Markdown。
+    """
+    text = "\n".join(lines)
+    if length_function(text) <= chunk_size:
+        return [text]
+    if kind == "code":
+        opening = lines[0]
+        closed = len(lines) > 1 and _FENCE.match(lines[-1]) is not None
+        closing = lines[-1] if closed else opening.strip()[0] * 3
+        body = lines[1:-1] if closed else lines[1:]
+        limit = max(1, chunk_size - length_function(opening) - length_function(closing) - 2)
+        return ["\n".join([opening, *group, closing]) for group in _group_lines(body, limit, length_function)]
+    if kind == "table":
+        header = "\n".join(lines[:2])
+        limit = max(1, chunk_size - length_function(header) - 1)
+        return [header + "\n" + "\n".join(group) for group in _group_lines(lines[2:], limit, length_function)] or [header]
+    return text_splitter.split_text(text)
+
+def iter_markdown_sections(lines: Iterable[str], chunk_size: int = 1000, chunk_overlap: int = 200,
+                           length_function: Callable[[str], int] = len) -> Iterator[Tuple[str, Dict[str, str], Optional[int]]]:
+    """
+    单遍流式分割Markdown，产出带标题信息的文本块
+
+    逐行读取并维护标题栈，遇到标题时结束当前文本块；同一标题下的段落、列表、表格和代码块
+    整块合并到不超过 chunk_size 的文本块中，相邻文本块以末尾不超过 chunk_overlap 的完整内容块重叠。
+    超长的代码块和表格按行分割并补全围栏或表头，超长段落按句分割。标题行本身不计入文本块。
+    PDF转换的Markdown带有页码标记，文本块的页码取其第一个新内容块所在的页。
+
+    参数:
+        lines: Markdown文本的行，可以直接传入打开的文件对象
+        chunk_size: 文本块大小，默认1000字符
+        chunk_overlap: 块之间的重叠字符数，默认200
+        length_function: 计算文本长度的函数，默认按字符数，传入 token 计数函数时按 token 数分块
+
+    返回:
+        (text, headers, page) 的迭代器，headers 为 {"Header 1": 标题, ...}，只包含当前所在的各级标题；
+        page 为从1开始的页码，没有页码标记时为 None
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=_TEXT_SEPARATORS,
+        keep_separator="end",
+        length_function=length_function
+    )
+    heading_stack: Dict[int, str] = {}
+    pieces: List[str] = []
+    # 与 pieces 对应的各段长度
+    lengths: List[int] = []
+    # 与 pieces 对应的各段所在页码
+    pages: List[Optional[int]] = []
+    page: Optional[int] = None
+    size = 0
+    # pieces 开头作为重叠内容保留下来的段数
+    carried = 0
+
+    def headers() -> Dict[str, str]:
+        return {f"Header {level}": heading_stack[level] for level in sorted(heading_stack)}
+
+    def emit() -> Tuple[str, Dict[str, str], Optional[int]]:
+        nonlocal pieces, lengths, pages, size, carried
+        chunk = ("\n\n".join(pieces), headers(), pages[carried])
+        keep = 0
+        overlap_size = 0
+        for length in reversed(lengths[1:]):
+            if overlap_size + length > chunk_overlap:
+                break
+            keep += 1
+            overlap_size += length + 2
+        pieces, lengths, pages = (pieces[-keep:], lengths[-keep:], pages[-keep:]) if keep else ([], [], [])
+        size, carried = max(0, overlap_size - 2), keep
+        return chunk
+
+    for event, value in _iter_blocks(lines):
+        if event == "heading":
+            if len(pieces) > carried:
+                yield emit()
+            pieces, lengths, pages, size, carried = [], [], [], 0, 0
+            level, title = value
+            for deeper in [item for item in heading_stack if item >= level]:
+                del heading_stack[deeper]
+            if title:
+                heading_stack[level] = title
+            continue
+        if event == "page":
+            page = value
+            continue
+
+        kind, block = value
+        for piece in _split_block(kind, block, chunk_size, text_splitter, length_function):
+            length = length_function(piece)
+            while pieces and size + length + 2 > chunk_size:
+                if len(pieces) > carried:
+                    yield emit()
+                else:
+                    # 重叠内容放不下新的内容块时从前面丢弃
+                    pieces.pop(0)
+                    pages.pop(0)
+                    size = max(0, size - lengths.pop(0) - 2)
+                    carried -= 1
+            pieces.append(piece)
+            lengths.append(length)
+            pages.append(page)
+            size += length + (2 if len(pieces) > 1 else 0)
+
+    if len(pieces) > carried:
+        yield emit()
@@ -5,10 +5,16 @@ import logging
 import threading
 import io
 from pathlib import Path
+from typing import Callable, List, Optional
+from .markdown_chunker import PAGE_MARKER
 from .logger import logger_init
 
 logger = logger_init("pdf_to_markdown")
 
+# PDF向量化的文本来源：markdown（等待高分辨率解析生成的Markdown，用Markdown分块器向量化，解析失败时回退到PyPDF快速提取），
+# pypdf（上传后直接用PyPDF快速提取文本向量化，不等待Markdown）
+PDF_VECTOR_SOURCE = os.getenv("PDF_VECTOR_SOURCE", "markdown").lower()
+
 # 尝试从环境变量获取，否则使用默认路径
 poppler_path = os.getenv("POPPLER_PATH")
 if not poppler_path:
@@ -35,7 +41,7 @@ os.environ["PATH"] = poppler_path + os.pathsep + os.environ["PATH"]
 import fitz  # PyMuPDF
 from fitz import open as fitz_open
 from unstructured.partition.pdf import partition_pdf
-from langchain_unstructured import UnstructuredLoader
+from langchain_core.documents import Document
 import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 from PIL import Image
@@ -55,26 +61,7 @@ def resolve_pdf_path(pdf_path):
     # 相对路径，从当前工作目录解析
     return Path.cwd() / path
 
-# 方法1: 使用 langchain_unstructured 加载 PDF
-def load_with_langchain(pdf_path):
-    logger.info(f"使用 LangChain UnstructuredLoader 加载 PDF: {pdf_path}")
-    loader_local = UnstructuredLoader(
-        file_path=str(pdf_path),
-        strategy="hi_res",  # 高分辨率模式，支持复杂文档
-        infer_table_structure=True,  # 自动解析表格结构
-        languages=["chi_sim", "eng"],  # 支持中英文 OCR
-        ocr_engine="paddleocr",  # 指定 PaddleOCR 作为 OCR 引擎
-        poppler_path=poppler_path  # 明确指定 poppler 路径
-    )
-
-    docs_local = []
-    for doc in loader_local.lazy_load():
-        docs_local.append(doc)
-    
-    logger.info(f"成功加载 {len(docs_local)} 个文档元素")
-    return docs_local
-
-# 方法2: 使用 unstructured 直接处理 PDF
+# 使用 unstructured 直接处理 PDF，只解析一次，元素同时用于生成批注和Markdown
 def process_with_unstructured(pdf_path):
     logger.info("使用 unstructured 直接处理 PDF...")
     # 提取文本/结构化内容
@@ -90,6 +77,35 @@ def process_with_unstructured(pdf_path):
     logger.info(f"成功提取 {len(elements)} 个文档元素")
     return elements
 
+def elements_to_documents(elements) -> List[Document]:
+    """
+    将 partition_pdf 的元素转换为带坐标元数据的文档，供 render_page 生成批注
+
+    没有坐标信息的元素无法标注，不包含在结果中。
+    """
+    docs = []
+    for el in elements:
+        metadata = el.metadata.to_dict()
+        if "coordinates" not in metadata:
+            continue
+        metadata["category"] = el.category
+        docs.append(Document(page_content=el.text, metadata=metadata))
+    return docs
+
+def markdown_path_for(pdf_path) -> str:
+    """PDF转换生成的Markdown文件路径（与PDF同目录同名）"""
+    return os.path.join(os.path.dirname(os.path.abspath(pdf_path)), f"{Path(pdf_path).stem}.md")
+
+def vector_source_path(pdf_path: str) -> str:
+    """
+    PDF向量化使用的文件：PDF_VECTOR_SOURCE 为 markdown 且已生成Markdown时使用Markdown，否则使用PDF本身
+    """
+    if PDF_VECTOR_SOURCE == "markdown" and Path(pdf_path).suffix.lower() in (".pdf", ".pdfa", ".pdfx"):
+        md_path = markdown_path_for(pdf_path)
+        if os.path.exists(md_path):
+            return md_path
+    return pdf_path
+
 # 可视化函数
 def plot_pdf_with_boxes(pdf_page, segments):
     pix = pdf_page.get_pixmap()
@@ -241,12 +257,18 @@ def extract_images_and_convert_to_markdown(pdf_path, elements):
     # 转换为 Markdown
     md_lines = []
     inserted_images = set()  # 用来记录已经插入过的图片, 避免重复
+    current_page = None
 
     for el in elements:
         cat = el.category
         text = el.text
         page_num = el.metadata.page_number
 
+        # 写入页码标记，向量化时据此为文本块记录页码
+        if page_num is not None and page_num != current_page:
+            md_lines.append(PAGE_MARKER.format(page_num) + "\n")
+            current_page = page_num
+
         if cat == "List" and text.strip().startswith("- "):
             md_lines.append(text + "\n")
         elif cat == "Title":
@@ -271,18 +293,23 @@ def extract_images_and_convert_to_markdown(pdf_path, elements):
         else:
             md_lines.append(text + "\n")
 
-    # 写入 Markdown 文件，确保与源文件在同一目录
-    pdf_dir = os.path.dirname(os.path.abspath(pdf_path))
-    output_md = os.path.join(pdf_dir, f"{Path(pdf_path).stem}.md")
-    with open(output_md, "w", encoding="utf-8") as f:
+    # 写入 Markdown 文件，确保与源文件在同一目录；先写临时文件再改名，等待Markdown的向量化不会读到写了一半的文件
+    output_md = markdown_path_for(pdf_path)
+    with open(output_md + ".tmp", "w", encoding="utf-8") as f:
         f.write("\n".join(md_lines))
+    os.replace(output_md + ".tmp", output_md)
 
     logger.info(f"转换完成, 已生成: {output_md}")
     logger.info(f"图片文件夹路径: {output_dir}/")
+    return output_md
 
 # 处理PDF的主函数
 def process_pdf(pdf_path_str):
-    """处理PDF文件的主函数"""
+    """
+    处理PDF文件的主函数
+
+    只做一次高分辨率解析，解析出的元素同时用于生成批注版PDF和Markdown。
+    """
     try:
         # 解析PDF路径
         pdf_path = resolve_pdf_path(pdf_path_str)
@@ -294,13 +321,10 @@ def process_pdf(pdf_path_str):
             logger.error(error_msg)
             return False
             
-        # 尝试方法1
-        docs = load_with_langchain(pdf_path)
-        # 可视化所有页面并保存标注版
-        render_page(pdf_path, docs, save_annotated=True)
-        
-        # 尝试方法2
+        # 高分辨率解析一次
         elements = process_with_unstructured(pdf_path)
+        # 可视化所有页面并保存标注版
+        render_page(pdf_path, elements_to_documents(elements), save_annotated=True)
         # 转换为 Markdown
         extract_images_and_convert_to_markdown(pdf_path, elements)
         
@@ -312,9 +336,23 @@ def process_pdf(pdf_path_str):
         return False
 
 # 在后台线程中处理PDF
-def process_pdf_in_thread(pdf_path_str):
-    """在后台线程中处理PDF文件"""
-    thread = threading.Thread(target=process_pdf, args=(pdf_path_str,))
+def process_pdf_in_thread(pdf_path_str, on_complete: Optional[Callable[[bool], None]] = None):
+    """
+    在后台线程中处理PDF文件
+
+    参数:
+        pdf_path_str: PDF文件路径
+        on_complete: 处理结束后在同一线程中调用，参数为是否处理成功，用于在Markdown生成后继续向量化
+    """
+    def run():
+        success = False
+        try:
+            success = process_pdf(pdf_path_str)
+        finally:
+            if on_complete is not None:
+                on_complete(success)
+
+    thread = threading.Thread(target=run)
     thread.daemon = True  # 设置为守护线程，主程序退出时线程也会退出
     thread.start()
     logger.info(f"已在后台线程启动PDF处理: {pdf_path_str}")
@@ -1,17 +1,20 @@
-from langchain_core.vectorstores.base import VectorStoreRetriever
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.documents import Document
 from langchain_core.messages.base import BaseMessage
 
 import asyncio
 import json
 import os
-from typing import List, Generator, Any, Optional
+from typing import List, Dict, Generator, Any, Optional, Union
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 
 from langchain_community.chat_models import ChatZhipuAI
 from .database_chat import get_session_history, Message
 from ._config import humanRole, aiRole
 from .logger import logger_init
-from .chroma_store import load_chroma_store_retriever
+from .chroma_store import load_chroma_store_retriever, aretrieve_knowledge_bases
+from .retrieval_cache import retrieval_cache
+from .tokenizer import count_tokens
 
 logger = logger_init("rag_chat")
 
@@ -22,22 +25,52 @@ MAX_TOKENS: int = int(os.getenv("LLM_MAX_TOKENS", 2048))
 TOP_P: float = float(os.getenv("LLM_TOP_P", 0.8))
 STREAM_DELAY: float = float(os.getenv("STREAM_DELAY", 0.01))
 MAX_HISTORY_MESSAGES: int = int(os.getenv("MAX_HISTORY_MESSAGES", 10))
+# 检索上下文的 token 预算，按检索排序放入文本块直到用完，0 表示不限制
+RAG_CONTEXT_TOKEN_BUDGET: int = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", 3000))
+
+_chat: Optional[ChatZhipuAI] = None
 
 def get_chat() -> ChatZhipuAI:
     """
-    初始化并返回ChatZhipuAI实例。
+    初始化并返回ChatZhipuAI实例，进程内复用同一个实例，可在启动预热时提前创建。
     
     Returns:
         ChatZhipuAI: 配置好的ChatZhipuAI实例
     """
-    chat = ChatZhipuAI(
-        model=MODEL_NAME,
-        streaming=True,
-        temperature=TEMPERATURE,
-        max_tokens=MAX_TOKENS,
-        top_p=TOP_P,
-    )
-    return chat
+    global _chat
+    if _chat is None:
+        _chat = ChatZhipuAI(
+            model=MODEL_NAME,
+            streaming=True,
+            temperature=TEMPERATURE,
+            max_tokens=MAX_TOKENS,
+            top_p=TOP_P,
+        )
+    return _chat
+
+def build_context(docs: List[Document], token_budget: int = RAG_CONTEXT_TOKEN_BUDGET) -> tuple[str, int, int]:
+    """
+    按检索排序将文本块组装为上下文，总 token 数不超过预算
+
+    文本块的 token 数优先使用入库时记录的 token_count；放不下的文本块跳过，继续尝试排在后面的较短文本块。
+
+    Args:
+        docs: 检索到的文档，按相关性排序
+        token_budget: token 预算，0 表示不限制
+
+    Returns:
+        (上下文文本, 放入的文本块数, 上下文 token 数)
+    """
+    parts: List[str] = []
+    used = 0
+    for doc in docs:
+        header = f"文档 {len(parts)+1} (相似度: {doc.metadata.get('score')}):\n"
+        tokens = count_tokens(header) + (doc.metadata.get("token_count") or count_tokens(doc.page_content)) + (2 if parts else 0)
+        if token_budget and used + tokens > token_budget:
+            continue
+        parts.append(header + doc.page_content)
+        used += tokens
+    return "\n\n".join(parts), len(parts), used
 
 def convert_db_messages_to_langchain_messages(session_id:str) -> list[BaseMessage]:
     """
@@ -70,7 +103,8 @@ def convert_db_messages_to_langchain_messages(session_id:str) -> list[BaseMessag
 async def generate_rag_response_stream_with_context(
     input_text: str, 
     session_id: str, 
-    kb_id: str = "0"
+    kb_id: Union[str, List[str]] = "0",
+    filters: Optional[Dict[str, Any]] = None
 ) :
     """
     生成基于RAG的流式响应，包含上下文感知。
@@ -78,7 +112,8 @@ async def generate_rag_response_stream_with_context(
     Args:
         input_text: 用户输入文本
         session_id: 会话ID
-        kb_id: 知识库集合id，默认为"0" 默认系统知识库
+        kb_id: 知识库集合id或id列表，默认为"0" 默认系统知识库；多个知识库时并发检索并合并结果
+        filters: 元数据过滤条件，如 {"doc_id": "..."} 只检索指定文档
         
     Yields:
         str: 流式响应文本块
@@ -91,9 +126,10 @@ async def generate_rag_response_stream_with_context(
         yield f"data: {json.dumps({'content': '[ERROR] 输入参数无效'})}\n\n"
         return
         
+    kb_ids = [kb_id] if isinstance(kb_id, str) else list(dict.fromkeys(kb_id)) or ["0"]
     try:
         chat = get_chat()
-        logger.info(f"处理会话 {session_id} 的请求，知识库: {kb_id}")
+        logger.info(f"处理会话 {session_id} 的请求，知识库: {kb_ids}，过滤条件: {filters}")
         
         # 计时：初始化聊天模型
         t1 = time.time()
@@ -112,7 +148,7 @@ async def generate_rag_response_stream_with_context(
 
         # 加载知识库检索器
         retriever_start = time.time()
-        retriever: VectorStoreRetriever = load_chroma_store_retriever(kb_id)
+        retrievers: Dict[str, BaseRetriever] = {kb: load_chroma_store_retriever(kb, filters) for kb in kb_ids}
         
         # 计时：加载知识库检索器
         t3 = time.time()
@@ -154,12 +190,19 @@ async def generate_rag_response_stream_with_context(
         # docs = retriever.invoke(reconstructed_question)
         # 检索时会返回带 score 的文档
         retrieval_start = time.time()
-        docs = retriever.invoke(reconstructed_question)
+        # 使用异步检索，嵌入请求与向量检索不阻塞事件循环，并发会话可以重叠执行
+        try:
+            docs = await aretrieve_knowledge_bases(retrievers, reconstructed_question)
+        except Exception as e:
+            # 嵌入接口限流或失败时不中断对话，按无相关资料处理
+            logger.warning(f"知识库检索失败，将不使用检索上下文: {str(e)}")
+            docs = []
         
         # 计时：文档检索
         t5 = time.time()
         step_times['文档检索'] = t5 - retrieval_start
         logger.info(f"性能分析 - 文档检索耗时: {step_times['文档检索']:.3f}秒")
+        logger.info(f"检索缓存统计: {retrieval_cache.stats()}")
         
         logger.info(f"检索到 {len(docs)} 个相关文档")
 
@@ -171,11 +214,8 @@ async def generate_rag_response_stream_with_context(
             logger.info(f"文档 {i+1} 相似度分数: {score if score is not None else '未知'}")
         
         # 构建系统提示，包含检索到的上下文（添加相似度分数）
-        context_text = "\n\n".join([
-            f"文档 {i+1} (相似度: {doc.metadata.get('score')}):\n{doc.page_content}" 
-            for i, doc in enumerate(docs)
-        ])
-        logger.info(f"合并后的上下文总长度: {len(context_text)}")
+        context_text, packed_count, context_tokens = build_context(docs)
+        logger.info(f"合并后的上下文总长度: {len(context_text)}，放入 {packed_count}/{len(docs)} 个文档，约 {context_tokens} tokens")
         
         # 检查是否有相关上下文
         if not context_text.strip():
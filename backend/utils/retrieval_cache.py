@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, Hashable, Callable
+from pydantic import ConfigDict
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from .embedding_cache import normalize_query
+from .logger import logger_init
+
+logger = logger_init("retrieval_cache")
+
+# 检索结果缓存配置：是否启用、内存上限(MB)、过期时间(秒)
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RETRIEVAL_CACHE_MAX_MB = float(os.getenv("RETRIEVAL_CACHE_MAX_MB", 64))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
+
+# 每个缓存条目的固定开销估算（键、列表与字典对象）
+_ENTRY_OVERHEAD = 256
+
+def _estimate_bytes(entries: Tuple[Tuple[Optional[str], str, Dict[str, Any]], ...]) -> int:
+    """估算缓存条目占用的内存"""
+    size = _ENTRY_OVERHEAD
+    for doc_id, content, metadata in entries:
+        size += len(content.encode("utf-8")) + len(repr(metadata)) + (len(doc_id) if doc_id else 0)
+    return size
+
+class RetrievalCache:
+    """
+    检索结果的内存 LRU 缓存
+
+    以 (知识库ID, 检索范围, 知识库版本号, 规范化查询文本) 为键，检索范围区分不同的过滤条件。知识库每次增删文档都会递增版本号，
+    旧版本的条目不会再被命中，随 LRU 淘汰，因此失效精确且无需扫描。
+    总大小按文档内容与元数据估算，超过 max_bytes 时淘汰最久未使用的条目。
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kb_id: str, generation: Hashable, query: str, scope: Hashable = None) -> Optional[List[Document]]:
+        """获取缓存的检索结果，返回文档副本；过期或不存在时返回 None"""
+        key = (kb_id, scope, generation, normalize_query(query))
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                expires_at, size, entries = entry
+                if expires_at > time.monotonic():
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return [Document(id=doc_id, page_content=content, metadata=dict(metadata)) for doc_id, content, metadata in entries]
+                del self._cache[key]
+                self._bytes -= size
+            self.misses += 1
+            return None
+
+    def put(self, kb_id: str, generation: Hashable, query: str, docs: List[Document], scope: Hashable = None) -> None:
+        """写入检索结果，超出容量时淘汰最久未使用的条目"""
+        entries = tuple((doc.id, doc.page_content, dict(doc.metadata or {})) for doc in docs)
+        size = _estimate_bytes(entries)
+        if size > self.max_bytes:
+            return
+        key = (kb_id, scope, generation, normalize_query(query))
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._cache[key] = (time.monotonic() + self.ttl, size, entries)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._cache.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._cache),
+            "evictions": self.evictions,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+# 进程内共享的检索结果缓存
+retrieval_cache = RetrievalCache(max_bytes=int(RETRIEVAL_CACHE_MAX_MB * 1024 * 1024), ttl=RETRIEVAL_CACHE_TTL)
+
+class CachedRetriever(BaseRetriever):
+    """
+    为检索器增加结果缓存
+
+    generation 返回知识库当前的版本标识，命中时跳过查询嵌入与向量检索。
+    版本号在检索前读取：检索期间知识库发生变化时，结果写入旧版本的键，不会被后续请求命中。
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    retriever: BaseRetriever
+    kb_id: str
+    generation: Callable[[], Hashable]
+    scope: Optional[Hashable] = None
+    cache: RetrievalCache = retrieval_cache
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        generation = self.generation()
+        docs = self.cache.get(self.kb_id, generation, query, self.scope)
+        if docs is None:
+            docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+            self.cache.put(self.kb_id, generation, query, docs, self.scope)
+        return docs
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        generation = self.generation()
+        docs = self.cache.get(self.kb_id, generation, query, self.scope)
+        if docs is None:
+            docs = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+            self.cache.put(self.kb_id, generation, query, docs, self.scope)
+        return docs
@@ -0,0 +1,59 @@
+import os
+import re
+import math
+from functools import lru_cache
+from typing import Callable
+from .logger import logger_init
+
+# tiktoken 为可选依赖：安装后按 BPE 编码精确计数，否则按字符类别估算
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logger_init("tokenizer")
+
+# 分词器：auto（有 tiktoken 时使用，否则估算）、tiktoken、heuristic；tiktoken 使用的编码；计数缓存条数
+TOKENIZER = os.getenv("TOKENIZER", "auto").lower()
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 16384))
+
+# 估算规则：中日韩字符每字计 1 个 token，字母数字串每 4 个字符计 1 个，其他非空白字符每个计 1 个
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]|[A-Za-z0-9_]+|[^\s{_CJK}A-Za-z0-9_]")
+
+def _heuristic_count(text: str) -> int:
+    count = 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        length = match.end() - match.start()
+        count += 1 if length <= 4 else math.ceil(length / 4)
+    return count
+
+def _load_counter() -> Callable[[str], int]:
+    if TOKENIZER in ("auto", "tiktoken") and tiktoken is not None:
+        try:
+            encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            logger.info(f"使用 tiktoken 编码 {TOKENIZER_ENCODING} 计算 token 数")
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            logger.warning(f"加载 tiktoken 编码 {TOKENIZER_ENCODING} 失败，改用估算: {str(e)}")
+    elif TOKENIZER == "tiktoken":
+        logger.warning("未安装 tiktoken，改用估算的 token 数")
+    return _heuristic_count
+
+_counter = _load_counter()
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text: str) -> int:
+    """
+    计算文本的 token 数
+
+    分割器合并文本片段时会反复计算相同片段的长度，结果按文本缓存。
+
+    参数:
+        text: 文本
+
+    返回:
+        token 数
+    """
+    return _counter(text)
@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+from typing import Dict, Any, List, Callable, Optional
+from sqlalchemy import text
+from .database_chat import engine as chat_engine
+from .database_knowledge import engine as knowledge_engine, list_knowledge_base_ids
+from . import chroma_store
+from .rag_chat import get_chat
+from .logger import logger_init
+
+logger = logger_init("warmup")
+
+# 启动预热配置：是否启用、预热最近使用的知识库数量、用于预热嵌入接口的查询文本（为空则跳过）
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+WARMUP_KB_LIMIT = int(os.getenv("WARMUP_KB_LIMIT", 5))
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "你好")
+
+class WarmupState:
+    """预热进度，ready 为 True 后就绪检查接口才返回成功"""
+    def __init__(self):
+        self.ready = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.steps: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.steps[name] = round(seconds, 3)
+            if error is not None:
+                self.errors[name] = error
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "elapsed": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else 0.0,
+                "steps": dict(self.steps),
+                "errors": dict(self.errors),
+            }
+
+warmup_state = WarmupState()
+
+def _run_step(name: str, func: Callable[[], Any]) -> None:
+    """执行一个预热步骤，失败只记录日志，不影响服务启动"""
+    start = time.time()
+    try:
+        func()
+        warmup_state.record(name, time.time() - start)
+    except Exception as e:
+        warmup_state.record(name, time.time() - start, str(e))
+        logger.warning(f"预热步骤 {name} 失败: {str(e)}")
+
+def _warm_databases() -> None:
+    """打开数据库连接池中的连接"""
+    for engine in (chat_engine, knowledge_engine):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+def _warm_collection(kb_id: str) -> None:
+    """
+    打开知识库的向量集合并执行一次检索，使索引文件载入内存
+
+    检索使用集合中已存储的一个向量，不调用嵌入接口；同时触发关键词索引的加载或后台构建。
+    """
+    store = chroma_store.get_chroma_store(kb_id)
+    sample = store._collection.get(limit=1, include=["embeddings"])
+    embeddings = sample.get("embeddings")
+    if sample.get("ids") and embeddings is not None and len(embeddings):
+        store._collection.query(query_embeddings=[embeddings[0]], n_results=1, include=[])
+    if chroma_store.HYBRID_SEARCH_ENABLED:
+        chroma_store.get_kb_bm25_index(kb_id)
+
+def _warm_embeddings() -> None:
+    """嵌入一次查询，建立到嵌入接口的连接；结果进入嵌入缓存，之后的预热不再产生调用"""
+    if chroma_store.embedding_generator is not None and WARMUP_QUERY:
+        chroma_store.embedding_generator.embed_query(WARMUP_QUERY)
+
+def recent_knowledge_base_ids(limit: int = WARMUP_KB_LIMIT) -> List[str]:
+    """最近使用的、已创建向量集合的知识库，系统知识库"0"排在最前"""
+    kb_ids = ["0"] + [kb_id for kb_id in list_knowledge_base_ids(limit=limit) if kb_id != "0"]
+    return [kb_id for kb_id in kb_ids if chroma_store.chroma_store_exists(kb_id)][:limit + 1]
+
+def run_warmup() -> Dict[str, Any]:
+    """
+    启动预热：打开数据库连接、向量库客户端与对话模型客户端，
+    预加载最近使用的知识库集合并执行一次检索
+
+    各步骤失败只记录，完成后无论成功与否都标记为就绪，避免服务一直不可用。
+
+    Returns:
+        预热结果，包含各步骤耗时与错误信息
+    """
+    warmup_state.started_at = time.time()
+    kb_ids: List[str] = []
+    try:
+        _run_step("databases", _warm_databases)
+        if chroma_store.VECTOR_STORE_BACKEND == "chroma":
+            _run_step("chroma_client", chroma_store.get_chroma_client)
+        _run_step("chat_client", get_chat)
+        _run_step("embeddings", _warm_embeddings)
+        _run_step("list_knowledge_bases", lambda: kb_ids.extend(recent_knowledge_base_ids()))
+        for kb_id in kb_ids:
+            _run_step(f"collection:{kb_id}", lambda kb_id=kb_id: _warm_collection(kb_id))
+    finally:
+        warmup_state.finished_at = time.time()
+        warmup_state.ready = True
+    result = warmup_state.to_dict()
+    logger.info(f"启动预热完成，耗时 {result['elapsed']:.2f} 秒，预热知识库 {kb_ids}，失败步骤: {list(result['errors'])}")
+    return result